@@ -0,0 +1,127 @@
+"""
+Micro-benchmark of :func:`statmagic_backend.geo.transform.decode_protobuf_to_geojson_wgs84`
+against the original per-vertex implementation, checking that both produce
+identical output.
+
+Usage::
+
+    python benchmarks/bench_decode_tiles.py [tile_cache.mbtiles]
+
+With a :class:`~statmagic_backend.geo.tile_cache.TileCache` file (e.g. the
+``cache_path`` of a previous :func:`macrostrat_from_bounds` run) the real
+Macrostrat tiles stored in it are used. Otherwise dense synthetic tiles are
+generated.
+"""
+
+import copy
+import sqlite3
+import sys
+import time
+
+import mapbox_vector_tile
+import mercantile
+import numpy as np
+
+from statmagic_backend.geo.transform import decode_protobuf_to_geojson_wgs84
+
+
+def reference_decode(tile, layername, bounds, tilesize):
+    """ Per-vertex implementation prior to vectorization """
+    def process_coord_pair(coord_pair):
+        return [
+            round(float(coord_pair[0]) / float(tilesize) * (
+                        bounds.east - bounds.west) + bounds.west, 5),
+            round(float(coord_pair[1]) / float(tilesize) * (
+                        bounds.north - bounds.south) + bounds.south, 5)
+        ]
+
+    data_decoded = mapbox_vector_tile.decode(tile)
+    if layername not in data_decoded:
+        return None
+    data = data_decoded[layername]
+    fnews = []
+    for feature in data['features']:
+        fnew = copy.deepcopy(feature)
+        coords = fnew['geometry']['coordinates']
+        coords_new = []
+        if fnew['geometry']['type'] == 'LineString':
+            for coord_pair in coords:
+                coords_new.append(process_coord_pair(coord_pair))
+        else:
+            for poly in coords:
+                poly_new = []
+                for part in poly:
+                    if type(part[0]) == list:
+                        part_new = []
+                        for coord_pair in part:
+                            part_new.append(process_coord_pair(coord_pair))
+                        poly_new.append(part_new)
+                    else:
+                        poly_new.append(process_coord_pair(part))
+                coords_new.append(poly_new)
+        fnew['geometry']['coordinates'] = coords_new
+        fnews.append(fnew)
+    data['features'] = fnews
+    return data
+
+
+def synthetic_tiles(num_tiles=20, num_features=300, num_vertices=200, seed=0):
+    """ Dense 'units' tiles of random star-shaped polygons """
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for i in range(num_tiles):
+        features = []
+        for j in range(num_features):
+            cx, cy = rng.uniform(200, 3900, 2)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices))
+            radii = rng.uniform(20, 200, num_vertices)
+            ring = [(cx + r * np.cos(a), cy + r * np.sin(a)) for a, r in zip(angles, radii)]
+            ring.append(ring[0])
+            wkt = "POLYGON((" + ",".join(f"{x:.0f} {y:.0f}" for x, y in ring) + "))"
+            features.append({"geometry": wkt, "properties": {"map_id": j}})
+        tiles.append(((10, 240 + i, 380), mapbox_vector_tile.encode([{"name": "units", "features": features}])))
+    return tiles
+
+
+def cached_tiles(cache_path):
+    with sqlite3.connect(cache_path) as conn:
+        rows = conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")
+        return [((z, x, y), data) for z, x, y, data in rows]
+
+
+def time_decode(func, tiles):
+    start = time.perf_counter()
+    for (z, x, y), tile in tiles:
+        func(tile, "units", mercantile.bounds(x, y, z), 4096)
+    return time.perf_counter() - start
+
+
+def main(cache_path=None):
+    tiles = cached_tiles(cache_path) if cache_path else synthetic_tiles()
+
+    vertices = 0
+    for (z, x, y), tile in tiles:
+        bounds = mercantile.bounds(x, y, z)
+        expected = reference_decode(tile, "units", bounds, 4096)
+        assert decode_protobuf_to_geojson_wgs84(tile, "units", bounds, 4096) == expected, \
+            f"outputs differ for tile {z}/{x}/{y}"
+        if expected:
+            for f in expected['features']:
+                vertices += len(np.ravel(f['geometry']['coordinates'])) // 2
+    print(f"{len(tiles)} tiles, {vertices} vertices; outputs identical")
+
+    # Protobuf decoding is shared by both; report georegistration on its own
+    decode_time = time_decode(lambda tile, *args: mapbox_vector_tile.decode(tile), tiles)
+    reference_time = time_decode(reference_decode, tiles)
+    vectorized_time = time_decode(decode_protobuf_to_geojson_wgs84, tiles)
+
+    print(f"{'decode':>10}: {decode_time:7.3f} s")
+    for name, elapsed in (("reference", reference_time), ("vectorized", vectorized_time)):
+        print(f"{name:>10}: {elapsed:7.3f} s total, "
+              f"{elapsed - decode_time:7.3f} s georegistration")
+    speedup = (reference_time - decode_time) / (vectorized_time - decode_time)
+    print(f"georegistration speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
@@ -0,0 +1,32 @@
+"""
+Benchmark of :func:`statmagic_backend.geo.transform.download_tiles` against a
+local stand-in tile server, serial vs. concurrent.
+
+Usage::
+
+    python benchmarks/bench_download_tiles.py [num_tiles] [latency_seconds]
+"""
+
+import sys
+import time
+
+from statmagic_backend.geo.transform import download_tiles
+from tile_server import StandInTileServer
+
+
+def main(num_tiles=200, latency=0.02):
+    tile_indices = [[10, 200 + i % 20, 300 + i // 20] for i in range(num_tiles)]
+
+    with StandInTileServer(latency=latency) as server:
+        for workers in (1, 4, 8, 16, 32):
+            start = time.perf_counter()
+            tiles = download_tiles(tile_indices, server.url, "carto", max_workers=workers)
+            elapsed = time.perf_counter() - start
+            assert len(tiles) == num_tiles
+            print(f"max_workers={workers:>3}: {elapsed:7.3f} s "
+                  f"({num_tiles / elapsed:8.1f} tiles/s)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 200, float(args[1]) if len(args) > 1 else 0.02)
@@ -0,0 +1,70 @@
+"""
+Benchmark of :func:`statmagic_backend.dev.match_stack_raster_tools.match_and_stack_rasters`
+on synthetic rasters, scaling from 1 to N cores with the thread and process
+backends.
+
+Usage::
+
+    python benchmarks/bench_stack_rasters.py [num_layers] [template_size] [max_cores]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from statmagic_backend.dev.match_stack_raster_tools import match_and_stack_rasters
+
+
+def make_rasters(directory, num_layers, size):
+    """ Writes a UTM template and ``num_layers`` lat/lon inputs covering it """
+    template_path = Path(directory, "template.tif")
+    template = np.ones((1, size, size), dtype='float32')
+    template[:, :size // 8, :size // 8] = -999
+    with rio.open(template_path, 'w', driver='GTiff', height=size, width=size, count=1,
+                  dtype='float32', crs='EPSG:32615', nodata=-999,
+                  transform=from_origin(400000, 4500000, 30000 / size, 30000 / size)) as dst:
+        dst.write(template)
+
+    rng = np.random.default_rng(0)
+    input_paths = []
+    for i in range(num_layers):
+        path = Path(directory, f"layer_{i}.tif")
+        with rio.open(path, 'w', driver='GTiff', height=size, width=size, count=1,
+                      dtype='float32', crs='EPSG:4326', nodata=-999,
+                      transform=from_origin(-94.3, 40.7, 0.4 / size, 0.4 / size)) as dst:
+            dst.write(rng.random((1, size, size), dtype='float32'))
+        input_paths.append(str(path))
+    return str(template_path), input_paths
+
+
+def main(num_layers=16, size=2048, max_cores=None):
+    max_cores = max_cores or os.cpu_count()
+    cores = sorted({1, 2, 4, 8, 16, max_cores} & set(range(1, max_cores + 1)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        template_path, input_paths = make_rasters(directory, num_layers, size)
+        args = (template_path, input_paths, [Resampling.bilinear] * num_layers, ["all"] * num_layers)
+
+        for backend in ("thread", "process"):
+            baseline = None
+            for num_threads in cores:
+                start = time.perf_counter()
+                match_and_stack_rasters(*args, num_threads=num_threads, backend=backend)
+                elapsed = time.perf_counter() - start
+                baseline = baseline or elapsed
+                print(f"{backend:>7} num_threads={num_threads:>3}: {elapsed:7.3f} s "
+                      f"(speedup {baseline / elapsed:5.2f}x)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 16,
+         int(args[1]) if len(args) > 1 else 2048,
+         int(args[2]) if len(args) > 2 else None)
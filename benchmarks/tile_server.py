@@ -0,0 +1,61 @@
+"""
+Local stand-in for a Mapbox vector tile server, used by the benchmarks.
+
+Serves ``/{service}/{z}/{x}/{y}`` with a fixed payload after an artificial
+delay, which approximates the round trip to a remote tile server.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInTileServer:
+    """
+    Threaded HTTP server running in the background.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds to wait before answering each request
+    payload : bytes or callable
+        Body returned for every tile, or a function of the request path
+        returning the body
+    """
+
+    def __init__(self, latency=0.02, payload=b"\x1a\x00"):
+        self.latency = latency
+        self.payload = payload
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                body = server.payload(self.path) if callable(server.payload) else server.payload
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,27 +1,234 @@
+import asyncio
+import functools
+import itertools
+
 import geopandas as gpd
-from statmagic_backend.geo.transform import get_tiles_for_ll_bounds, download_tiles, process_tiles, dissolve_vector_files_by_property
+from statmagic_backend.geo.async_tiles import iter_decoded_tiles
+from statmagic_backend.geo.feature_spill import FeatureSpill
+from statmagic_backend.geo.transform import get_tiles_for_ll_bounds, get_adaptive_tiles_for_ll_bounds, download_tiles, process_tiles, dissolve_vector_files_by_property, dissolve_feature_spill, snap_to_tile_seams
+from statmagic_backend.geo.tile_cache import TileCache
 from pathlib import Path
 
-def macrostrat_from_bounds(bounds, output_path, zoom_level = 10):
 
-    tile_indices = get_tiles_for_ll_bounds(**bounds, zoom_level=zoom_level)
+def _macrostrat_tiles(bounds, zoom_level, aoi, precision, max_tiles):
+    """ Tiles to download, at ``zoom_level`` or adapted to ``precision`` """
+    if precision is None:
+        return get_tiles_for_ll_bounds(**bounds, zoom_level=zoom_level, aoi=aoi)
+    return get_adaptive_tiles_for_ll_bounds(
+        **bounds, precision=precision, max_tiles=max_tiles, max_zoom=zoom_level, aoi=aoi
+    )
+
+
+def _spill_tile(spill, features, zoom):
+    """ Spills one decoded tile's ``units`` features, seamed at its zoom level """
+    spill.add(features['features'], functools.partial(snap_to_tile_seams, zoom_level=zoom))
+
+
+def _dissolve_spill(spill, output_path, bounds, output_format):
+    """ Dissolves spilled ``units`` features to ``output_path`` and closes the spill """
+    with spill:
+        dissolve_feature_spill(
+            spill, ['Polygon', 'MultiPolygon'], output_path, **bounds,
+            output_format=output_format
+        )
+
+
+def macrostrat_from_bounds(bounds, output_path, zoom_level = 10, cache_path=None, keep_tile_files=False, aoi=None, num_workers=1, streaming=False, output_format=None, precision=None, max_tiles=None):
+    """
+    Downloads the Macrostrat ``units`` layer within a lat/lon bounding box and
+    writes it, dissolved by ``map_id`` and clipped to the bounds, to file.
+
+    Parameters
+    ----------
+    bounds : dict
+        Lat/lon bounds with keys ``n``, ``s``, ``e``, ``w``
+    output_path : str
+        File path for the output file. A ``.parquet`` or ``.fgb`` extension
+        writes GeoParquet or FlatGeobuf instead of GeoJSON.
+    zoom_level : int, optional
+        Vector tile server zoom level (higher = more zoomed in). With
+        ``precision``, the finest zoom level used.
+    cache_path : str or Path, optional
+        SQLite tile cache to read tiles from and add downloaded tiles to
+    keep_tile_files : bool, optional
+        Also write the decoded tiles as json files next to ``output_path``,
+        for debugging. Tiles are otherwise kept in memory only.
+    aoi : shapely.Geometry, optional
+        Area of interest in lat/lon. If given, only tiles intersecting it are
+        downloaded instead of every tile in ``bounds``.
+    num_workers : int, optional
+        Number of processes used to dissolve the features
+    streaming : bool, optional
+        Dissolve with bounded memory: each tile's features are spilled to a
+        temporary file as soon as the tile is decoded, so at most one
+        decoded tile is held in memory; for very large extents at high zoom
+        levels
+    output_format : str, optional
+        ``'GeoJSON'``, ``'GeoParquet'`` or ``'FlatGeobuf'``, overriding the
+        format implied by the extension of ``output_path``
+    precision : float, optional
+        Target georegistration precision in metres. If given, each region is
+        downloaded at the lowest zoom level reaching it (see
+        :func:`~statmagic_backend.geo.transform.get_adaptive_tiles_for_ll_bounds`)
+        instead of everything at ``zoom_level``, and the tiles at mixed zoom
+        levels are dissolved into one layer.
+    max_tiles : int, optional
+        With ``precision``, the tile budget; the precision is relaxed if
+        more tiles would be needed
+    """
+
+    tile_indices = _macrostrat_tiles(bounds, zoom_level, aoi, precision, max_tiles)
 
     print("Now downloading Macrostrat data")
-    mapbox_tiles = download_tiles(tile_indices, "https://dev.macrostrat.org/tiles/", "carto")
+    if cache_path:
+        # Reruns over overlapping extents reuse the tiles stored here
+        with TileCache(cache_path) as cache:
+            mapbox_tiles = download_tiles(tile_indices, "https://dev.macrostrat.org/tiles/", "carto", cache=cache)
+            print(f"Tile cache: {cache.stats()}")
+    else:
+        mapbox_tiles = download_tiles(tile_indices, "https://dev.macrostrat.org/tiles/", "carto")
 
     print("Now converting from Mapbox to json")
-    js_paths = process_tiles(mapbox_tiles, tile_indices, Path(output_path).parent, "units", 4096)
+    # Decoded tiles are passed straight on to the dissolve; the per-tile json
+    # files are only written when asked for (e.g. for debugging)
+    tile_dir = Path(output_path).parent if keep_tile_files else None
+    if streaming:
+        spill = FeatureSpill('map_id')
+        try:
+            for tile_index, tile in zip(tile_indices, mapbox_tiles):
+                for features in process_tiles([tile], [tile_index], tile_dir, "units", 4096, return_features=True):
+                    _spill_tile(spill, features, tile_index[0])
+        except BaseException:
+            spill.close()
+            raise
+
+        print("Now dissolving tiles")
+        _dissolve_spill(spill, output_path, bounds, output_format)
+        return
+
+    tile_features = []
+    seam_zooms = []
+    # One zoom level at a time, so each tile's features are seamed at its own zoom
+    by_zoom = sorted(zip(tile_indices, mapbox_tiles), key=lambda t: t[0][0])
+    for zoom, group in itertools.groupby(by_zoom, key=lambda t: t[0][0]):
+        indices, tiles = zip(*group)
+        features = process_tiles(tiles, indices, tile_dir, "units", 4096, return_features=True)
+        tile_features += features
+        seam_zooms += [zoom] * len(features)
 
     print("Now dissolving tiles")
     dissolve_vector_files_by_property(
-        js_paths,
+        tile_features,
         'map_id',
         ['Polygon', 'MultiPolygon'],
         output_path,
-        **bounds
+        **bounds,
+        num_workers=num_workers,
+        streaming=streaming,
+        output_format=output_format,
+        seam_zoom_level=seam_zooms
     )
 
 
+async def macrostrat_from_bounds_async(bounds, output_path, zoom_level=10, cache_path=None, aoi=None, num_workers=1, streaming=False, output_format=None, precision=None, max_tiles=None, progress=None, max_workers=8, max_pending=64):
+    """
+    Asynchronous version of :func:`macrostrat_from_bounds` that downloads and
+    decodes tiles as one overlapping pipeline and reports each tile as soon
+    as it is decoded, so callers (e.g. a QGIS task) can show progress and
+    partial results without blocking the event loop.
+
+    Parameters
+    ----------
+    bounds : dict
+        Lat/lon bounds with keys ``n``, ``s``, ``e``, ``w``
+    output_path : str
+        File path for the output file. A ``.parquet`` or ``.fgb`` extension
+        writes GeoParquet or FlatGeobuf instead of GeoJSON.
+    zoom_level : int, optional
+        Vector tile server zoom level (higher = more zoomed in). With
+        ``precision``, the finest zoom level used.
+    cache_path : str or Path, optional
+        SQLite tile cache to read tiles from and add downloaded tiles to
+    aoi : shapely.Geometry, optional
+        Area of interest in lat/lon; only tiles intersecting it are downloaded
+    num_workers : int, optional
+        Number of processes used to dissolve the features
+    streaming : bool, optional
+        Dissolve with bounded memory: each tile's features are spilled to a
+        temporary file as soon as the tile is decoded instead of being
+        collected in memory
+    output_format : str, optional
+        ``'GeoJSON'``, ``'GeoParquet'`` or ``'FlatGeobuf'``, overriding the
+        format implied by the extension of ``output_path``
+    precision : float, optional
+        Target georegistration precision in metres; see
+        :func:`macrostrat_from_bounds`
+    max_tiles : int, optional
+        With ``precision``, the tile budget
+    progress : callable, optional
+        Called as ``progress(done, total, tile_index, features)`` after each
+        tile is decoded, where ``features`` is the tile's ``units`` GeoJSON
+        or ``None`` if the tile is empty
+    max_workers : int, optional
+        Maximum number of tile requests in flight at once
+    max_pending : int, optional
+        Maximum number of downloaded tiles waiting to be decoded
+    """
+    tile_indices = _macrostrat_tiles(bounds, zoom_level, aoi, precision, max_tiles)
+    cache = TileCache(cache_path) if cache_path else None
+    spill = FeatureSpill('map_id') if streaming else None
+
+    tile_features = []
+    seam_zooms = []
+    done = 0
+    try:
+        tiles = iter_decoded_tiles(
+            tile_indices, "https://dev.macrostrat.org/tiles/", "carto", ["units"], 4096,
+            max_workers=max_workers, max_pending=max_pending, cache=cache
+        )
+        async for tile_index, layers in tiles:
+            features = layers.get("units")
+            if features is not None and spill is not None:
+                _spill_tile(spill, features, tile_index[0])
+            elif features is not None:
+                tile_features.append(features)
+                seam_zooms.append(tile_index[0])
+            done += 1
+            if progress is not None:
+                progress(done, len(tile_indices), tile_index, features)
+        if cache is not None:
+            print(f"Tile cache: {cache.stats()}")
+    except BaseException:
+        if spill is not None:
+            spill.close()
+        raise
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # The dissolve is CPU bound; run it off the event loop
+    loop = asyncio.get_running_loop()
+    if spill is not None:
+        # The spill is closed by the dissolve itself, so that it outlives
+        # the executor job even if this coroutine is cancelled
+        await loop.run_in_executor(None, functools.partial(
+            _dissolve_spill, spill, output_path, bounds, output_format
+        ))
+        return
+    await loop.run_in_executor(None, functools.partial(
+        dissolve_vector_files_by_property,
+        tile_features,
+        'map_id',
+        ['Polygon', 'MultiPolygon'],
+        output_path,
+        **bounds,
+        num_workers=num_workers,
+        streaming=streaming,
+        output_format=output_format,
+        seam_zoom_level=seam_zooms
+    ))
+
+
 if __name__ == "__main__":
     fp = "/home/efvega/Downloads/focus_areas_MagmaticNiCo.shp"
 
@@ -0,0 +1,323 @@
+import os
+import uuid
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+# GDAL data type names of the numpy dtypes a data cube band can have
+GDAL_DATA_TYPES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+# Raster tag recording whether a data raster is still the placeholder
+# template ("YES") or has had layers added to it ("NO")
+PLACEHOLDER_TAG = 'STATMAGIC_PLACEHOLDER'
+
+
+def is_placeholder_data_raster(data_raster_filepath):
+    """
+    Whether a data raster is still the placeholder made from the template,
+    so the first layers added should replace its band rather than follow it.
+
+    The state is read from the :data:`PLACEHOLDER_TAG` raster tag. Data
+    rasters written before the tag existed fall back to checking that every
+    valid pixel of band 1 equals 1, which needs a full read of the band.
+
+    Parameters
+    ----------
+    data_raster_filepath : str
+        Path to the data raster (GeoTIFF or data cube)
+
+    Returns
+    -------
+    placeholder : bool
+    """
+    with rio.open(data_raster_filepath) as data_raster:
+        tag = data_raster.tags().get(PLACEHOLDER_TAG)
+        if tag is not None:
+            return tag == 'YES'
+
+        logger.debug(f'{data_raster_filepath} has no {PLACEHOLDER_TAG} tag, scanning band 1')
+        nodata = data_raster.nodata
+        tarr = data_raster.read(1)
+    arr = np.where(tarr == nodata, np.nan, tarr)
+    arr = arr[~np.isnan(arr)]
+    return bool(np.all(arr == 1))
+
+
+def is_data_cube(data_raster_filepath):
+    """ Whether a data raster is stored as an appendable data cube (a ``.vrt``). """
+    return Path(data_raster_filepath).suffix.lower() == '.vrt'
+
+
+def band_directory(cube_path):
+    """ Directory holding the per-band files of a data cube, next to its VRT. """
+    cube_path = Path(cube_path)
+    return cube_path.with_name(f"{cube_path.stem}_bands")
+
+
+def read_cube_bands(cube_path):
+    """
+    Lists the bands of a data cube.
+
+    Parameters
+    ----------
+    cube_path : str or Path
+        Path to the data cube VRT
+
+    Returns
+    -------
+    bands : list
+        ``(source file, description)`` tuples in band order, with source
+        files as absolute paths
+    """
+    cube_path = Path(cube_path)
+    root = ET.parse(cube_path).getroot()
+    bands = []
+    for band in root.iter('VRTRasterBand'):
+        source = band.find('SimpleSource/SourceFilename')
+        filename = Path(source.text)
+        if source.get('relativeToVRT') == '1':
+            filename = cube_path.parent / filename
+        description = band.findtext('Description')
+        bands.append((str(filename), description))
+    return bands
+
+
+def write_cube_vrt(cube_path, profile, bands, placeholder=False):
+    """
+    Writes the VRT of a data cube. Only the small XML file is written; the
+    band files themselves are left untouched.
+
+    Parameters
+    ----------
+    cube_path : str or Path
+        Path to the data cube VRT
+    profile : dict
+        rasterio profile of the cube grid (``width``, ``height``, ``crs``,
+        ``transform``, ``nodata``, ``dtype``)
+    bands : list
+        ``(source file, description)`` tuples in band order
+    placeholder : bool, optional
+        Value of the :data:`PLACEHOLDER_TAG` tag of the cube
+    """
+    cube_path = Path(cube_path)
+    root = ET.Element('VRTDataset', rasterXSize=str(profile['width']), rasterYSize=str(profile['height']))
+    metadata = ET.SubElement(root, 'Metadata')
+    ET.SubElement(metadata, 'MDI', key=PLACEHOLDER_TAG).text = 'YES' if placeholder else 'NO'
+    if profile.get('crs'):
+        ET.SubElement(root, 'SRS').text = profile['crs'].to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(
+        repr(float(x)) for x in profile['transform'].to_gdal()
+    )
+
+    data_type = GDAL_DATA_TYPES[np.dtype(profile['dtype']).name]
+    for index, (filename, description) in enumerate(bands, 1):
+        band = ET.SubElement(root, 'VRTRasterBand', dataType=data_type, band=str(index))
+        if description is not None:
+            ET.SubElement(band, 'Description').text = description
+        if profile.get('nodata') is not None:
+            ET.SubElement(band, 'NoDataValue').text = repr(float(profile['nodata']))
+        source = ET.SubElement(band, 'SimpleSource')
+        ET.SubElement(source, 'SourceFilename', relativeToVRT='1').text = \
+            Path(os.path.relpath(filename, cube_path.parent)).as_posix()
+        ET.SubElement(source, 'SourceBand').text = '1'
+
+    ET.indent(root)
+    tmp_path = cube_path.with_suffix('.vrt.tmp')
+    ET.ElementTree(root).write(tmp_path, encoding='unicode')
+    os.replace(tmp_path, cube_path)
+
+
+def new_band_file(cube_path, profile):
+    """
+    Picks a new file name in a data cube's band directory.
+
+    Parameters
+    ----------
+    cube_path : str or Path
+        Path to the data cube VRT
+    profile : dict
+        rasterio profile of the cube
+
+    Returns
+    -------
+    filename : Path
+        Path of the new band file
+    band_profile : dict
+        Profile to create it with: a single-band, tiled, compressed GeoTIFF
+        on the cube grid
+    """
+    directory = band_directory(cube_path)
+    directory.mkdir(parents=True, exist_ok=True)
+    band_profile = profile.copy()
+    band_profile.update(driver='GTiff', count=1, tiled=True, blockxsize=256, blockysize=256,
+                        compress='deflate')
+    return directory / f"{uuid.uuid4().hex}.tif", band_profile
+
+
+def _write_band_files(cube_path, profile, arrays, descriptions):
+    """ Writes each band of ``arrays`` to its own tiled GeoTIFF in the cube's band directory. """
+    bands = []
+    for array, description in zip(arrays, descriptions):
+        filename, band_profile = new_band_file(cube_path, profile)
+        with rio.open(filename, 'w', **band_profile) as dst:
+            dst.write(array, 1)
+            dst.set_band_description(1, description)
+        bands.append((str(filename), description))
+    return bands
+
+
+def create_data_cube(template_path, cube_path):
+    """
+    Creates an appendable data cube whose only band is the template raster,
+    the same placeholder state as a freshly made GeoTIFF data raster.
+
+    Parameters
+    ----------
+    template_path : str
+        Path to the template raster
+    cube_path : str
+        Path of the data cube VRT to create
+    """
+    with rio.open(template_path) as template:
+        profile = template.profile
+    write_cube_vrt(cube_path, profile, [(str(Path(template_path).resolve()), None)], placeholder=True)
+
+
+def append_bands_to_data_cube(cube_path, arrays, descriptions, replace=False):
+    """
+    Adds bands to a data cube. Only the new bands are written, each to its
+    own file, and the VRT listing the bands is updated, so the cost does not
+    grow with the size of the cube.
+
+    Parameters
+    ----------
+    cube_path : str
+        Path to the data cube VRT
+    arrays : ndarray
+        Bands to add, shaped ``(bands, rows, cols)``
+    descriptions : list
+        Description of each new band
+    replace : bool, optional
+        Replace the existing bands (e.g. the template placeholder) instead of
+        appending to them
+    """
+    with rio.open(cube_path) as cube:
+        profile = cube.profile
+    append_band_files_to_data_cube(
+        cube_path, _write_band_files(cube_path, profile, arrays, descriptions), replace=replace
+    )
+
+
+def append_band_files_to_data_cube(cube_path, bands, replace=False):
+    """
+    Adds already written band files (see :func:`new_band_file`) to a data
+    cube.
+
+    Parameters
+    ----------
+    cube_path : str
+        Path to the data cube VRT
+    bands : list
+        ``(band file, description)`` tuples of the new bands
+    replace : bool, optional
+        Replace the existing bands instead of appending to them
+    """
+    with rio.open(cube_path) as cube:
+        profile = cube.profile
+    existing = [] if replace else read_cube_bands(cube_path)
+    write_cube_vrt(cube_path, profile, existing + list(bands))
+
+
+def drop_bands_from_data_cube(cube_path, drop_idxs):
+    """
+    Removes bands from a data cube by rewriting only its band list. The band
+    files are left in place until :func:`compact_data_cube` is run.
+
+    Parameters
+    ----------
+    cube_path : str
+        Path to the data cube VRT
+    drop_idxs : list
+        Zero-based indexes of the bands to remove
+    """
+    with rio.open(cube_path) as cube:
+        profile = cube.profile
+    drop_set = set(drop_idxs)
+    bands = [band for index, band in enumerate(read_cube_bands(cube_path)) if index not in drop_set]
+    write_cube_vrt(cube_path, profile, bands)
+
+
+def compact_data_cube(cube_path):
+    """
+    Deletes the band files of a data cube that are no longer listed in it,
+    e.g. after bands were dropped.
+
+    Band files are written before the VRT is updated to list them, so files
+    at least as new as the VRT are left alone: they may belong to bands
+    still being added. This makes it safe to run while a single writer adds
+    or drops bands, such as in the background or when a project is closed;
+    files left over by an interrupted addition are removed once the VRT has
+    been written again.
+
+    Parameters
+    ----------
+    cube_path : str
+        Path to the data cube VRT
+
+    Returns
+    -------
+    removed : list
+        Paths of the deleted files
+    """
+    directory = band_directory(cube_path)
+    if not directory.exists():
+        return []
+    # Taken before the band list, so a VRT written in between can only make
+    # this more cautious
+    cube_mtime = os.stat(cube_path).st_mtime_ns
+    listed = {Path(filename).resolve() for filename, _ in read_cube_bands(cube_path)}
+    removed = []
+    for filename in directory.glob("*.tif"):
+        if filename.resolve() in listed or filename.stat().st_mtime_ns >= cube_mtime:
+            continue
+        filename.unlink()
+        removed.append(str(filename))
+    logger.debug(f"Removed {len(removed)} unused band files from {directory}")
+    return removed
+
+
+def export_data_cube(cube_path, output_path):
+    """
+    Writes a data cube out as a single multi-band GeoTIFF, one band at a
+    time.
+
+    Parameters
+    ----------
+    cube_path : str
+        Path to the data cube VRT
+    output_path : str
+        Path of the GeoTIFF to write
+    """
+    with rio.open(cube_path) as cube:
+        profile = cube.profile
+        profile.update(driver='GTiff', tiled=True, blockxsize=256, blockysize=256)
+        with rio.open(output_path, 'w', **profile) as dst:
+            for index in range(1, cube.count + 1):
+                dst.write(cube.read(index), index)
+                dst.set_band_description(index, cube.descriptions[index - 1])
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+import requests
+from rasterio.enums import Resampling
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+def _remote_fingerprint(url, timeout=30):
+    """
+    Version of a remote raster from the validators of a HEAD request: its
+    ETag, Last-Modified and Content-Length headers.
+    """
+    http_url = url[len('/vsicurl/'):] if url.startswith('/vsicurl/') else url
+    try:
+        response = requests.head(http_url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # Offline, cached layers can only be found by their URL
+        logger.warning(f"Could not check {url} for changes, keying it by its URL alone: {e}")
+        return [url]
+    headers = response.headers
+    return [url, headers.get('ETag'), headers.get('Last-Modified'), headers.get('Content-Length')]
+
+
+def input_fingerprint(input_path, hash_contents=False):
+    """
+    Identifies the contents of an input raster for use in a cache key.
+
+    Parameters
+    ----------
+    input_path : str or Path
+        Local path or URL of the raster
+    hash_contents : bool, optional
+        Hash the file contents instead of trusting its modification time and
+        size. Slower, but survives files being copied or touched.
+
+    Returns
+    -------
+    fingerprint : list
+        The absolute path with the file's mtime and size (or content hash)
+        for local files; for http(s) URLs, the URL with the ETag,
+        Last-Modified and Content-Length the server reports for it, so that
+        a file replaced at the same URL gets a new key; the path or URL
+        itself otherwise
+    """
+    if not os.path.exists(input_path):
+        url = str(input_path)
+        if url.startswith(('http://', 'https://', '/vsicurl/')):
+            return _remote_fingerprint(url)
+        return [url]
+
+    path = os.path.abspath(input_path)
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return [path, digest.hexdigest()]
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+class LayerCache:
+    """
+    Persistent, content-addressed cache of layers matched to a template.
+
+    Each entry is one matched layer stored as a compressed, tiled GeoTIFF on
+    the template grid. Entries are keyed by a hash of the input raster
+    (see :func:`input_fingerprint`), the band, the resampling method, the
+    template grid and nodata mask and the data type, so re-running a stack against the same
+    template and inputs reads the layers back instead of reprojecting them.
+    An SQLite index in the same directory tracks sizes and access times for
+    least recently used eviction.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory holding the cached layers. Created if it does not exist.
+    max_bytes : int, optional
+        Size cap for the cached files. When exceeded, the least recently used
+        layers are evicted. Unlimited by default.
+    hash_contents : bool, optional
+        Key local inputs by a hash of their contents rather than their
+        modification time and size
+
+    Attributes
+    ----------
+    hits : int
+        Number of layers read from the cache
+    misses : int
+        Number of layers that had to be matched
+    """
+
+    def __init__(self, directory, max_bytes=None, hash_contents=False):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.directory / "layers.sqlite"), check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS layers (
+                key TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+            Hit/miss counters and the number and size of cached layers
+        """
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM layers"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "layers": count, "bytes": size}
+
+    def key(self, input_path, band, resampling_method, session, dtype='float64'):
+        """
+        Cache key of one matched layer.
+
+        Parameters
+        ----------
+        input_path : str
+            Local path or URL of the input raster
+        band : int or str
+            Zero-based band index, or ``"all"``
+        resampling_method : rasterio.enums.Resampling, str or int
+            Resampling method
+        session : statmagic_backend.dev.match_stack_raster_tools.StackingSession
+            Template the layer is matched to
+        dtype : str, optional
+            Data type the layer is matched in, so that callers matching in
+            different precisions do not read each other's layers
+
+        Returns
+        -------
+        key : str
+        """
+        # The same method given by name or by code shares its layers
+        method = resampling_method if isinstance(resampling_method, str) else Resampling(resampling_method).name
+        parts = [input_fingerprint(input_path, self.hash_contents), band, method, session.grid_key(),
+                 np.dtype(dtype).name]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.tif"
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        array : ndarray or None
+            The cached layer, or ``None`` if it is not cached
+        """
+        path = self._path(key)
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM layers WHERE key=?", (key,)).fetchone()
+            if row is None or not path.exists():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE layers SET accessed=? WHERE key=?", (time.time(), key))
+            self._conn.commit()
+        with rio.open(path) as src:
+            return src.read()
+
+    def put(self, key, array, session):
+        """
+        Stores a matched layer, then evicts least recently used layers if the
+        cache is over ``max_bytes``.
+
+        Parameters
+        ----------
+        key : str
+            Key from :meth:`key`
+        array : ndarray
+            Matched layer of shape ``(bands, template height, template width)``
+        session : statmagic_backend.dev.match_stack_raster_tools.StackingSession
+            Template the layer was matched to
+        """
+        path = self._path(key)
+        profile = session.profile.copy()
+        profile.update(driver='GTiff', count=array.shape[0], dtype=array.dtype.name,
+                       tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate', predictor=3 if array.dtype.kind == 'f' else 2)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with rio.open(tmp_path, 'w', **profile) as dst:
+            dst.write(array)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO layers VALUES (?, ?, ?)",
+                (key, path.stat().st_size, time.time())
+            )
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """ Removes least recently used layers until under ``max_bytes``. """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM layers").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            evict_keys = []
+            for key, size in self._conn.execute("SELECT key, bytes FROM layers ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                evict_keys.append((key,))
+                total -= size
+                self._path(key).unlink(missing_ok=True)
+            self._conn.executemany("DELETE FROM layers WHERE key=?", evict_keys)
+            self._conn.commit()
+        logger.debug(f"Evicted {len(evict_keys)} layers from {self.directory}")
@@ -1,21 +1,437 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import weakref
+
 import rasterio as rio
 import numpy as np
-from rasterio.warp import reproject
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from rasterio import windows
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
 from pathlib import Path
 from sklearn.preprocessing import StandardScaler
 import rioxarray
 import concurrent.futures
+from multiprocessing import shared_memory
+
+from statmagic_backend.dev.data_cube import (
+    PLACEHOLDER_TAG, append_band_files_to_data_cube, append_bands_to_data_cube, drop_bands_from_data_cube,
+    is_data_cube, is_placeholder_data_raster, new_band_file
+)
 
 import logging
 logger = logging.getLogger("statmagic_backend")
 
 
-def match_raster_to_template(template_path, input_raster_path, resampling_method, band, num_threads=1):
+def iter_template_windows(height, width, block_size=1024):
+    """
+    Splits a raster grid into square, grid-aligned blocks.
+
+    Parameters
+    ----------
+    height : int
+        Number of rows of the grid
+    width : int
+        Number of columns of the grid
+    block_size : int, optional
+        Edge length of the blocks in pixels. Blocks on the right and bottom
+        edges are cut to the grid.
+
+    Yields
+    ------
+    window : rasterio.windows.Window
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off,
+                         min(block_size, width - col_off),
+                         min(block_size, height - row_off))
+
+
+def _resampling(resampling_method):
+    """
+    Converts a resampling method given by name (``'bilinear'``), by GDAL
+    code (``1``) or as a :class:`~rasterio.enums.Resampling` to the latter.
+    ``None`` is passed through.
+    """
+    if resampling_method is None:
+        return None
+    if isinstance(resampling_method, str):
+        return Resampling[resampling_method]
+    return Resampling(resampling_method)
+
+
+# Radius in source pixels of GDAL's resampling kernels. When downsampling,
+# GDAL widens the kernels by the resolution ratio; methods missing here
+# (average, mode and the other aggregates) cover one template cell.
+KERNEL_RADIUS = {
+    Resampling.nearest: 1,
+    Resampling.bilinear: 1,
+    Resampling.cubic: 2,
+    Resampling.cubic_spline: 2,
+    Resampling.lanczos: 3,
+}
+
+
+def _source_padding(resampling_method, ratio):
+    """
+    Source pixels to pad the source window of a block by, so the block sees
+    every source pixel its resampling kernel reaches when resampling to
+    cells ``ratio`` times coarser than the source pixels.
+    """
+    resampling_method = _resampling(resampling_method)
+    radius = KERNEL_RADIUS.get(resampling_method, 1)
+    # A few extra pixels allow for GDAL's approximate transformer
+    return math.ceil(radius * max(ratio, 1)) + 4
+
+
+def _source_window(in_raster, dst_crs, dst_bounds, padding=4):
+    """
+    Window of ``in_raster`` covering ``dst_bounds`` (given in ``dst_crs``),
+    padded by ``padding`` source pixels for the resampling kernel (see
+    :func:`_source_padding`) and cut to the raster. Returns ``None`` if the
+    bounds miss the raster.
+    """
+    src_bounds = transform_bounds(dst_crs, in_raster.crs, *dst_bounds)
+    window = from_bounds(*src_bounds, transform=in_raster.transform)
+    col_off = max(math.floor(window.col_off) - padding, 0)
+    row_off = max(math.floor(window.row_off) - padding, 0)
+    col_end = min(math.ceil(window.col_off + window.width) + padding, in_raster.width)
+    row_end = min(math.ceil(window.row_off + window.height) + padding, in_raster.height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+# Resampling methods that aggregate the source pixels under each template
+# cell, for which reading a coarser overview built with the same method gives
+# nearly the same result as reading the full resolution
+OVERVIEW_RESAMPLING = {
+    Resampling.average, Resampling.mode, Resampling.max, Resampling.min,
+    Resampling.med, Resampling.q1, Resampling.q3, Resampling.rms,
+}
+
+
+def _resolution_ratio(src, session):
+    """ How many times coarser the template cells are than the pixels of ``src``. """
+    crs = src.crs or CRS.from_epsg(4326)
+    left, bottom, right, top = transform_bounds(crs, session.crs, *src.bounds)
+    src_res = min((right - left) / src.width, (top - bottom) / src.height)
+    dst_res = min(abs(session.transform.a), abs(session.transform.e))
+    return dst_res / src_res
+
+
+def select_overview_level(src, session, resampling_method=None):
+    """
+    Picks the coarsest overview of a raster that is still at least as fine
+    as the template grid.
+
+    Parameters
+    ----------
+    src : rasterio.io.DatasetReader
+        Open input raster
+    session : StackingSession
+        Template the raster is matched to
+    resampling_method : rasterio.enums.Resampling, str or int, optional
+        Resampling method the raster will be matched with. If given, an
+        overview is only picked for methods in :data:`OVERVIEW_RESAMPLING`,
+        and only if the overview was built with the same method (untagged
+        overviews, e.g. those of most COGs, are only trusted for
+        ``average``).
+
+    Returns
+    -------
+    overview_level : int or None
+        Zero-based overview level to open the raster at, or ``None`` to read
+        the full resolution
+    """
+    resampling_method = _resampling(resampling_method)
+    if resampling_method is not None and resampling_method not in OVERVIEW_RESAMPLING:
+        return None
+    factors = src.overviews(1)
+    if not factors:
+        return None
+    ratio = _resolution_ratio(src, session)
+
+    level = None
+    for i, factor in enumerate(factors):
+        if factor <= ratio:
+            level = i
+    if level is None or resampling_method is None:
+        return level
+
+    with rio.open(src.name, overview_level=level) as overview:
+        built_with = overview.tags(1).get('RESAMPLING', 'AVERAGE').lower()
+    if built_with != resampling_method.name:
+        logger.debug(f'{src.name}: overviews were built with {built_with}, not {resampling_method.name}')
+        return None
+    return level
+
+
+def build_overviews(input_raster_path, resampling_method, factors=None, min_size=256):
+    """
+    Builds overviews of a raster once, so matching it to coarse templates
+    can read them instead of the full resolution. They are written to an
+    external ``.ovr`` file next to the raster, which is left untouched, and
+    are tagged with ``resampling_method`` so they are only used for that
+    method (see :func:`select_overview_level`).
+
+    Parameters
+    ----------
+    input_raster_path : str
+        Path to a local raster
+    resampling_method : rasterio.enums.Resampling, str or int
+        Resampling method to build the overviews with
+    factors : list, optional
+        Decimation factors of the overviews to build. By default overviews
+        are halved in size until their shorter side is below ``min_size``.
+    min_size : int, optional
+        Smallest overview size built by default
+
+    Returns
+    -------
+    factors : list
+        Decimation factors of the overviews built
+    """
+    resampling_method = _resampling(resampling_method)
+    with rio.Env(TIFF_USE_OVR=True), rio.open(input_raster_path, 'r+') as src:
+        if factors is None:
+            factors = []
+            factor = 2
+            while min(src.height, src.width) // factor >= min_size:
+                factors.append(factor)
+                factor *= 2
+        if factors:
+            src.build_overviews(factors, resampling_method)
+    logger.debug(f'built {resampling_method.name} overviews {factors} of {input_raster_path}')
+    return factors
+
+
+class StackingSession:
+    """
+    Template raster prepared once for matching a whole stack of layers to it.
+
+    The template's grid (crs, transform, shape) and nodata mask are read a
+    single time when the session is created, instead of once per layer.
+    The mask is held bit-packed (one bit per pixel, 1/64th the size of the
+    template as float64), is built from the template in row strips, and is
+    unpacked only for the rows (or block) being masked.
+
+    Parameters
+    ----------
+    template_path : str
+        Path to the template raster
+    block_size : int, optional
+        Number of template rows read at a time while building the mask
+    mask_band : int, optional
+        Band (1-based) of the template the nodata mask is taken from. By
+        default a pixel is masked if it is nodata in any band.
+
+    Attributes
+    ----------
+    crs, transform, nodata, height, width, profile
+        Properties of the template raster
+    """
+
+    def __init__(self, template_path, block_size=1024, mask_band=None):
+        self.template_path = template_path
+        self.mask_band = mask_band
+        with rio.open(template_path) as base_raster:
+            self.crs = base_raster.crs
+            self.transform = base_raster.transform
+            self.nodata = base_raster.nodata
+            self.height, self.width = base_raster.shape
+            self.profile = base_raster.profile
+            self._packed_mask = self._read_mask(base_raster, block_size)
+
+    def _read_mask(self, base_raster, block_size):
+        if self.nodata is None:
+            return None
+        packed = np.empty((self.height, (self.width + 7) // 8), dtype='uint8')
+        for row_off in range(0, self.height, block_size):
+            window = Window(0, row_off, self.width, min(block_size, self.height - row_off))
+            template_block = base_raster.read(self.mask_band or None, window=window)
+            if template_block.ndim == 2:
+                template_block = template_block[np.newaxis]
+            if np.isnan(self.nodata):
+                is_nodata = np.isnan(template_block)
+            else:
+                is_nodata = template_block == self.nodata
+            packed[row_off:row_off + window.height] = np.packbits(is_nodata.any(axis=0), axis=-1)
+        return packed
+
+    def grid_key(self):
+        """
+        Returns
+        -------
+        key : str
+            Hash of the template grid (crs, transform, shape) and nodata mask,
+            identifying what layers matched to this template depend on
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.crs.to_wkt() if self.crs else None, list(self.transform)[:6],
+                                  [self.height, self.width], self.nodata]).encode())
+        if self._packed_mask is not None:
+            digest.update(self._packed_mask.tobytes())
+        return digest.hexdigest()
+
+    def mask(self, window=None):
+        """
+        Template nodata mask.
+
+        Parameters
+        ----------
+        window : rasterio.windows.Window, optional
+            Part of the template grid to return the mask of
+
+        Returns
+        -------
+        mask : ndarray or None
+            Boolean array, True where the template is nodata, or ``None`` if
+            the template has no nodata value
+        """
+        if self._packed_mask is None:
+            return None
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        rows = self._packed_mask[window.row_off:window.row_off + window.height]
+        mask = np.unpackbits(rows, axis=-1, count=self.width)
+        return mask[:, window.col_off:window.col_off + window.width].view(bool)
+
+    def apply_mask(self, array, window=None):
+        """ Sets ``array`` (bands, rows, cols) to nodata outside the template, in place. """
+        mask = self.mask(window)
+        if mask is not None:
+            np.copyto(array, self.nodata, where=mask)
+        return array
+
+    def _open_input(self, input_raster_path, resampling_method, use_overviews=True, make_overviews=False):
+        """
+        Opens an input raster, at the overview level suited to the template
+        if it has one (see :func:`select_overview_level`). With
+        ``make_overviews``, overviews down to the template's resolution are
+        first built for rasters that have none.
+        """
+        in_raster = rio.open(input_raster_path)
+        if not use_overviews:
+            return in_raster
+        resampling_method = _resampling(resampling_method)
+
+        if make_overviews and resampling_method in OVERVIEW_RESAMPLING and not in_raster.overviews(1):
+            # Powers of two up to the template's resolution
+            ratio = _resolution_ratio(in_raster, self)
+            factors = [2 ** i for i in range(1, int(math.log2(ratio)) + 1)] if ratio >= 2 else []
+            if factors:
+                in_raster.close()
+                build_overviews(input_raster_path, resampling_method, factors)
+                in_raster = rio.open(input_raster_path)
+
+        level = select_overview_level(in_raster, self, resampling_method)
+        if level is None:
+            return in_raster
+        in_raster.close()
+        logger.debug(f'reading {input_raster_path} at overview level {level}')
+        return rio.open(input_raster_path, overview_level=level)
+
+    def _match_windowed(self, in_raster, resampling_method, indexes, num_threads, block_size, out,
+                        out_indexes=None, dtype='float64'):
+        """
+        Reprojects bands ``indexes`` (1-based) of ``in_raster`` onto the
+        template grid one block at a time, in ``dtype``, writing each masked
+        block to ``out``: an array, or bands ``out_indexes`` of an open
+        rasterio dataset in write mode.
+        """
+        fill = self.nodata if self.nodata is not None else 0
+        padding = _source_padding(resampling_method, _resolution_ratio(in_raster, self))
+
+        for window in iter_template_windows(self.height, self.width, block_size):
+            block = np.full((len(indexes), window.height, window.width), fill, dtype=dtype)
+            dst_transform = windows.transform(window, self.transform)
+
+            src_window = _source_window(in_raster, self.crs, windows.bounds(window, self.transform), padding)
+            if src_window is not None:
+                reproject(in_raster.read(indexes, window=src_window), block,
+                          src_transform=in_raster.window_transform(src_window), dst_transform=dst_transform,
+                          src_crs=in_raster.crs, dst_crs=self.crs,
+                          src_nodata=in_raster.nodata, dst_nodata=self.nodata,
+                          resampling=resampling_method, num_threads=num_threads)
+            self.apply_mask(block, window)
+
+            if isinstance(out, rio.io.DatasetWriter):
+                out.write(block.astype(out.dtypes[0]), indexes=out_indexes, window=window)
+            else:
+                out[:, window.row_off:window.row_off + window.height,
+                    window.col_off:window.col_off + window.width] = block
+
+    def match(self, input_raster_path, resampling_method, band, num_threads=1,
+              block_size=None, out=None, output_path=None, use_overviews=True, make_overviews=False):
+        """
+        Reprojects an input raster onto the template grid and masks it with
+        the template nodata mask. See :func:`match_raster_to_template` for
+        the parameters.
+        """
+        in_raster = self._open_input(input_raster_path, resampling_method, use_overviews, make_overviews)
+        logger.debug(f'read {input_raster_path}')
+        logger.debug(f"count: {in_raster.count}")
+
+        with in_raster:
+            if block_size is not None or out is not None or output_path is not None:
+                block_size = block_size or 1024
+                indexes = list(range(1, in_raster.count + 1)) if band == "all" else [band + 1]
+                count = len(indexes)
+                if output_path is not None:
+                    profile = self.profile.copy()
+                    profile.update(driver='GTiff', dtype='float64', tiled=True,
+                                   blockxsize=256, blockysize=256, count=count)
+                    with rio.open(output_path, 'w', **profile) as dst:
+                        self._match_windowed(in_raster, resampling_method, indexes, num_threads, block_size, dst)
+                    return output_path
+
+                if out is None:
+                    out = np.empty((count, self.height, self.width))
+                self._match_windowed(in_raster, resampling_method, indexes, num_threads, block_size, out)
+                return out
+
+            if band == "all":
+                logger.debug('reading full')
+                in_array = in_raster.read()
+            else:
+                logger.debug(f'reading band {band}')
+                in_array = np.expand_dims(in_raster.read(band+1), 0)
+            logger.debug(f'shape: {in_array.shape}')
+
+            # Create an array in the shape of the template to reproject into and execute reprojections
+            new_ds = np.empty(shape=(in_array.shape[0], self.height, self.width))
+
+            reproj_arr = reproject(in_array, new_ds,
+                                   src_transform=in_raster.transform, dst_transform=self.transform,
+                                   src_crs=in_raster.crs, dst_crs=self.crs,
+                                   src_nodata=in_raster.nodata, dst_nodata=self.nodata,
+                                   resampling=resampling_method, num_threads=num_threads)[0]
+        return self.apply_mask(reproj_arr)
+
+
+def match_raster_to_template(template_path, input_raster_path, resampling_method, band, num_threads=1,
+                             block_size=None, out=None, output_path=None, use_overviews=True,
+                             make_overviews=False):
     """
     Clip and reproject an input raster to another rasters extent, crs,
     and affine transform. There could still be some room to add in some subtle
     shifts to better match pixel edges.
 
+    By default both rasters are read whole. Giving ``block_size``, ``out``
+    or ``output_path`` instead reprojects one template-aligned block at a
+    time, reading only the part of the input each block needs, so memory
+    use stays flat however large the rasters are.
+
+    To match several rasters to the same template, use a
+    :class:`StackingSession` so the template is only read once.
+
     Parameters
     ----------
     template_path : str
@@ -32,50 +448,257 @@ def match_raster_to_template(template_path, input_raster_path, resampling_method
                 'nearest', 'bilinear', 'cubic', 'cubic_spline',
                 'lanczos', 'average', 'mode', 'gauss'
             ]
+    band : int or str
+        Zero-based index of the band to match, or ``"all"``
     num_threads : int
         Number of threads to utilize for the resampling
+    block_size : int, optional
+        Edge length in template pixels of the blocks reprojected at a time.
+        Defaults to 1024 when ``out`` or ``output_path`` is given.
+    out : ndarray, optional
+        Array of shape ``(bands, template height, template width)`` to write
+        the blocks into, e.g. a ``np.memmap``
+    output_path : str, optional
+        GeoTIFF to stream the blocks to, on the template grid
+    use_overviews : bool, optional
+        When the template is coarser than the input and the resampling
+        method aggregates pixels (see :data:`OVERVIEW_RESAMPLING`), read the
+        input from its nearest overview built with the same method instead
+        of its full resolution
+    make_overviews : bool, optional
+        Build overviews of an input that has none first (see
+        :func:`build_overviews`), so this and later matches can read them
 
     Returns
     -------
-    reproj_arr : ndarray
-        Array representing the dimensions of the template raster
+    reproj_arr : ndarray or str
+        Array representing the dimensions of the template raster; ``out``
+        if given, or ``output_path`` when writing to file
 
     """
+    session = StackingSession(template_path)
+    return session.match(input_raster_path, resampling_method, band, num_threads=num_threads,
+                         block_size=block_size, out=out, output_path=output_path,
+                         use_overviews=use_overviews, make_overviews=make_overviews)
 
-    # Establish properties from the template/base raster
-    base_raster = rio.open(template_path)
-    base_crs = base_raster.crs
-    base_nodata = base_raster.nodata
-    base_shape = base_raster.shape
-    base_transform = base_raster.transform
-    template_array = base_raster.read()
 
-    in_raster = rio.open(input_raster_path)
-    logger.debug(f'read {input_raster_path}')
-    logger.debug(f"count: {in_raster.count}")
+class VirtualStack:
+    """
+    Lazy stack of layers matched to a template.
 
-    if band == "all":
-        logger.debug('reading full')
-        in_array = in_raster.read()
-    else:
-        logger.debug(f'reading band {band}')
-        in_array = np.expand_dims(in_raster.read(band+1), 0)
-    logger.debug(f'shape: {in_array.shape}')
+    Each layer is a :class:`rasterio.vrt.WarpedVRT` of its source on the
+    template grid, so nothing is read or warped until a window of the stack
+    is read; then only the source pixels under that window are. Reading the
+    stack block by block (e.g. for clustering or prediction) needs memory
+    for one window of all layers instead of the whole ``N x H x W`` cube.
+    Inputs with overviews suited to the template and resampling method are
+    warped from those (see :func:`select_overview_level`).
+
+    Parameters
+    ----------
+    template_path : str or StackingSession
+        Path to the template raster, or a session already made for it
+    input_raster_paths_list : list
+        List of file paths (str) to input rasters
+    resampling_method_list : list
+        Resampling method to apply to each input
+    band_id_list : list
+        Zero-based band index, or ``"all"``, for each input raster
+    dtype : str, optional
+        Data type of the arrays read from the stack
 
-    # Create an array in the shape of the template to reproject into and execute reprojections
-    new_ds = np.empty(shape=(in_array.shape[0], base_shape[0], base_shape[1]))
+    Attributes
+    ----------
+    count : int
+        Number of bands in the stack
+    shape : tuple
+        ``(count, template height, template width)``
+    """
 
-    reproj_arr = reproject(in_array, new_ds,
-                           src_transform=in_raster.transform, dst_transform=base_transform,
-                           src_crs=in_raster.crs, dst_crs=base_crs,
-                           src_nodata=in_raster.nodata, dst_nodata=base_nodata,
-                           resampling=resampling_method, num_threads=num_threads)[0]
-    out_arr = np.where(template_array == base_nodata, base_nodata, reproj_arr)
+    def __init__(self, template_path, input_raster_paths_list, resampling_method_list, band_id_list,
+                 dtype='float32'):
+        if isinstance(template_path, StackingSession):
+            self.session = template_path
+        else:
+            self.session = StackingSession(template_path)
+        self.dtype = dtype
+        self._lock = threading.Lock()
+
+        self._sources = []
+        self._layers = []
+        for path, method, band in zip(input_raster_paths_list, resampling_method_list, band_id_list):
+            src = self.session._open_input(path, method)
+            vrt = WarpedVRT(src, crs=self.session.crs, transform=self.session.transform,
+                            width=self.session.width, height=self.session.height,
+                            resampling=method, nodata=self.session.nodata)
+            indexes = list(range(1, src.count + 1)) if band == "all" else [band + 1]
+            self._sources.append(src)
+            self._layers.append((vrt, indexes))
+
+        self.count = sum(len(indexes) for _, indexes in self._layers)
+        self.shape = (self.count, self.session.height, self.session.width)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for vrt, _ in self._layers:
+            vrt.close()
+        for src in self._sources:
+            src.close()
+
+    def read(self, window=None):
+        """
+        Warps and masks one window of every layer.
+
+        Parameters
+        ----------
+        window : rasterio.windows.Window, optional
+            Part of the template grid to read. The whole grid by default.
+
+        Returns
+        -------
+        array : ndarray
+            Array of shape ``(count, window height, window width)``
+        """
+        if window is None:
+            window = Window(0, 0, self.session.width, self.session.height)
+        out = np.empty((self.count, window.height, window.width), dtype=self.dtype)
+        band = 0
+        # Datasets must not be read from several threads at once
+        with self._lock:
+            for vrt, indexes in self._layers:
+                vrt.read(indexes, window=window, out=out[band:band + len(indexes)])
+                band += len(indexes)
+        return self.session.apply_mask(out, window)
+
+    def iter_windows(self, block_size=1024):
+        """
+        Reads the stack one block at a time.
+
+        Yields
+        ------
+        window, array
+            Each template-aligned block and the stack's values in it
+        """
+        for window in iter_template_windows(self.session.height, self.session.width, block_size):
+            yield window, self.read(window)
+
+
+def split_threads(num_threads, num_layers):
+    """
+    Splits a thread budget between layers matched concurrently and the GDAL
+    warp threads used for each layer, so that together they never use more
+    than ``num_threads`` cores.
+
+    Parameters
+    ----------
+    num_threads : int
+        Total number of cores to use
+    num_layers : int
+        Number of layers to match
+
+    Returns
+    -------
+    layer_workers : int
+        Number of layers to match at once
+    warp_threads : int
+        Number of threads for each ``reproject`` call
+    """
+    layer_workers = max(1, min(num_threads, num_layers))
+    warp_threads = max(1, num_threads // layer_workers)
+    return layer_workers, warp_threads
 
-    return out_arr
 
+# Session of a worker process of the process-pool backend
+_worker_session = None
 
-def match_and_stack_rasters(template_path, input_raster_paths_list, resampling_method_list, band_id_list, num_threads=1):
+
+def _init_worker(session):
+    global _worker_session
+    _worker_session = session
+
+
+def _match_into_shared_memory(shm_name, shape, dtype, offset, count, input_raster_path, resampling_method, band,
+                              warp_threads):
+    """ Matches one layer into its bands of a shared-memory stack (process pool worker). """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        stack = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        session = _worker_session
+        # A single block covering the template is the same warp as a full read
+        session.match(input_raster_path, resampling_method, band, num_threads=warp_threads,
+                      block_size=max(session.height, session.width),
+                      out=stack[offset:offset + count])
+    finally:
+        shm.close()
+
+
+class _SharedStack:
+    """
+    Owner of a shared-memory stack, exposed to numpy through the array
+    interface so that every array viewing the stack keeps it alive. The block
+    is released once the last of them is garbage collected.
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self.__array_interface__ = np.ndarray(shape, dtype=dtype, buffer=shm.buf).__array_interface__
+        weakref.finalize(self, shm.close)
+
+
+def _layer_band_counts(input_raster_paths_list, band_id_list):
+    """ Number of bands each input contributes to a stack. """
+    counts = []
+    for path, band in zip(input_raster_paths_list, band_id_list):
+        if band == "all":
+            with rio.open(path) as src:
+                counts.append(src.count)
+        else:
+            counts.append(1)
+    return counts
+
+
+def _match_and_stack_processes(session, input_raster_paths_list, resampling_method_list, band_id_list,
+                               layer_workers, warp_threads, dtype='float64'):
+    """
+    Process-pool backend of :func:`match_and_stack_rasters`. Workers write
+    straight into one shared-memory stack, so no arrays are pickled back.
+    The returned arrays are views of that stack rather than copies; the
+    shared memory is released once none of them is in use any more.
+    """
+    counts = _layer_band_counts(input_raster_paths_list, band_id_list)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    shape = (int(sum(counts)), session.height, session.width)
+    dtype = np.dtype(dtype)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=layer_workers, initializer=_init_worker,
+                                                    initargs=(session,)) as executor:
+            futures = [
+                executor.submit(_match_into_shared_memory, shm.name, shape, dtype.str, int(offset), count, path,
+                                method, band, warp_threads)
+                for offset, count, path, method, band in zip(offsets, counts, input_raster_paths_list,
+                                                             resampling_method_list, band_id_list)
+            ]
+            for future in futures:
+                future.result()
+    except BaseException:
+        shm.close()
+        raise
+    finally:
+        # The name is no longer needed; the mapping stays valid until closed
+        shm.unlink()
+
+    stack = np.asarray(_SharedStack(shm, shape, dtype))
+    return [stack[offset:offset + count] for offset, count in zip(offsets, counts)]
+
+
+def match_and_stack_rasters(template_path, input_raster_paths_list, resampling_method_list, band_id_list, num_threads=1,
+                            backend="thread", cache=None, dtype='float64'):
     """
     Serves as the backend of the add raster layers to the data stack tool.
     Lists should be created coming from the QDialog and QListView.
@@ -88,33 +711,62 @@ def match_and_stack_rasters(template_path, input_raster_paths_list, resampling_m
         List of file paths (str) to input rasters
     resampling_method_list : list
         Resampling method to apply
+    band_id_list : list
+        Zero-based band index, or ``"all"``, for each input raster
     num_threads : int
-        Number of threads to utilize for the resampling
+        Number of cores to use. They are split between layers matched
+        concurrently and GDAL warp threads per layer (see
+        :func:`split_threads`).
+    backend : str, optional
+        ``"thread"`` (the default, also what should be used from inside
+        QGIS) matches layers in a thread pool. ``"process"`` uses a process
+        pool whose workers write into a shared-memory stack, so the Python
+        side of each layer (reading, masking) runs in parallel too. The
+        returned arrays are then views of that stack, which is freed once
+        they are all garbage collected.
+    cache : statmagic_backend.dev.layer_cache.LayerCache, optional
+        Cache of matched layers. Layers already matched to this template
+        are read from it; the others are matched and added to it.
+    dtype : str, optional
+        Data type of the matched arrays
 
     Returns
     -------
-    array_stack : ndarray
-        Array with dimensions (number of input files, height and width of template)
-
-    Warnings
-    --------
-    Defaults to ``float32`` datatype.
-
-    """
-    # reprojected_arrays = []
-    # for raster_path, rs_method in zip(input_raster_paths_list, resampling_method_list):
-    #     reprojected_array = match_raster_to_template(template_path, raster_path, rs_method, num_threads=num_threads)
-    #     reprojected_arrays.append(reprojected_array)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        reprojected_arrays = list(executor.map(lambda args: match_raster_to_template(*args),
-                                               zip([template_path] * len(input_raster_paths_list),
-                                                   input_raster_paths_list,
-                                                   resampling_method_list,
-                                                   band_id_list,
-                                                   [num_threads] * len(input_raster_paths_list))))
-    # array_stack = np.vstack(reprojected_arrays).astype('float32')
-
-    # return array_stack
+    array_stack : list
+        Arrays with dimensions (bands, height and width of template), one
+        per input file
+
+    """
+    if backend not in ("thread", "process"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # The template grid and nodata mask are read once for the whole stack
+    session = StackingSession(template_path)
+    layers = list(zip(input_raster_paths_list, resampling_method_list, band_id_list))
+
+    reprojected_arrays = [None] * len(layers)
+    if cache is not None:
+        keys = [cache.key(path, band, method, session, dtype) for path, method, band in layers]
+        reprojected_arrays = [cache.get(key) for key in keys]
+    todo = [i for i, array in enumerate(reprojected_arrays) if array is None]
+    if not todo:
+        return reprojected_arrays
+
+    paths, methods, bands = (list(x) for x in zip(*[layers[i] for i in todo]))
+    layer_workers, warp_threads = split_threads(num_threads, len(todo))
+    logger.debug(f'matching {layer_workers} layers at a time with {warp_threads} warp threads each')
+
+    if backend == "process":
+        matched = _match_and_stack_processes(session, paths, methods, bands, layer_workers, warp_threads, dtype)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=layer_workers) as executor:
+            matched = list(executor.map(lambda args: session.match(*args).astype(dtype, copy=False),
+                                        zip(paths, methods, bands, [warp_threads] * len(todo))))
+
+    for i, array in zip(todo, matched):
+        reprojected_arrays[i] = array
+        if cache is not None:
+            cache.put(keys[i], array, session)
     return reprojected_arrays
 
 
@@ -122,6 +774,11 @@ def add_matched_arrays_to_data_raster(data_raster_filepath, matched_arrays, desc
     """
     Adds ``matched_arrays`` to the data raster along with their descriptions.
 
+    If the data raster is a data cube (``.vrt``, see
+    :mod:`statmagic_backend.dev.data_cube`), only the new bands are written
+    and the cube's band list is updated. A GeoTIFF data raster is rewritten
+    in full.
+
     Parameters
     ----------
     data_raster_filepath : str
@@ -141,17 +798,15 @@ def add_matched_arrays_to_data_raster(data_raster_filepath, matched_arrays, desc
     profile = data_raster.profile
     number_new_bands = matched_arrays.shape[0]
 
-    # Check that if there is only one layer in the raster (eg. just got built) then to remove it
-    nodata = data_raster.nodata
-    tarr = data_raster.read(1)
-    arr = np.where(tarr == nodata, np.nan, tarr)
-    arr = arr[~np.isnan(arr)]
-    isAltered = np.all(arr == 1)
-
     data_raster.close()
 
-    # Todo: Find a better way to do this. A user might just add one band first, and then another
-    # if current_band_count == 1:
+    # If the raster is still the placeholder template (eg. just got built) its band is replaced
+    isAltered = is_placeholder_data_raster(data_raster_filepath)
+
+    if is_data_cube(data_raster_filepath):
+        append_bands_to_data_cube(data_raster_filepath, matched_arrays, description_list, replace=isAltered)
+        return
+
     if isAltered:
         logger.debug('updating raster layers for the first time')
         profile.update(count=number_new_bands)
@@ -159,6 +814,7 @@ def add_matched_arrays_to_data_raster(data_raster_filepath, matched_arrays, desc
         data_raster.write(matched_arrays)
         for band, description in enumerate(description_list, 1):
             data_raster.set_band_description(band, description)
+        data_raster.update_tags(**{PLACEHOLDER_TAG: 'NO'})
         data_raster.close()
     else:
         # Raster already has layers added and just needs more added to it
@@ -174,6 +830,7 @@ def add_matched_arrays_to_data_raster(data_raster_filepath, matched_arrays, desc
         data_raster.write(full_array)
         for band, description in enumerate(full_descriptions, 1):
             data_raster.set_band_description(band, description)
+        data_raster.update_tags(**{PLACEHOLDER_TAG: 'NO'})
         data_raster.close()
 
 
@@ -181,6 +838,10 @@ def drop_selected_layers_from_raster(data_raster_filepath, drop_idxs):
     """
     Removes selected bands from the data raster.
 
+    For a data cube (``.vrt``) only the cube's band list is updated, which
+    is instant whatever the size of the cube; the dropped band files are
+    deleted later by :func:`~statmagic_backend.dev.data_cube.compact_data_cube`.
+
     Parameters
     ----------
     data_raster_filepath : str
@@ -193,98 +854,208 @@ def drop_selected_layers_from_raster(data_raster_filepath, drop_idxs):
     No return value. Overwrites the raster file.
 
     """
+    if is_data_cube(data_raster_filepath):
+        drop_bands_from_data_cube(data_raster_filepath, drop_idxs)
+        return
+
     data_raster = rio.open(data_raster_filepath)
     num_bands_current = data_raster.count  # The number of bands in the current raster
-    number_bands_new = num_bands_current - len(
-        drop_idxs)  # The number of bands that will be kept (list of bands is actually list of keepers)
     current_descriptions = list(data_raster.descriptions)  # The current band descriptions
-    full_idx = [x for x in range(num_bands_current)]
-    keep_idxs = [x for x in full_idx if x not in drop_idxs]
+    drop_set = set(drop_idxs)
+    keep_idxs = [x for x in range(num_bands_current) if x not in drop_set]
     updated_descs = [current_descriptions[i] for i in keep_idxs]
     profile = data_raster.profile
-    profile.update(count=number_bands_new)
-    existing_array = data_raster.read()
+    profile.update(count=len(keep_idxs))
+    # Only the bands being kept are read
+    updated_array = data_raster.read([i + 1 for i in keep_idxs])
     data_raster.close()
     del data_raster
-    updated_array = np.delete(existing_array, drop_idxs, 0)
     data_raster = rio.open(data_raster_filepath, 'w', **profile)
     data_raster.write(updated_array)
     for band, description in enumerate(updated_descs, 1):
         data_raster.set_band_description(band, description)
+    data_raster.update_tags(**{PLACEHOLDER_TAG: 'NO'})
     data_raster.close()
 
 
 def add_selected_bands_from_source_raster_to_data_raster(data_raster_filepath, input_raster_filepath, list_of_bands,
-                                                         resampling_method, num_threads=1):
-    # # Establish properties from the template/base raster
-    data_raster = rio.open(data_raster_filepath)
-    data_crs = data_raster.crs
-    data_nodata = data_raster.nodata
-    data_shape = data_raster.shape
-    data_transform = data_raster.transform
-    base_array = data_raster.read()[0:1, :, :]
-
-    existing_band_descs = list(data_raster.descriptions)
-    logger.debug(len(existing_band_descs))
-    logger.debug(f'first element is : {existing_band_descs[0]}')
+                                                         resampling_method, num_threads=1, block_size=1024):
+    """
+    Matches selected bands of a source raster to the data raster and adds
+    them to it.
+
+    Only the selected bands are read, one data raster block at a time and
+    in float32, so memory and I/O scale with the bands picked rather than
+    with the number of bands in the source. Existing bands are copied over
+    block by block (or, for a data cube, left untouched).
+
+    Parameters
+    ----------
+    data_raster_filepath : str
+        Path to the data raster (GeoTIFF or ``.vrt`` data cube)
+    input_raster_filepath : str
+        Path to the source raster
+    list_of_bands : list
+        Selected bands, as ``"Band <number>: <description>"`` strings
+    resampling_method : rasterio.enums.Resampling
+        Resampling method
+    num_threads : int, optional
+        Number of threads to utilize for the resampling
+    block_size : int, optional
+        Edge length in pixels of the blocks matched at a time
+
+    Notes
+    -----
+    No return value. Writes directly to the raster file.
+    """
+    with rio.open(data_raster_filepath) as data_raster:
+        profile = data_raster.profile
+        tag = data_raster.tags().get(PLACEHOLDER_TAG)
+        existing_band_descs = list(data_raster.descriptions)
     logger.debug(f'exiting band descs {existing_band_descs}')
-    if existing_band_descs[0] is None:
-        logger.debug('no bands ')
+    if tag is not None:
+        first_addition = tag == 'YES'
+    else:
+        first_addition = existing_band_descs[0] is None
+    if first_addition:
+        logger.debug('first addition of bands')
         existing_band_descs = []
 
-    logger.debug(existing_band_descs)
-
-    # Here figure out which bands will be kept from the source raster
-    input_raster = rio.open(input_raster_filepath)
-    num_bands_current = input_raster.count
-    number_bands_new = len(list_of_bands)
-    full_idx = [x + 1 for x in range(num_bands_current)]
+    # The bands picked from the source raster, in the order they were listed
     idxs = [int(item.split("Band ")[1].split(":")[0]) for item in list_of_bands]
-    drop_idxs = [x - 1 for x in full_idx if x not in idxs]
     new_descs = [item.split(": ")[1] for item in list_of_bands]
     logger.debug(f'new descs: {new_descs}')
-    # Read the input array and drop the unneeded bands
-    in_array = input_raster.read()
-    updated_rast = np.delete(in_array, drop_idxs, 0)
-    input_raster.close()
 
-    # Create an array in the shape of the template to reproject into and execute reprojections
-    new_ds = np.empty(shape=(updated_rast.shape[0], data_shape[0], data_shape[1]))
+    # Only band 1 of the data raster is used as the mask
+    session = StackingSession(data_raster_filepath, block_size=block_size, mask_band=1)
 
-    reproj_arr = reproject(updated_rast, new_ds,
-                           src_transform=input_raster.transform, dst_transform=data_transform,
-                           src_crs=input_raster.crs, dst_crs=data_crs,
-                           src_nodata=input_raster.nodata, dst_nodata=data_nodata,
-                           resampling=resampling_method, num_threads=num_threads)[0]
-    out_arr = np.where(base_array == data_nodata, data_nodata, reproj_arr)
+    with session._open_input(input_raster_filepath, resampling_method) as input_raster:
+        if is_data_cube(data_raster_filepath):
+            bands = []
+            for idx, description in zip(idxs, new_descs):
+                filename, band_profile = new_band_file(data_raster_filepath, profile)
+                with rio.open(filename, 'w', **band_profile) as dst:
+                    session._match_windowed(input_raster, resampling_method, [idx], num_threads, block_size,
+                                            dst, out_indexes=[1], dtype='float32')
+                    dst.set_band_description(1, description)
+                bands.append((str(filename), description))
+            append_band_files_to_data_cube(data_raster_filepath, bands, replace=first_addition)
+            return
 
-    profile = data_raster.profile
-    # Does updating the profile here work the way it should?
-    if len(existing_band_descs) > 0:
-        logger.debug('already has bands')
-        profile.update(count=data_raster.count + number_bands_new)
-        existing_array = data_raster.read()
-        data_raster_array_updated = np.vstack([existing_array, out_arr])
-        existing_band_descs.extend(new_descs)
-        updated_descs = existing_band_descs.copy()
-    else:
-        logger.debug('first addition of bands')
-        data_raster_array_updated = out_arr
-        profile.update(count=number_bands_new)
-        updated_descs = new_descs
+        # Write the updated raster next to the old one, then swap it in
+        num_existing = len(existing_band_descs)
+        updated_descs = existing_band_descs + new_descs
+        profile.update(count=len(updated_descs), tiled=True, blockxsize=256, blockysize=256)
+        tmp_path = Path(data_raster_filepath).with_suffix('.tmp.tif')
+        with rio.open(tmp_path, 'w', **profile) as dst:
+            if num_existing:
+                logger.debug('already has bands')
+                with rio.open(data_raster_filepath) as data_raster:
+                    for window in iter_template_windows(session.height, session.width, block_size):
+                        dst.write(data_raster.read(window=window), indexes=list(range(1, num_existing + 1)),
+                                  window=window)
+            session._match_windowed(input_raster, resampling_method, idxs, num_threads, block_size, dst,
+                                    out_indexes=list(range(num_existing + 1, len(updated_descs) + 1)),
+                                    dtype='float32')
+            for band, description in enumerate(updated_descs, 1):
+                dst.set_band_description(band, description)
+            dst.update_tags(**{PLACEHOLDER_TAG: 'NO'})
+    os.replace(tmp_path, data_raster_filepath)
+    logger.debug(f'updated descs: {updated_descs}')
 
-    data_raster.close()
-    del data_raster
 
-    logger.debug(f'updated descs: {updated_descs}')
-    data_raster = rio.open(data_raster_filepath, 'w', **profile)
-    data_raster.write(data_raster_array_updated)
-    for band, description in enumerate(updated_descs, 1):
-        data_raster.set_band_description(band, description)
-    data_raster.close()
+# GDAL settings for reading remote COGs: skip the directory listing on open,
+# fetch only the byte ranges of the tiles read and merge adjacent ranges into
+# one request
+COG_ENV = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff',
+    VSI_CACHE='TRUE',
+)
+
+
+def _read_cog_window(url, resampling_method, indexes, overview_level, session, window, dtype, semaphore):
+    """ Warps one template window of a COG, holding ``semaphore`` while it is read. """
+    with semaphore, rio.Env(**COG_ENV):
+        with rio.open(url, overview_level=overview_level) as src:
+            with WarpedVRT(src, src_crs=src.crs or CRS.from_epsg(4326), crs=session.crs,
+                           transform=session.transform, width=session.width, height=session.height,
+                           resampling=resampling_method, nodata=session.nodata) as vrt:
+                block = vrt.read(indexes, window=window, out_dtype=dtype)
+    return session.apply_mask(block, window)
+
+
+def lazy_match_cog(cog_path, resampling_method, session, band="all", chunk_size=1024, max_concurrency=8,
+                   dtype='float32', semaphore=None):
+    """
+    Matches a (remote) COG to a template as a lazy dask array.
+
+    Nothing is downloaded until chunks of the array are computed. Each chunk
+    is one template-aligned window, warped from only the COG tiles under it,
+    so just the byte ranges intersecting the template footprint are fetched
+    (over HTTP range requests for ``http(s)://`` and ``/vsicurl/`` paths).
+    When the template is coarser than the COG and the resampling method
+    allows it, the COG's internal overviews are read instead of the full
+    resolution (see :func:`select_overview_level`).
+
+    Parameters
+    ----------
+    cog_path : str
+        Path or URL of the COG
+    resampling_method : rasterio.enums.Resampling, str or int
+        Resampling method
+    session : StackingSession
+        Template to match the COG to
+    band : int or str, optional
+        Zero-based band index, or ``"all"``
+    chunk_size : int, optional
+        Edge length in template pixels of the chunks of the array
+    max_concurrency : int, optional
+        Maximum number of chunks read at once
+    dtype : str, optional
+        Data type of the array
+    semaphore : threading.Semaphore, optional
+        Semaphore to bound reads with instead of a new one allowing
+        ``max_concurrency``, e.g. to share one bound between several COGs
+
+    Returns
+    -------
+    array : dask.array.Array
+        Array of shape ``(bands, template height, template width)``
+    """
+    import dask
+    import dask.array as da
 
+    resampling_method = _resampling(resampling_method)
+    if semaphore is None:
+        semaphore = threading.BoundedSemaphore(max_concurrency)
 
-def match_cogList_to_template_andStack(template_path: str, cog_paths: list, method_list: list) -> np.ndarray:
+    with rio.Env(**COG_ENV), rio.open(cog_path) as src:
+        indexes = list(range(1, src.count + 1)) if band == "all" else [band + 1]
+        overview_level = select_overview_level(src, session, resampling_method)
+    logger.debug(f'{cog_path}: reading overview level {overview_level}')
+
+    name = hashlib.sha256(json.dumps([str(cog_path), str(resampling_method), band, overview_level,
+                                      chunk_size, dtype, session.grid_key()]).encode()).hexdigest()
+    rows = []
+    for row_off in range(0, session.height, chunk_size):
+        row = []
+        for col_off in range(0, session.width, chunk_size):
+            window = Window(col_off, row_off,
+                            min(chunk_size, session.width - col_off),
+                            min(chunk_size, session.height - row_off))
+            block = dask.delayed(_read_cog_window, pure=True)(
+                cog_path, resampling_method, indexes, overview_level, session, window, dtype, semaphore,
+                dask_key_name=f"lazy-cog-{name}-{row_off}-{col_off}"
+            )
+            row.append(da.from_delayed(block, shape=(len(indexes), window.height, window.width), dtype=dtype))
+        rows.append(row)
+    return da.block([rows])
+
+
+def match_cogList_to_template_andStack(template_path: str, cog_paths: list, method_list: list,
+                                       cache=None, lazy=False, max_concurrency=8) -> list:
     """
     Function to match a list of COG arrays to a template using rasterio, rioxarray, and numpy operations.
 
@@ -292,14 +1063,48 @@ def match_cogList_to_template_andStack(template_path: str, cog_paths: list, meth
     - template_path: str, path to the template COG file
     - cog_paths: list, list of paths to the COG files to match
     - rs_list: list, list of resampling methods for reprojection
+    - cache: LayerCache, optional cache of matched layers to check first and add to. When lazy, it is
+      only read from: layers not in it stay lazy and are not added (use :func:`match_and_assemble_stack`
+      to compute COG layers and cache them)
+    - lazy: bool, return dask arrays that read only the needed byte ranges when computed
+      (see :func:`lazy_match_cog`) instead of downloading and matching each COG now
+    - max_concurrency: int, maximum number of COGs (or, when lazy, chunks) read at once
 
     Returns:
-    - out_arr: np.ndarray, matched and stacked array with nodata masking applied
+    - matched_arrays: list, matched float32 arrays masked with the template nodata mask
+      (ndarray, or dask arrays when lazy)
     """
-    template_ds = rioxarray.open_rasterio(template_path)
+    matched_arrays = [None] * len(cog_paths)
+    session = StackingSession(template_path)
+    if cache is not None:
+        keys = [cache.key(path, "cog", method, session, 'float32') for path, method in zip(cog_paths, method_list)]
+        matched_arrays = [cache.get(key) for key in keys]
+    todo = [i for i, array in enumerate(matched_arrays) if array is None]
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        matched_arrays = list(executor.map(_process_cog, cog_paths, method_list, [template_ds] * len(cog_paths)))
+    if lazy:
+        import dask.array as da
+
+        # One bound shared by all the COGs. Cache hits are wrapped as they are;
+        # misses are not cached, since that would mean computing them now
+        semaphore = threading.BoundedSemaphore(max_concurrency)
+        for i, array in enumerate(matched_arrays):
+            if array is None:
+                matched_arrays[i] = lazy_match_cog(cog_paths[i], method_list[i], session, semaphore=semaphore)
+            else:
+                matched_arrays[i] = da.from_array(array)
+        return matched_arrays
+
+    template_ds = rioxarray.open_rasterio(template_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        matched = list(executor.map(_process_cog, [cog_paths[i] for i in todo], [method_list[i] for i in todo],
+                                    [template_ds] * len(todo)))
+    for i, array in zip(todo, matched):
+        # Masked float32 on the template grid, the same as lazily matched COGs
+        # and what is cached under their keys
+        array = session.apply_mask(array.astype('float32'))
+        matched_arrays[i] = array
+        if cache is not None:
+            cache.put(keys[i], array, session)
 
     # array_stack = np.vstack(matched_arrays).astype('float32')
     # # Apply nodata masking
@@ -370,25 +1175,175 @@ def parse_raster_processing_table_elements(raster_paths, source_list, method_lis
     return local_dict, cog_dict, order_dict
 
 
+class StackAssembler:
+    """
+    Stack of the layers of a raster processing table, allocated once in its
+    final dtype and filled in place.
+
+    Each local or COG layer owns a slice of bands of the stack (its *slot*),
+    in the order of the table. Matched layers are written straight into
+    their slots as they complete, so the stack is never copied, and finding
+    a slot is a dict lookup.
+
+    Parameters
+    ----------
+    order : dict
+        Order of the layers, as returned by
+        :func:`parse_raster_processing_table_elements`
+    band_counts : list
+        Number of bands of each layer, in table order (``order['full']``)
+    shape : tuple
+        ``(height, width)`` of the layers
+    dtype : str, optional
+        Data type of the stack
+
+    Attributes
+    ----------
+    stack : ndarray
+        The stack, of shape ``(sum(band_counts), height, width)``
+    """
+
+    def __init__(self, order, band_counts, shape, dtype='float32'):
+        offsets = np.concatenate([[0], np.cumsum(band_counts, dtype=int)])
+        position = {idx: pos for pos, idx in enumerate(order['full'])}
+        self._slots = {}
+        for source in ('local', 'cog'):
+            for i, idx in enumerate(order[source]):
+                pos = position[idx]
+                self._slots[source, i] = (int(offsets[pos]), int(offsets[pos + 1]))
+        self.stack = np.empty((int(offsets[-1]), *shape), dtype=dtype)
+
+    def slot(self, source, i):
+        """
+        Parameters
+        ----------
+        source : str
+            ``"local"`` or ``"cog"``
+        i : int
+            Index of the layer in the ``source`` lists
+
+        Returns
+        -------
+        slot : ndarray
+            View of the bands of the stack belonging to the layer, to match
+            it into
+        """
+        start, end = self._slots[source, i]
+        return self.stack[start:end]
+
+    def put(self, source, i, array):
+        """ Writes a matched layer into its slot, converting it to the stack's dtype. """
+        np.copyto(self.slot(source, i), array, casting='same_kind')
+
+
 def reorder_array_lists_to_stack(local_array_list, cog_array_list, order):
-    full_array_list = []
-    for x in order['full']:
-        logger.debug("----------------------------------------")
-        logger.debug(x)
-        if x in order['local']:
-            logger.debug(f"local: {order['local']}")
-            idx = order['local'].index(x)
-            logger.debug(idx)
-            full_array_list.append(local_array_list[idx])
-        elif x in order['cog']:
-            logger.debug(f"cog: {order['cog']}")
-            idx = order['cog'].index(x)
-            logger.debug(idx)
-            full_array_list.append(cog_array_list[idx])
-        else:
-            logger.debug('somethign wrong')
-    array_stack = np.vstack(full_array_list).astype('float32')
-    return array_stack
+    band_counts = {}
+    for source, array_list in (('local', local_array_list), ('cog', cog_array_list)):
+        for idx, array in zip(order[source], array_list):
+            band_counts[idx] = array.shape[0]
+    shape = (local_array_list or cog_array_list)[0].shape[1:]
+
+    assembler = StackAssembler(order, [band_counts[x] for x in order['full']], shape)
+    for i, array in enumerate(local_array_list):
+        assembler.put('local', i, array)
+    for i, array in enumerate(cog_array_list):
+        assembler.put('cog', i, array)
+    return assembler.stack
+
+
+def match_and_assemble_stack(template_path, local_dict, cog_dict, order, num_threads=1, block_size=1024,
+                             cache=None):
+    """
+    Matches the layers of a raster processing table to a template and
+    stacks them, writing each one straight into its slot of a float32 stack
+    (see :class:`StackAssembler`).
+
+    Equivalent to :func:`match_and_stack_rasters` and
+    :func:`match_cogList_to_template_andStack` followed by
+    :func:`reorder_array_lists_to_stack` and
+    :func:`apply_template_mask_to_array`, without holding the matched
+    layers and the stack at the same time: besides the stack itself, only
+    one block per layer being matched is in memory.
+
+    Parameters
+    ----------
+    template_path : str
+        Path to the template raster
+    local_dict, cog_dict, order : dict
+        Local layers, COG layers and their order, as returned by
+        :func:`parse_raster_processing_table_elements`
+    num_threads : int, optional
+        Number of cores to use for local layers (see :func:`split_threads`),
+        and the maximum number of COG chunks read at once
+    block_size : int, optional
+        Edge length in template pixels of the blocks matched at a time
+    cache : statmagic_backend.dev.layer_cache.LayerCache, optional
+        Cache of matched layers to read from and add to
+
+    Returns
+    -------
+    array_stack : ndarray
+        float32 array of shape (number of bands, template height, template width)
+    """
+    session = StackingSession(template_path)
+    local_layers = list(zip(local_dict['paths'], local_dict['methods'], local_dict['band']))
+    cog_layers = list(zip(cog_dict['paths'], cog_dict['methods']))
+
+    # Cached COG layers are read first, so that only the others are opened
+    # over the network; their band counts come from the cached arrays
+    cog_hits = {}
+    if cache is not None:
+        keys = {('local', i): cache.key(path, band, method, session, 'float32')
+                for i, (path, method, band) in enumerate(local_layers)}
+        keys.update((('cog', i), cache.key(path, "cog", method, session, 'float32'))
+                    for i, (path, method) in enumerate(cog_layers))
+        for i in range(len(cog_layers)):
+            array = cache.get(keys['cog', i])
+            if array is not None:
+                cog_hits[i] = array
+    cog_todo = [i for i in range(len(cog_layers)) if i not in cog_hits]
+    # One bound shared by all the COGs
+    semaphore = threading.BoundedSemaphore(max(1, num_threads))
+    cog_arrays = {i: lazy_match_cog(*cog_layers[i], session, chunk_size=block_size, semaphore=semaphore)
+                  for i in cog_todo}
+
+    band_counts = dict(zip(order['local'], _layer_band_counts(local_dict['paths'], local_dict['band'])))
+    band_counts.update((order['cog'][i], array.shape[0]) for i, array in cog_hits.items())
+    band_counts.update((order['cog'][i], array.shape[0]) for i, array in cog_arrays.items())
+    assembler = StackAssembler(order, [band_counts[x] for x in order['full']], (session.height, session.width))
+
+    for i in list(cog_hits):
+        assembler.put('cog', i, cog_hits.pop(i))
+    local_todo = list(range(len(local_layers)))
+    if cache is not None:
+        for i in range(len(local_layers)):
+            array = cache.get(keys['local', i])
+            if array is not None:
+                assembler.put('local', i, array)
+                local_todo.remove(i)
+
+    if local_todo:
+        layer_workers, warp_threads = split_threads(num_threads, len(local_todo))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=layer_workers) as executor:
+            futures = [
+                executor.submit(session.match, *local_layers[i], num_threads=warp_threads, block_size=block_size,
+                                out=assembler.slot('local', i))
+                for i in local_todo
+            ]
+            for future in futures:
+                future.result()
+
+    if cog_todo:
+        import dask.array as da
+
+        # Chunks are written into the COG slots as they are computed
+        da.store([cog_arrays[i] for i in cog_todo], [assembler.slot('cog', i) for i in cog_todo], lock=False)
+
+    if cache is not None:
+        for source, todo in (('local', local_todo), ('cog', cog_todo)):
+            for i in todo:
+                cache.put(keys[source, i], assembler.slot(source, i), session)
+    return assembler.stack
 
 
 def apply_template_mask_to_array(template_path, array_stack):
@@ -7,6 +7,7 @@ from rasterio.features import rasterize
 import geopandas as gpd
 from typing import Optional
 
+from statmagic_backend.dev.data_cube import PLACEHOLDER_TAG
 from statmagic_backend.utils import loggingDecorator
 import logging
 logger = logging.getLogger("statmagic_backend")
@@ -59,6 +60,8 @@ def create_template_raster_from_bounds_and_resolution(bounds, target_crs, pixel_
 
     new_dataset = rio.open(output_path, 'w', driver='GTiff', **out_meta)
     new_dataset.write(out_array)
+    # Data rasters start out as copies of the template; mark them as the placeholder
+    new_dataset.update_tags(**{PLACEHOLDER_TAG: 'YES'})
     new_dataset.close()
 
 # def create_template_raster_from_bounds_and_resolution(
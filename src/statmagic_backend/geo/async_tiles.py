@@ -0,0 +1,195 @@
+import asyncio
+
+import httpx
+import mercantile
+
+from statmagic_backend.geo.tiles import HostRateLimiter, RETRY_STATUS_CODES, tile_url
+from statmagic_backend.geo.transform import decode_protobuf_layers_to_geojson_wgs84
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+async def fetch_tile_async(client, url, etag=None, limiter=None, max_retries=3,
+                           backoff_factor=0.5):
+    """
+    Downloads one tile, retrying with exponential backoff on transport
+    errors and retryable (429/5xx) statuses.
+
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        Client to issue the request from
+    url : str
+        URL of the tile
+    etag : str, optional
+        ETag of a cached copy of the tile; makes the request conditional
+    limiter : statmagic_backend.geo.tiles.HostRateLimiter, optional
+        Per-host rate limiter
+    max_retries : int, optional
+        Number of times a failed request is retried
+    backoff_factor : float, optional
+        Backoff between retries is ``backoff_factor * 2 ** retry`` seconds,
+        unless the server sends ``Retry-After``
+
+    Returns
+    -------
+    response : httpx.Response
+    """
+    headers = {"If-None-Match": etag} if etag else None
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            delay = limiter.reserve(url)
+            if delay:
+                await asyncio.sleep(delay)
+
+        try:
+            response = await client.get(url, headers=headers)
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(backoff_factor * 2 ** attempt)
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else backoff_factor * 2 ** attempt
+            await asyncio.sleep(delay)
+            continue
+
+        if response.status_code not in (200, 304):
+            logger.warning(f"{url} returned status {response.status_code}")
+        return response
+
+
+async def iter_decoded_tiles(tile_indices, tileserver, service, layernames,
+                             tilesize, max_workers=8, max_pending=32,
+                             rate_limit=None, max_retries=3, backoff_factor=0.5,
+                             cache=None, executor=None, timeout=30):
+    """
+    Downloads and decodes vector tiles as one overlapping pipeline.
+
+    Up to ``max_workers`` downloads are in flight at once. As soon as a tile
+    arrives it is handed to ``executor`` to be decoded while further
+    downloads continue. At most ``max_pending`` downloaded tiles wait to be
+    consumed; when the consumer falls behind, downloading pauses, so memory
+    stays bounded however many tiles there are. Cached tiles are looked up
+    one at a time as they are reached, and cache reads and writes run in
+    the event loop's default thread pool.
+
+    Parameters
+    ----------
+    tile_indices : array-like
+        Tile indices ordered ``[z,x,y]``
+    tileserver : str
+        Tile server URL
+    service : str
+        Which tile service to use from the tile server
+    layernames : list
+        Names (str) of the layers to decode from each tile
+    tilesize : int
+        Size of the tile returned by the tile server in pixels
+    max_workers : int, optional
+        Maximum number of tile requests in flight at once
+    max_pending : int, optional
+        Maximum number of tiles downloaded but not yet consumed
+    rate_limit : float or dict, optional
+        Per-host limit in requests per second; see
+        :class:`~statmagic_backend.geo.tiles.HostRateLimiter`
+    max_retries : int, optional
+        Retries per tile on transport errors and retryable statuses
+    backoff_factor : float, optional
+        Exponential backoff factor between retries, in seconds
+    cache : statmagic_backend.geo.tile_cache.TileCache, optional
+        Persistent tile cache to read from and add downloaded tiles to
+    executor : concurrent.futures.Executor, optional
+        Executor the tiles are decoded in. Defaults to the event loop's
+        default thread pool; a ``ProcessPoolExecutor`` decodes in parallel.
+    timeout : float, optional
+        Timeout in seconds for each request
+
+    Yields
+    ------
+    tile_index, layers
+        Tile indices and the dict returned by
+        :func:`~statmagic_backend.geo.transform.decode_protobuf_layers_to_geojson_wgs84`,
+        in the order tiles finish downloading
+    """
+    loop = asyncio.get_running_loop()
+    limiter = HostRateLimiter(rate_limit)
+    todo = asyncio.Queue()
+    for i in range(len(tile_indices)):
+        todo.put_nowait(i)
+    # Decoding futures waiting for the consumer; bounded for backpressure
+    pending = asyncio.Queue(maxsize=max_pending)
+
+    async def download(client):
+        while not todo.empty():
+            i = todo.get_nowait()
+            tile_index = tile_indices[i]
+            entry = None
+            if cache:
+                (entry,) = await loop.run_in_executor(
+                    None, cache.lookup, tileserver, service, [tile_index]
+                )
+
+            if entry and entry[2]:
+                tile = entry[0]
+            else:
+                response = await fetch_tile_async(
+                    client, tile_url(tileserver, service, tile_index),
+                    entry[1] if entry else None, limiter, max_retries,
+                    backoff_factor
+                )
+                if response.status_code == 304:
+                    tile = entry[0]
+                    await loop.run_in_executor(
+                        None, cache.touch, tileserver, service, [tile_index]
+                    )
+                else:
+                    tile = response.content
+                    if cache and response.status_code == 200:
+                        await loop.run_in_executor(
+                            None, cache.store, tileserver, service, [tile_index],
+                            [tile], [response.headers.get("ETag")]
+                        )
+
+            bounds = mercantile.bounds(tile_index[1], tile_index[2], tile_index[0])
+            decoded = loop.run_in_executor(
+                executor, decode_protobuf_layers_to_geojson_wgs84,
+                tile, layernames, bounds, tilesize
+            )
+            await pending.put((tile_index, decoded))
+
+    async def produce():
+        limits = httpx.Limits(max_connections=max_workers,
+                              max_keepalive_connections=max_workers)
+        try:
+            async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+                workers = [asyncio.ensure_future(download(client)) for _ in range(max_workers)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    # On an error, stop the other downloads before the client
+                    # is closed under them
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        except Exception:
+            await pending.put(None)
+            raise
+        await pending.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            tile_index, decoded = item
+            yield tile_index, await decoded
+        # Surface any download error
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
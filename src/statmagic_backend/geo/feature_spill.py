@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import tempfile
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+class FeatureSpill:
+    """
+    Temporary on-disk store of vector features partitioned by the value of
+    one property, used to dissolve feature sets that are too large to hold
+    in memory.
+
+    Features are written to an indexed SQLite file as WKB as they are read,
+    so memory use is bounded by one input file (or one group) at a time
+    rather than by the total number of features. The file is deleted when
+    the spill is closed.
+
+    Parameters
+    ----------
+    property_name : str
+        Name of the feature property to partition features by
+    directory : str or Path, optional
+        Directory for the temporary file. Defaults to the system temp dir.
+    transform : callable, optional
+        Function applied to each array of shapely geometries before it is
+        spilled, e.g. to snap tile seams
+    """
+
+    def __init__(self, property_name, directory=None, transform=None):
+        self.property_name = property_name
+        self.transform = transform
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite", dir=directory)
+        os.close(fd)
+        # A spill may be filled on one thread and dissolved on another (e.g.
+        # an event loop and its executor), but is never used concurrently
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE features (key, properties TEXT, geometry BLOB)"
+        )
+        self._indexed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+        os.remove(self.path)
+
+    def add(self, features, transform=None):
+        """
+        Spills features to disk.
+
+        Parameters
+        ----------
+        features : iterable
+            GeoJSON-like features with ``properties`` and ``geometry``
+        transform : callable, optional
+            Applied to these features' geometries instead of the spill's own
+            ``transform``
+        """
+        properties, geoms = [], []
+        for feature in features:
+            properties.append(dict(feature['properties']))
+            geoms.append(shape(feature['geometry']))
+        if not geoms:
+            return
+
+        geoms = np.asarray(geoms, dtype=object)
+        transform = transform or self.transform
+        if transform is not None:
+            geoms = transform(geoms)
+
+        rows = [
+            (p[self.property_name], json.dumps(p), wkb)
+            for p, wkb in zip(properties, shapely.to_wkb(geoms))
+        ]
+        self._conn.executemany("INSERT INTO features VALUES (?, ?, ?)", rows)
+        self._conn.commit()
+
+    def keys(self):
+        """
+        Returns
+        -------
+        keys : list
+            Distinct property values, in sorted order
+        """
+        if not self._indexed:
+            self._conn.execute("CREATE INDEX features_key ON features (key)")
+            self._indexed = True
+        return [row[0] for row in self._conn.execute(
+            "SELECT DISTINCT key FROM features ORDER BY key"
+        )]
+
+    def properties(self, key):
+        """ Properties of the first feature spilled with property value ``key``. """
+        row = self._conn.execute(
+            "SELECT properties FROM features WHERE key IS ? ORDER BY rowid LIMIT 1",
+            (key,)
+        ).fetchone()
+        return json.loads(row[0])
+
+    def union(self, key, batch_size=1000):
+        """
+        Makes valid and unions the geometries of all features with property
+        value ``key``, reading and combining at most ``batch_size``
+        geometries at a time.
+
+        Returns
+        -------
+        union : shapely.Geometry
+        """
+        cursor = self._conn.execute(
+            "SELECT geometry FROM features WHERE key IS ? ORDER BY rowid", (key,)
+        )
+        union = None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            geoms = shapely.from_wkb(np.array([row[0] for row in rows], dtype=object))
+            batch = shapely.union_all(shapely.make_valid(geoms))
+            union = batch if union is None else shapely.union(union, batch)
+        return union
@@ -0,0 +1,252 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+class TileCache:
+    """
+    Persistent cache of raw vector tiles stored in a single SQLite file, laid
+    out like an MBTiles ``tiles`` table with extra columns for the tile server
+    and service the tile came from.
+
+    Tiles are keyed by ``(tileserver, service, z, x, y)`` and stored as the
+    raw protobuf bytes returned by the server. Note that, unlike MBTiles,
+    ``tile_row`` holds the XYZ ``y`` index as used in the tile URL rather
+    than the flipped TMS row.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the SQLite file. Created if it does not exist.
+    max_bytes : int, optional
+        Size cap for the stored tile data. When exceeded, the least recently
+        used tiles are evicted until the data is back under 90% of the cap.
+        Unlimited by default.
+    ttl : float, optional
+        Seconds after which a cached tile is considered stale. Stale tiles
+        with an ETag are revalidated with the server; stale tiles without one
+        are downloaded again. Tiles never expire by default.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups answered from the cache without a request
+    misses : int
+        Number of lookups that required a request to the server, either
+        because the tile was not cached or because it was stale
+    revalidations : int
+        Number of stale tiles confirmed unchanged by the server (HTTP 304)
+    """
+
+    def __init__(self, path, max_bytes=None, ttl=None):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                tileserver TEXT NOT NULL,
+                service TEXT NOT NULL,
+                zoom_level INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                tile_data BLOB,
+                etag TEXT,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (tileserver, service, zoom_level, tile_column, tile_row)
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)"
+        )
+        self._conn.commit()
+        # Estimate of the size of the stored tile data: the last exact total
+        # plus what this instance stored since, so eviction only sums the
+        # table when the cap may have been reached
+        self._bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles"
+        ).fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+            Hit/miss counters and the number and size of stored tiles
+        """
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "tiles": count,
+            "bytes": size,
+        }
+
+    def lookup(self, tileserver, service, tile_indices):
+        """
+        Looks up a set of tiles in the cache.
+
+        Parameters
+        ----------
+        tileserver : str
+            Tile server URL
+        service : str
+            Which tile service the tiles come from
+        tile_indices : array-like
+            Tile indices ordered ``[z,x,y]``
+
+        Returns
+        -------
+        entries : list
+            For each tile, ``None`` if it is not cached, otherwise a tuple
+            ``(tile_data, etag, fresh)`` where ``fresh`` is False once the
+            tile is older than ``ttl``
+        """
+        now = time.time()
+        entries = []
+        with self._lock:
+            for z, x, y in tile_indices:
+                row = self._conn.execute(
+                    "SELECT tile_data, etag, fetched FROM tiles WHERE tileserver=? "
+                    "AND service=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                    (tileserver, service, int(z), int(x), int(y))
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    entries.append(None)
+                    continue
+                tile_data, etag, fetched = row
+                fresh = self.ttl is None or now - fetched <= self.ttl
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                entries.append((tile_data, etag, fresh))
+
+            self._conn.executemany(
+                "UPDATE tiles SET accessed=? WHERE tileserver=? AND service=? "
+                "AND zoom_level=? AND tile_column=? AND tile_row=?",
+                [(now, tileserver, service, int(z), int(x), int(y))
+                 for (z, x, y), entry in zip(tile_indices, entries) if entry]
+            )
+            self._conn.commit()
+        return entries
+
+    def store(self, tileserver, service, tile_indices, tiles, etags=None):
+        """
+        Stores (or refreshes) tiles in the cache, then evicts least recently
+        used tiles if the cache is over ``max_bytes``.
+
+        Parameters
+        ----------
+        tileserver : str
+            Tile server URL
+        service : str
+            Which tile service the tiles come from
+        tile_indices : array-like
+            Tile indices ordered ``[z,x,y]``
+        tiles : list
+            Raw tile bytes for each tile
+        etags : list, optional
+            ETag returned by the server for each tile
+        """
+        if etags is None:
+            etags = [None] * len(tiles)
+        # A tile given twice is stored once, with its last copy
+        batch = {}
+        for (z, x, y), tile, etag in zip(tile_indices, tiles, etags):
+            batch[int(z), int(x), int(y)] = (tile, etag)
+        now = time.time()
+        with self._lock:
+            for (z, x, y), (tile, _) in batch.items():
+                # Size of the copy being replaced, if any
+                row = self._conn.execute(
+                    "SELECT LENGTH(tile_data) FROM tiles WHERE tileserver=? "
+                    "AND service=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                    (tileserver, service, z, x, y)
+                ).fetchone()
+                self._bytes += len(tile or b"") - ((row[0] or 0) if row else 0)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(tileserver, service, z, x, y, tile, etag, now, now)
+                 for (z, x, y), (tile, etag) in batch.items()]
+            )
+            self._conn.commit()
+        self.evict()
+
+    def touch(self, tileserver, service, tile_indices):
+        """ Marks tiles as freshly fetched after a 304 revalidation. """
+        now = time.time()
+        with self._lock:
+            self.revalidations += len(tile_indices)
+            self._conn.executemany(
+                "UPDATE tiles SET fetched=?, accessed=? WHERE tileserver=? AND "
+                "service=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                [(now, now, tileserver, service, int(z), int(x), int(y))
+                 for z, x, y in tile_indices]
+            )
+            self._conn.commit()
+
+    def evict(self):
+        """
+        Removes least recently used tiles until under 90% of ``max_bytes``,
+        if the cache is over ``max_bytes``.
+
+        The size is summed afresh inside the eviction transaction, since
+        other processes may share the database.
+        """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self._bytes <= self.max_bytes:
+                return
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._bytes = self._conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles"
+                ).fetchone()[0]
+                evict_ids = []
+                if self._bytes > self.max_bytes:
+                    # Walk the access-time index only as far as needed
+                    low_water = 0.9 * self.max_bytes
+                    rows = self._conn.execute(
+                        "SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY accessed"
+                    )
+                    for rowid, size in rows:
+                        if self._bytes <= low_water:
+                            break
+                        evict_ids.append((rowid,))
+                        self._bytes -= size or 0
+                    rows.close()
+                    self._conn.executemany("DELETE FROM tiles WHERE rowid=?", evict_ids)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        logger.debug(f"Evicted {len(evict_ids)} tiles from {self.path}")
@@ -0,0 +1,205 @@
+import threading
+import time
+import concurrent.futures
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import logging
+logger = logging.getLogger("statmagic_backend")
+
+
+# HTTP status codes that are worth retrying against a tile server
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def tile_url(tileserver, service, tile_index):
+    """
+    Builds the URL of a single vector tile.
+
+    Parameters
+    ----------
+    tileserver : str
+        Tile server URL
+    service : str
+        Which tile service to use from the tile server
+    tile_index : array-like
+        Tile indices ordered ``[z,x,y]``
+
+    Returns
+    -------
+    url : str
+        URL of the tile, i.e. ``{tileserver}/{service}/{z}/{x}/{y}``
+    """
+    base_url = urljoin(tileserver, service) + "/"
+    return urljoin(base_url, "/".join([str(x) for x in tile_index]))
+
+
+def make_tile_session(pool_size=8, max_retries=3, backoff_factor=0.5):
+    """
+    Creates a :class:`requests.Session` with a connection pool large enough
+    for ``pool_size`` concurrent requests and automatic retries with
+    exponential backoff.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Maximum number of pooled connections kept open per host
+    max_retries : int, optional
+        Number of times a failed request is retried
+    backoff_factor : float, optional
+        Backoff between retries is ``backoff_factor * 2 ** (retry - 1)``
+        seconds. ``Retry-After`` headers sent by the server take precedence.
+
+    Returns
+    -------
+    session : requests.Session
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostRateLimiter:
+    """
+    Thread-safe limiter that spaces out requests to each host so that no more
+    than ``rate`` requests per second are started against it.
+
+    Parameters
+    ----------
+    rate : float or dict, optional
+        Requests per second allowed for every host, or a dict mapping host
+        names (e.g. ``"dev.macrostrat.org"``) to their own rate. Hosts missing
+        from the dict, or a rate of ``None``, are not limited.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def _rate_for(self, host):
+        if isinstance(self.rate, dict):
+            return self.rate.get(host)
+        return self.rate
+
+    def reserve(self, url):
+        """
+        Reserves the next request slot for the host of ``url``.
+
+        Returns
+        -------
+        delay : float
+            Seconds to wait before starting the request
+        """
+        host = urlparse(url).netloc
+        rate = self._rate_for(host)
+        if not rate:
+            return 0.0
+
+        interval = 1.0 / rate
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+
+        return max(0.0, slot - now)
+
+    def wait(self, url):
+        """ Blocks until a request to the host of ``url`` may be started. """
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetch_tile_responses(urls, etags=None, session=None, max_workers=8,
+                         rate_limit=None, max_retries=3, backoff_factor=0.5,
+                         timeout=30):
+    """
+    Downloads a list of URLs concurrently over a pooled session.
+
+    Parameters
+    ----------
+    urls : list
+        URLs to download
+    etags : list, optional
+        ETag previously returned for each URL, or ``None`` entries. Where
+        given, the request is made conditional with ``If-None-Match`` and the
+        server may answer ``304 Not Modified`` with an empty body.
+    session : requests.Session, optional
+        Session to issue the requests from. If not provided, one is created
+        with :func:`make_tile_session` and closed afterwards.
+    max_workers : int, optional
+        Maximum number of requests in flight at once
+    rate_limit : float or dict, optional
+        Per-host limit in requests per second; see :class:`HostRateLimiter`
+    max_retries : int, optional
+        Retries per request on connection errors and retryable status codes
+    backoff_factor : float, optional
+        Exponential backoff factor between retries, in seconds
+    timeout : float, optional
+        Timeout in seconds for each request
+
+    Returns
+    -------
+    responses : list
+        :class:`requests.Response` objects, in the same order as ``urls``
+    """
+    if etags is None:
+        etags = [None] * len(urls)
+
+    own_session = session is None
+    if own_session:
+        session = make_tile_session(max_workers, max_retries, backoff_factor)
+    limiter = HostRateLimiter(rate_limit)
+
+    def fetch(url, etag):
+        limiter.wait(url)
+        headers = {"If-None-Match": etag} if etag else None
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code not in (200, 304):
+            logger.warning(f"{url} returned status {response.status_code}")
+        return response
+
+    try:
+        if max_workers <= 1:
+            return [fetch(url, etag) for url, etag in zip(urls, etags)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # executor.map yields results in submission order
+            return list(executor.map(fetch, urls, etags))
+    finally:
+        if own_session:
+            session.close()
+
+
+def fetch_tiles(urls, **kwargs):
+    """
+    Downloads a list of URLs concurrently and returns their bodies.
+
+    Parameters
+    ----------
+    urls : list
+        URLs to download
+    **kwargs
+        Passed to :func:`fetch_tile_responses`
+
+    Returns
+    -------
+    contents : list
+        Response bodies (bytes), in the same order as ``urls``
+    """
+    return [response.content for response in fetch_tile_responses(urls, **kwargs)]
@@ -1,21 +1,21 @@
-import copy
+import concurrent.futures
+import gc
 import json
 import itertools
 import os
 import fiona
-from shapely.geometry import shape, mapping, Polygon
-from shapely.ops import unary_union
-from shapely.validation import make_valid
-from shapely import to_geojson
+from shapely.geometry import shape, mapping, MultiLineString, MultiPolygon
+import shapely
 from pathlib import Path
 import numpy as np
 from pyproj import Transformer
-import requests
-from urllib.parse import urljoin
 
 import mapbox_vector_tile
 import mercantile # utility for converting between XYZ indices and lat/lon bounds
 
+from statmagic_backend.geo.feature_spill import FeatureSpill
+from statmagic_backend.geo.tiles import tile_url, fetch_tiles, fetch_tile_responses
+
 import logging
 logger = logging.getLogger("statmagic_backend")
 
@@ -38,7 +38,9 @@ def geotFromOffsets(row_offset, col_offset, geot):
     return new_geot
 
 
-def download_tiles(tile_indices, tileserver, service):
+def download_tiles(tile_indices, tileserver, service, max_workers=8,
+                   rate_limit=None, max_retries=3, backoff_factor=0.5,
+                   session=None, cache=None):
     r"""
     Download Mapbox tiles from a particular tile server. Defaults to Macrostrat
     using the ``carto`` service.
@@ -52,11 +54,32 @@ def download_tiles(tile_indices, tileserver, service):
         Tile server URL
     service : str
         Which tile service to use from the tile server
+    max_workers : int, optional
+        Maximum number of tile requests in flight at once. ``1`` downloads the
+        tiles serially.
+    rate_limit : float or dict, optional
+        Maximum requests per second per host, or a dict mapping host names to
+        their own limit. Unlimited by default.
+    max_retries : int, optional
+        Number of retries, with exponential backoff, for tiles that fail with
+        a connection error or a retryable (429/5xx) status
+    backoff_factor : float, optional
+        Backoff factor in seconds between retries
+    session : requests.Session, optional
+        Session to reuse for the requests. By default a pooled session is
+        created (see :func:`statmagic_backend.geo.tiles.make_tile_session`).
+        ``max_retries`` and ``backoff_factor`` are only applied to the
+        default session.
+    cache : statmagic_backend.geo.tile_cache.TileCache, optional
+        Persistent tile cache. Cached tiles are returned without a request;
+        stale tiles are revalidated by ETag where possible, and downloaded
+        tiles are added to the cache.
 
     Returns
     -------
     mapbox_tiles : list
-        Raw (unprocessed) output from tileserver
+        Raw (unprocessed) output from tileserver, in the same order as
+        ``tile_indices``
 
     Notes
     -----
@@ -84,34 +107,152 @@ def download_tiles(tile_indices, tileserver, service):
     *  lower zoom level are more zoomed out
     ** i.e. vertices can be off by this much at this zoom level
     """
-    mapbox_tiles = []
-    base_url = urljoin(tileserver, service) + "/"
-    for tile_index in tile_indices:
-        tile_str = [str(x) for x in tile_index]
+    fetch_kwargs = dict(
+        session=session, max_workers=max_workers, rate_limit=rate_limit,
+        max_retries=max_retries, backoff_factor=backoff_factor
+    )
+    urls = [tile_url(tileserver, service, tile_index) for tile_index in tile_indices]
+
+    if cache is None:
+        return fetch_tiles(urls, **fetch_kwargs)
 
-        # Set URL of the tile to be downloaded
-        url = urljoin(base_url, "/".join(tile_str))
-        # TODO: use urllib instead of pathlib
+    # Serve fresh tiles from the cache and only request the rest
+    entries = cache.lookup(tileserver, service, tile_indices)
+    mapbox_tiles = [entry[0] if entry and entry[2] else None for entry in entries]
+    fetch_idxs = [i for i, tile in enumerate(mapbox_tiles) if tile is None]
+    logger.debug(f"{len(tile_indices) - len(fetch_idxs)} of {len(tile_indices)} tiles cached")
 
-        # Retrieve tile from URL
-        mapbox_tile = requests.get(url).content
-        mapbox_tiles.append(mapbox_tile)
+    responses = fetch_tile_responses(
+        [urls[i] for i in fetch_idxs],
+        etags=[entries[i][1] if entries[i] else None for i in fetch_idxs],
+        **fetch_kwargs
+    )
+
+    revalidated, downloaded = [], []
+    for i, response in zip(fetch_idxs, responses):
+        if response.status_code == 304:
+            mapbox_tiles[i] = entries[i][0]
+            revalidated.append(i)
+        else:
+            mapbox_tiles[i] = response.content
+            if response.status_code == 200:
+                downloaded.append((i, response.headers.get("ETag")))
+
+    cache.touch(tileserver, service, [tile_indices[i] for i in revalidated])
+    cache.store(
+        tileserver, service,
+        [tile_indices[i] for i, _ in downloaded],
+        [mapbox_tiles[i] for i, _ in downloaded],
+        [etag for _, etag in downloaded]
+    )
 
     return mapbox_tiles
 
 
-def decode_protobuf_to_geojson_wgs84(tile, layername, bounds, tilesize):
+def _flatten_coords(coords, pairs):
+    """
+    Appends every coordinate pair in a (nested) GeoJSON coordinate list to
+    ``pairs`` and returns the nesting structure needed to rebuild it: ``None``
+    for a single position, an int for a sequence of that many positions, or a
+    list of nested structures.
+    """
+    if len(coords) == 0:
+        return 0
+    if not isinstance(coords[0], (list, tuple)):
+        pairs.append(coords)
+        return None
+    if not isinstance(coords[0][0], (list, tuple)):
+        pairs.extend(coords)
+        return len(coords)
+    return [_flatten_coords(c, pairs) for c in coords]
+
+
+def _rebuild_coords(structure, pairs):
+    """ Inverse of :func:`_flatten_coords`, consuming ``pairs`` (an iterator). """
+    if structure is None:
+        return next(pairs)
+    if isinstance(structure, int):
+        return list(itertools.islice(pairs, structure))
+    return [_rebuild_coords(s, pairs) for s in structure]
+
+
+def _round_coords(values, decimals=5):
+    """
+    Rounds an array the same way as Python's built-in :func:`round`.
+
+    :func:`numpy.round` scales, rounds and unscales, which can pick a
+    different neighbor than the exact decimal rounding of :func:`round` when a
+    value sits (to within floating point error) on a rounding boundary. Those
+    few values are rounded with :func:`round` instead.
+    """
+    rounded = np.round(values, decimals)
+    scaled = values * 10.0 ** decimals
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if ties.any():
+        rounded[ties] = [round(v, decimals) for v in values[ties].tolist()]
+    return rounded
+
+
+def georegister_features(features, bounds, tilesize):
+    """
+    Scales the tile-relative coordinates of decoded vector tile features to
+    the lat/lon bounds of the tile, in place.
+
+    All vertices of all features are gathered into one array so that the
+    scaling is a single vectorized operation per tile.
+
+    Parameters
+    ----------
+    features : list
+        GeoJSON-like feature dicts, as returned by :meth:`mapbox_vector_tile.decode`
+    bounds : Object returned by mercantile.bounds() function
+        Has north, south, east, west attributes indicating lat/lon bounds
+    tilesize : int
+        Size of the tile returned by the tile server in pixels
+
+    Returns
+    -------
+    features : list
+        The same features, with coordinates in EPSG 4326 rounded to 5 decimals
+    """
+    pairs = []
+    structures = [_flatten_coords(f['geometry']['coordinates'], pairs) for f in features]
+    if not pairs:
+        return features
+
+    coords = np.asarray(pairs, dtype=np.float64)
+    # Same operation order as the scalar formula, so the results are identical
+    coords[:, 0] = coords[:, 0] / float(tilesize) * (bounds.east - bounds.west) + bounds.west
+    coords[:, 1] = coords[:, 1] / float(tilesize) * (bounds.north - bounds.south) + bounds.south
+    coords = _round_coords(coords)
+
+    # Rebuilding allocates millions of small lists on dense tiles; the cyclic
+    # garbage collector would otherwise rescan them over and over
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        scaled = iter(coords.tolist())
+        for feature, structure in zip(features, structures):
+            feature['geometry']['coordinates'] = _rebuild_coords(structure, scaled)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return features
+
+
+def decode_protobuf_layers_to_geojson_wgs84(tile, layernames, bounds, tilesize):
     """
     Decodes a Google protobuf binary object representing a vector tile return
-    from a MapBox tile server into a vector represented as a geoJSON dict in
-    EPSG 4326 (WGS 84) map projection.
-    
+    from a MapBox tile server once, and pulls out each of the requested layers
+    as a geoJSON dict in EPSG 4326 (WGS 84) map projection.
+
     Parameters
     ----------
     tile : Google protobuf binary
         Object returned from Mapbox vector tile server
-    layername : str
-        Name of the layer to pull out of response
+    layernames : list
+        Names (str) of the layers to pull out of response
     bounds : Object returned by mercantile.bounds() function
         Has north, south, east, west attributes indicating lat/lon bounds
     tilesize : int
@@ -119,66 +260,59 @@ def decode_protobuf_to_geojson_wgs84(tile, layername, bounds, tilesize):
 
     Returns
     -------
-    data : dict
-        Dict representing GeoJSON data
+    layers : dict
+        Maps each layer name present in the tile to a dict representing its
+        GeoJSON data. Layers missing from the tile are left out.
     """
 
-    def process_coord_pair(coord_pair):
-        """ Scales relative coordinates to known lat/lon bounds. """
-        return [
-            round(float(coord_pair[0]) / float(tilesize) * (
-                        bounds.east - bounds.west) + bounds.west, 5),
-            round(float(coord_pair[1]) / float(tilesize) * (
-                        bounds.north - bounds.south) + bounds.south, 5)
-        ]
-
-    # Decode to dict and pull out the GeoJSON for the target layer
+    # Decode to dict and pull out the GeoJSON for the target layers
     data_decoded = mapbox_vector_tile.decode(tile)
     #logger.debug(list(data_decoded.keys()))
-    if layername not in data_decoded:
-        logger.debug(f'\t\tLayer name "{layername}" not present in this data. Skipping...')
-        return None
 
-    data = data_decoded[layername]
+    layers = {}
+    for layername in layernames:
+        if layername not in data_decoded:
+            logger.debug(f'\t\tLayer name "{layername}" not present in this data. Skipping...')
+            continue
 
-    # Unwrap the geometry and scale coordinates to the lat/lon bounds
-    fnews = []
-    for feature in data['features']:
-        fnew = copy.deepcopy(feature)
-        #logger.debug(fnew)
-        coords = fnew['geometry']['coordinates']
-        coords_new = []
+        data = data_decoded[layername]
 
-        # Process coords for lines
-        if fnew['geometry']['type'] == 'LineString':
-            #line_new = []
-            for coord_pair in coords:
-                coords_new.append(process_coord_pair(coord_pair))
+        # Unwrap the geometry and scale coordinates to the lat/lon bounds. The
+        # decoded dict is ours, so the features are updated in place.
+        georegister_features(data['features'], bounds, tilesize)
+        layers[layername] = data
 
+    return layers
 
-        # Process coords for polygons
-        else:
-            for poly in coords:
-                poly_new = []
-                for part in poly:
-                    if type(part[0]) == list:
-                        part_new = []
-                        for coord_pair in part:
-                            part_new.append(process_coord_pair(coord_pair))
-                        poly_new.append(part_new)
-                    else:
-                        poly_new.append(process_coord_pair(part))
-                coords_new.append(poly_new)
 
-        fnew['geometry']['coordinates'] = coords_new
-        fnews.append(fnew)
-
-    data['features'] = fnews
+def decode_protobuf_to_geojson_wgs84(tile, layername, bounds, tilesize):
+    """
+    Decodes a Google protobuf binary object representing a vector tile return
+    from a MapBox tile server into a vector represented as a geoJSON dict in
+    EPSG 4326 (WGS 84) map projection.
+    
+    Parameters
+    ----------
+    tile : Google protobuf binary
+        Object returned from Mapbox vector tile server
+    layername : str
+        Name of the layer to pull out of response
+    bounds : Object returned by mercantile.bounds() function
+        Has north, south, east, west attributes indicating lat/lon bounds
+    tilesize : int
+        Size of the tile returned by the tile server in pixels
 
-    return data
+    Returns
+    -------
+    data : dict
+        Dict representing GeoJSON data
+    """
+    layers = decode_protobuf_layers_to_geojson_wgs84(tile, [layername], bounds, tilesize)
+    return layers.get(layername)
 
 
-def process_tiles(tiles, tile_indices, outdir, layername, tilesize):
+def process_tiles(tiles, tile_indices, outdir, layername, tilesize,
+                  return_features=False):
     """
     Convert Mapbox tiles to a format that can be used by QGIS in standard
     processing operations. This implementation converts to GeoJSON vector
@@ -193,47 +327,67 @@ def process_tiles(tiles, tile_indices, outdir, layername, tilesize):
         ``[z,x,y]`` where ``z`` is zoom; ``x``,``y`` are image indices.
     outdir : str or Path
         Directory in which to save outputs
-    layername : str
-        Name of the layer to pull out of response
+    layername : str or list
+        Name of the layer to pull out of response, or a list of layer names.
+        With a list, each tile is decoded only once for all of the layers and
+        each layer's files are written to its own ``outdir/<layername>``
+        subdirectory.
     tilesize : int
         Size of the tile returned by the tile server in pixel
+    return_features : bool, optional
+        If True, return the decoded GeoJSON dicts themselves instead of file
+        paths, so they can be handed straight to
+        :func:`dissolve_vector_files_by_property`. ``outdir`` may then be
+        ``None`` to skip writing files altogether; otherwise the files are
+        still written, e.g. for debugging.
 
     Returns
     -------
-    js_paths : list
-        List of str's representing output geojson file paths
+    js_paths : list or dict
+        List of str's representing output geojson file paths, or of GeoJSON
+        dicts if ``return_features`` is True. If ``layername`` is a list, a
+        dict mapping each layer name to its list.
     """
-    # TODO: could potentially be useful to return in-memory objects
-    #       instead of / in addition to writing the output to files
+    if outdir is None and not return_features:
+        raise ValueError("outdir is required unless return_features is True")
 
-    js_paths = []
+    multi_layer = not isinstance(layername, str)
+    layernames = list(layername) if multi_layer else [layername]
+    js_paths = {name: [] for name in layernames}
 
     # Process each tile
     for tile_index, tile in zip(tile_indices, tiles):
         tile_str = [str(x) for x in tile_index]
 
-        # # Set paths to output files
-        basename = Path(outdir, "-".join(tile_str))
-        js_path = basename.with_suffix(".json")
-
         # Get lat/lon bounds of a tile by [z,x,y] indices
         bounds = mercantile.bounds((tile_index[1], tile_index[2], tile_index[0]))
 
         # Convert to GeoJSON and georegister by scaling to tile bounds
-        data = decode_protobuf_to_geojson_wgs84(tile, layername, bounds, tilesize)
+        layers = decode_protobuf_layers_to_geojson_wgs84(tile, layernames, bounds, tilesize)
 
-        if not data:
-            continue
+        for name, data in layers.items():
+            if return_features:
+                js_paths[name].append(data)
+                if outdir is None:
+                    continue
 
-        # Save the GeoJSON to file
-        if not js_path.exists():
-            js_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(js_path, 'w') as f:
-            f.write(json.dumps(data))
+            # # Set paths to output files
+            if multi_layer:
+                basename = Path(outdir, name, "-".join(tile_str))
+            else:
+                basename = Path(outdir, "-".join(tile_str))
+            js_path = basename.with_suffix(".json")
 
-        js_paths.append(js_path)
+            # Save the GeoJSON to file
+            if not js_path.exists():
+                js_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(js_path, 'w') as f:
+                f.write(json.dumps(data))
 
-    return js_paths
+            if not return_features:
+                js_paths[name].append(js_path)
+
+    return js_paths if multi_layer else js_paths[layername]
 
 
 
@@ -262,7 +416,7 @@ def get_tile_xyz_by_ll(lat,lon,zoom_level=7):
     return mercantile.tile(lon,lat,zoom_level)
 
 
-def get_tiles_for_ll_bounds(n,s,e,w,zoom_level=7):
+def get_tiles_for_ll_bounds(n,s,e,w,zoom_level=7,aoi=None):
     """
     Takes in latitude and longitude bounds and returns a list of tiles (defined
     by [z,x,y] indices) for the provided zoom_level within those bounds.
@@ -278,6 +432,9 @@ def get_tiles_for_ll_bounds(n,s,e,w,zoom_level=7):
 
     zoom_level : int
         Vector tile server zoom level (higher = more zoomed in)
+    aoi : shapely.Geometry, optional
+        Area of interest in lat/lon (EPSG 4326). If given, only tiles that
+        intersect it are returned, rather than every tile in its bbox.
 
     Returns
     -------
@@ -295,53 +452,332 @@ def get_tiles_for_ll_bounds(n,s,e,w,zoom_level=7):
 
     Notes
     -----
-    :meth:`mercantile.tile` returns just a single tile by a point lat/lon, so in
-    order to get ALL tiles within a bounding box, we have to iterate searches
-    over a grid of lat/lon point within the bounds. Only the unique set of tiles
-    is retained. Grid size is determined by ``zoom_level``:
+    The x/y index range covering the bbox is computed directly from its
+    corners (:meth:`mercantile.tiles`), so every zoom level is exact and
+    planning is proportional to the number of tiles. A bbox with ``w > e``
+    is taken to cross the antimeridian. Latitudes are clamped to the web
+    mercator limits of +/-85.0511 degrees.
+    """
+    tiles = mercantile.tiles(w, s, e, n, zoom_level)
+    tile_indices = [[t.z, t.x, t.y] for t in tiles]
+
+    if aoi is not None and tile_indices:
+        # Keep only the tiles whose footprint touches the AOI itself
+        tile_bounds = np.array([
+            mercantile.bounds(x, y, z) for z, x, y in tile_indices
+        ])
+        footprints = shapely.box(
+            tile_bounds[:, 0], tile_bounds[:, 1], tile_bounds[:, 2], tile_bounds[:, 3]
+        )
+        # Prepare a copy, leaving the caller's geometry as it was
+        aoi = shapely.from_wkb(shapely.to_wkb(aoi))
+        shapely.prepare(aoi)
+        keep = shapely.intersects(aoi, footprints)
+        tile_indices = [t for t, k in zip(tile_indices, keep) if k]
 
-    .. table::
+    logger.debug(f"{len(tile_indices)} tiles at zoom level {zoom_level}")
 
-        ==========  ===============  =========================
-        Zoom level  Tile size        Grid resolution
-        ==========  ===============  =========================
-        5           11 - 18 degrees  10 degrees
-        6           5 -  9 degrees   4 degrees
-        7           2 -  3 degrees   1 degree (~100 km)
-        8           ? -  ? degrees   0.25 degree (~25 km)
-        9                            0.0625 degrees (~6.25 km)
-        10                           0.016 degrees (~1.6 km)
-        11                           0.004 degrees (~400 m)
-        ==========  ===============  =========================
-
-    """
-    logger.debug("testing the log")
-
-    # Default search grid resolution
-    grid_res_degrees = 10
-
-    # Dict mapping zoom level (int) to grid resolution (degrees)
-    zoom_to_gridres = {
-        6: 4,
-        7: 1,
-        8: 0.25,
-        9: 0.0625,
-        10: 0.016,
-        11: 0.004
-    }
+    return tile_indices
+
+
+# Observed georegistration precision at zoom level 4, in metres (see the
+# table in :func:`download_tiles`); it halves with each further zoom level
+PRECISION_AT_ZOOM_4 = 15000.0
+
+
+def zoom_level_for_precision(precision, lat=0.0):
+    """
+    Lowest zoom level whose tiles georegister vertices to within
+    ``precision`` metres at latitude ``lat``.
+
+    Tiles shrink on the ground by ``cos(lat)`` away from the equator, so
+    high latitudes reach the same precision at a lower zoom level.
+
+    Parameters
+    ----------
+    precision : float
+        Required precision in metres
+    lat : float or ndarray, optional
+        Latitude in degrees
+
+    Returns
+    -------
+    zoom_level : int or ndarray
+    """
+    scale = np.cos(np.radians(np.clip(lat, -85.0511287798, 85.0511287798)))
+    zoom = 4 + np.ceil(np.log2(PRECISION_AT_ZOOM_4 * scale / precision) - 1e-9)
+    return np.maximum(zoom, 0).astype(int)
+
+
+def get_adaptive_tiles_for_ll_bounds(n, s, e, w, precision, max_tiles=None,
+                                     min_zoom=4, max_zoom=14, aoi=None):
+    """
+    Selects tiles at mixed zoom levels covering a lat/lon bounding box, each
+    at the lowest zoom level that reaches the requested precision.
+
+    Starting from ``min_zoom``, tiles are split into their four children
+    until they reach the zoom level :func:`zoom_level_for_precision` gives
+    for the tile's latitude nearest the equator (where precision is worst).
+    Only children that intersect the bbox (and ``aoi``) are kept, so the
+    coverage has no gaps or overlaps and the tile count stays near the
+    minimum for the precision. If more than ``max_tiles`` tiles would be
+    needed, the precision is relaxed by factors of two until they fit.
+
+    Parameters
+    ----------
+    n : float
+        Latitude indicating northern bounds of BBOX
+    s : float
+        Latitude indicating southern bounds of BBOX
+    e : float
+        Longitude indicating eastern bounds of BBOX
+    w : float
+        Longitude indicating western bounds of BBOX
+    precision : float
+        Target georegistration precision in metres
+    max_tiles : int, optional
+        Tile budget
+    min_zoom : int, optional
+        Coarsest zoom level to use
+    max_zoom : int, optional
+        Finest zoom level to use
+    aoi : shapely.Geometry, optional
+        Area of interest in lat/lon (EPSG 4326); only tiles that intersect it
+        are returned
+
+    Returns
+    -------
+    tile_indices : list
+        ``[z,x,y]`` tile indices, possibly at several zoom levels
+    """
+    if aoi is not None:
+        # Prepare a copy, leaving the caller's geometry as it was
+        aoi = shapely.from_wkb(shapely.to_wkb(aoi))
+        shapely.prepare(aoi)
+
+    def covering(tiles):
+        # Drop the tiles that miss the bbox (which may cross the
+        # antimeridian) or the AOI
+        if not tiles:
+            return tiles
+        tw, ts, te, tn = np.array([mercantile.bounds(t) for t in tiles]).T
+        keep = (ts < n) & (tn > s)
+        if w <= e:
+            keep &= (tw < e) & (te > w)
+        else:
+            keep &= (te > w) | (tw < e)
+        if aoi is not None:
+            keep &= shapely.intersects(aoi, shapely.box(tw, ts, te, tn))
+        return [t for t, k in zip(tiles, keep) if k]
+
+    def select(relax):
+        tiles = covering(list(mercantile.tiles(w, s, e, n, min_zoom)))
+        selected = []
+        while tiles:
+            _, ts, _, tn = np.array([mercantile.bounds(t) for t in tiles]).T
+            # Latitude of each tile nearest the equator
+            lat = np.where(ts * tn <= 0, 0.0, np.minimum(np.abs(ts), np.abs(tn)))
+            needed = np.clip(
+                zoom_level_for_precision(precision * relax, lat), min_zoom, max_zoom
+            )
+            children = []
+            for tile, zoom in zip(tiles, needed):
+                if tile.z >= zoom:
+                    selected.append(tile)
+                else:
+                    children += mercantile.children(tile)
+            tiles = covering(children)
+        return selected
+
+    relax = 1
+    tiles = select(relax)
+    while max_tiles is not None and len(tiles) > max_tiles \
+            and any(t.z > min_zoom for t in tiles):
+        relax *= 2
+        tiles = select(relax)
+    if relax > 1:
+        logger.warning(
+            f"Relaxed the precision to {precision * relax:g} m to stay within "
+            f"{max_tiles} tiles"
+        )
 
-    if zoom_level in zoom_to_gridres:
-        grid_res_degrees = zoom_to_gridres[zoom_level]
+    tile_indices = [[t.z, t.x, t.y] for t in tiles]
+    logger.debug(
+        f"{len(tile_indices)} tiles at zoom levels "
+        f"{sorted(set(t[0] for t in tile_indices))}"
+    )
+    return tile_indices
 
-    # Gather tiles within the bounds
-    tiles = []
-    for lon in np.arange(w,e+grid_res_degrees,grid_res_degrees):
-        for lat in np.arange(s,n+grid_res_degrees,grid_res_degrees):
-            tiles.append(get_tile_xyz_by_ll(lat,lon,zoom_level))
 
-    # Return the set (unique tiles), formatted for input to process_tiles
-    return [[x.z,x.x,x.y] for x in set(tiles)]
 
+def infer_property_schema(features):
+    """
+    Infers a fiona schema ``properties`` mapping from GeoJSON-like features,
+    in the same way fiona types the fields of a GeoJSON file.
+
+    Parameters
+    ----------
+    features : list
+        GeoJSON-like feature dicts
+
+    Returns
+    -------
+    properties : dict
+        Maps each property name to ``'int'``, ``'float'``, ``'bool'`` or
+        ``'str'``. Properties with mixed int and float values are ``'float'``;
+        any other mix is ``'str'``.
+    """
+    type_names = {bool: 'bool', int: 'int', float: 'float', str: 'str'}
+    properties = {}
+    for feature in features:
+        for key, value in feature['properties'].items():
+            if value is None:
+                properties.setdefault(key, None)
+                continue
+            type_name = type_names.get(type(value), 'str')
+            current = properties.get(key)
+            if current is None or current == type_name:
+                properties[key] = type_name
+            elif {current, type_name} == {'int', 'float'}:
+                properties[key] = 'float'
+            else:
+                properties[key] = 'str'
+    return {key: value or 'str' for key, value in properties.items()}
+
+
+def snap_to_tile_seams(geoms, zoom_level, tilesize=4096, tolerance=1.0):
+    """
+    Snaps vertices lying on or next to tile boundaries onto the boundary.
+
+    Features cut by adjacent vector tiles are georegistered separately for
+    each tile and rounded, so vertices along a shared tile edge rarely line
+    up exactly, which leaves slivers after the union. Each coordinate within
+    ``tolerance`` tile pixels (or one unit of the 5-decimal rounding) of a
+    tile grid line at ``zoom_level`` is moved to the rounded grid line, so
+    both sides of a seam share exactly the same values.
+
+    Parameters
+    ----------
+    geoms : array-like
+        Shapely geometries in lat/lon (EPSG 4326)
+    zoom_level : int
+        Zoom level of the tiles the geometries were decoded from
+    tilesize : int, optional
+        Size of the tiles in pixels
+    tolerance : float, optional
+        Snapping distance in tile pixels
+
+    Returns
+    -------
+    snapped : ndarray
+        Object array of snapped shapely geometries, with repeated points
+        created by the snapping removed
+    """
+    num_tiles = 2 ** zoom_level
+    # Rounding precision of georegistered coordinates
+    precision = 1e-5
+
+    def snap_lon(lon):
+        tx = (lon + 180.0) / 360.0 * num_tiles
+        k = np.round(tx)
+        seam = np.round(k / num_tiles * 360.0 - 180.0, 5)
+        near = (np.abs(tx - k) * tilesize <= tolerance) | (np.abs(lon - seam) <= precision)
+        return np.where(near, seam, lon)
+
+    def snap_lat(lat):
+        lat_rad = np.radians(np.clip(lat, -85.0511287798, 85.0511287798))
+        ty = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * num_tiles
+        k = np.round(ty)
+        seam = np.round(np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * k / num_tiles)))), 5)
+        near = (np.abs(ty - k) * tilesize <= tolerance) | (np.abs(lat - seam) <= precision)
+        return np.where(near, seam, lat)
+
+    def snap(coords):
+        return np.column_stack([snap_lon(coords[:, 0]), snap_lat(coords[:, 1])])
+
+    snapped = shapely.transform(np.asarray(geoms, dtype=object), snap)
+    return shapely.remove_repeated_points(snapped)
+
+
+def _union_group(geoms):
+    """ Repairs and unions the geometries of one group (process pool worker). """
+    return shapely.union_all(shapely.make_valid(np.asarray(geoms, dtype=object)))
+
+
+def union_geometry_groups(geom_groups, num_workers=1):
+    """
+    Makes the geometries in each group valid and unions them, one group at a
+    time, optionally spreading the groups over a process pool.
+
+    Parameters
+    ----------
+    geom_groups : list
+        Sequences of shapely geometries, one per group
+    num_workers : int, optional
+        Number of worker processes. ``1`` runs in this process.
+
+    Returns
+    -------
+    unions : list
+        One shapely geometry per group, in the order of ``geom_groups``
+    """
+    if num_workers <= 1 or len(geom_groups) <= 1:
+        return [_union_group(geoms) for geoms in geom_groups]
+
+    # Send groups in batches so many small groups don't each cost a round trip
+    chunksize = max(1, len(geom_groups) // (num_workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(_union_group, geom_groups, chunksize=chunksize))
+
+
+def clip_geometries_to_bbox(geoms, n, s, e, w):
+    """
+    Clips geometries to a lat/lon BBOX.
+
+    The bounds of all geometries are compared with the BBOX first, so only
+    the geometries that cross its edges are actually intersected with it.
+    Geometries entirely inside are returned as they are, and geometries
+    entirely outside are returned empty. A BBOX with ``w > e`` crosses the
+    antimeridian and is split into its two halves.
+
+    Parameters
+    ----------
+    geoms : array-like
+        Shapely geometries
+    n : float
+        Latitude indicating northern bounds of BBOX used to clip features
+    s : float
+        Latitude indicating southern bounds of BBOX used to clip features
+    e : float
+        Longitude indicating eastern bounds of BBOX used to clip features
+    w : float
+        Longitude indicating western bounds of BBOX used to clip features
+
+    Returns
+    -------
+    clipped : ndarray
+        Object array of the clipped shapely geometries, in input order
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    if w > e:
+        boxes = [(w, s, 180.0, n), (-180.0, s, e, n)]
+    else:
+        boxes = [(w, s, e, n)]
+    bbox_geom = shapely.union_all([shapely.box(*b) for b in boxes])
+
+    minx, miny, maxx, maxy = shapely.bounds(geoms).T
+    inside = np.zeros(len(geoms), dtype=bool)
+    outside = np.ones(len(geoms), dtype=bool)
+    for bw, bs, be, bn in boxes:
+        inside |= (minx >= bw) & (maxx <= be) & (miny >= bs) & (maxy <= bn)
+        outside &= (maxx < bw) | (minx > be) | (maxy < bs) | (miny > bn)
+    crossing = ~(inside | outside)
+    logger.debug(f"Clipping {crossing.sum()} of {len(geoms)} geometries to the bbox")
+
+    clipped = geoms.copy()
+    clipped[outside] = shapely.Polygon()
+    clipped[crossing] = shapely.intersection(geoms[crossing], bbox_geom)
+    return clipped
 
 
 def dissolve_vector_files_by_property(
@@ -349,7 +785,14 @@ def dissolve_vector_files_by_property(
         property_name,
         valid_geom_types,
         output_file,
-        n=None,s=None,e=None,w=None
+        n=None,s=None,e=None,w=None,
+        num_workers=1,
+        streaming=False,
+        batch_size=1000,
+        spill_dir=None,
+        output_format=None,
+        seam_zoom_level=None,
+        seam_tolerance=1.0
     ):
     """
     Takes in a list of geospatial vector files and outputs a single vector file
@@ -362,7 +805,9 @@ def dissolve_vector_files_by_property(
     Parameters
     ----------
     vector_files : list
-        List of str's representing geojson file paths
+        List of str's representing geojson file paths, or of GeoJSON
+        FeatureCollection dicts (e.g. from :func:`process_tiles` with
+        ``return_features=True``) in EPSG 4326
     property_name : str
         Name of the feature property in the geoJSON to dissolve features by
     valid_geom_types : list of str's
@@ -377,6 +822,34 @@ def dissolve_vector_files_by_property(
         Longitude indicating eastern bounds of BBOX used to clip features
     w : float, optional
         Longitude indicating western bounds of BBOX used to clip features
+    num_workers : int, optional
+        Number of processes to spread the per-group validation and union
+        over. ``1`` (the default) runs everything in this process, which is
+        also what should be used from inside QGIS.
+    streaming : bool, optional
+        Bound memory use for very large inputs. Features are read one input
+        at a time and spilled to a temporary file partitioned by
+        ``property_name``, and each group is then unioned incrementally and
+        written before the next one is read. ``num_workers`` is ignored.
+    batch_size : int, optional
+        In streaming mode, the number of geometries unioned at a time
+    spill_dir : str or Path, optional
+        In streaming mode, directory for the temporary spill file
+    output_format : str, optional
+        ``'GeoJSON'``, ``'GeoParquet'`` or ``'FlatGeobuf'``. By default taken
+        from the extension of ``output_file`` (``.parquet``, ``.fgb``), and
+        otherwise the same format as the inputs. The columnar formats are
+        written in bulk; FlatGeobuf includes a packed spatial index for fast
+        bbox reads.
+    seam_zoom_level : int or list, optional
+        Zoom level of the vector tiles the features were decoded from, or a
+        list with the zoom level of each entry of ``vector_files`` when the
+        tiles are at mixed zoom levels. If given, vertices along tile
+        boundaries are snapped together before the union (see
+        :func:`snap_to_tile_seams`), so features split across adjacent tiles
+        merge without slivers.
+    seam_tolerance : float, optional
+        Seam snapping distance in tile pixels
 
     Notes
     -----
@@ -388,88 +861,283 @@ def dissolve_vector_files_by_property(
         logger.debug('No vector data to dissolve, skipping...')
         return
 
-    # If clip bounds are provided, create the bbox geometry to clip to
-    bbox_geom = None
-    if n and s and e and w:
-        bbox_geom = Polygon((
-            (w,n),
-            (w,s),
-            (e,s),
-            (e,n),
-            (w,n),
-        ))
-
-    # Collect geometry features from all the input files
+    clip = None not in (n, s, e, w)
+
+    # Tile-edge stitching ahead of the union, at the zoom of each input
+    if isinstance(seam_zoom_level, (list, tuple, np.ndarray)):
+        seam_zooms = list(seam_zoom_level)
+    else:
+        seam_zooms = [seam_zoom_level] * len(vector_files)
+
+    def snapper(zoom):
+        if zoom is None:
+            return None
+        return lambda geoms: snap_to_tile_seams(geoms, zoom, tolerance=seam_tolerance)
+
+    if streaming:
+        with FeatureSpill(property_name, spill_dir) as spill:
+            # One pass over the inputs to partition the features on disk
+            meta = None
+            for vector_file, zoom in zip(vector_files, seam_zooms):
+                if isinstance(vector_file, dict):
+                    spill.add(vector_file['features'], snapper(zoom))
+                    continue
+                with fiona.open(vector_file) as invector:
+                    meta = invector.meta
+                    spill.add(invector, snapper(zoom))
+
+            # Then union and write out one group at a time
+            dissolve_feature_spill(
+                spill, valid_geom_types, output_file, n, s, e, w,
+                batch_size=batch_size, output_format=output_format, meta=meta
+            )
+        return
+
+    # Collect geometry features from all the input files, along with the
+    # seam zoom level of the input each one came from
     features = []
-    for vector_file in vector_files:
+    zooms = []
+    in_memory = []
+    in_memory_zooms = []
+    meta = None
+    for vector_file, zoom in zip(vector_files, seam_zooms):
+        if isinstance(vector_file, dict):
+            in_memory += vector_file['features']
+            in_memory_zooms += [zoom] * len(vector_file['features'])
+            continue
         with fiona.open(vector_file) as invector:
             meta = invector.meta
-            features += invector
+            file_features = list(invector)
+        features += file_features
+        zooms += [zoom] * len(file_features)
+
+    if meta is None or (in_memory and not features):
+        meta = _in_memory_meta(in_memory)
+    features += in_memory
+    zooms += in_memory_zooms
 
     # Sort the features by the property
-    e = sorted(features, key=lambda k: k['properties'][property_name])
+    sorted_features = sorted(
+        zip(features, zooms), key=lambda k: k[0]['properties'][property_name]
+    )
 
-    # Loop through and combine geometry features by group property
-    features_new = [] # var to store the dissolved features
+    # Gather the geometries of each group of features sharing the property
+    group_properties = []
+    group_geoms = []
+    geom_zooms = []
     for key, group in itertools.groupby(
-            e, key=lambda x: x['properties'][property_name]
+            sorted_features, key=lambda x: x[0]['properties'][property_name]
         ):
+        properties, geom, zoom = zip(
+            *[(feature['properties'], shape(feature['geometry']), zoom)
+              for feature, zoom in group]
+        )
+        group_properties.append(properties[0])
+        group_geoms.append(geom)
+        geom_zooms += zoom
+
+    if any(zoom is not None for zoom in seam_zooms):
+        group_sizes = [len(geom) for geom in group_geoms]
+        snapped = np.asarray(list(itertools.chain.from_iterable(group_geoms)), dtype=object)
+        geom_zooms = np.asarray(geom_zooms, dtype=object)
+        for zoom in set(seam_zooms) - {None}:
+            at_zoom = geom_zooms == zoom
+            snapped[at_zoom] = snapper(zoom)(snapped[at_zoom])
+        group_geoms = np.split(snapped, np.cumsum(group_sizes)[:-1])
+
+    # Repair and combine the coordinates of each group into a single feature
+    unions = union_geometry_groups(group_geoms, num_workers=num_workers)
+
+    # Perform the clip here
+    if clip:
+        unions = clip_geometries_to_bbox(unions, n, s, e, w)
+
+    _write_dissolved_features(
+        zip(group_properties, unions), meta, valid_geom_types, output_file,
+        output_format
+    )
+
+
+def dissolve_feature_spill(spill, valid_geom_types, output_file,
+                           n=None, s=None, e=None, w=None, batch_size=1000,
+                           output_format=None, meta=None):
+    """
+    Unions the features of a :class:`~statmagic_backend.geo.feature_spill.FeatureSpill`
+    by its property and writes them out one group at a time, so that only
+    one group is held in memory. This is the second half of the streaming
+    mode of :func:`dissolve_vector_files_by_property`, for callers that
+    spill features as they are produced (e.g. one tile at a time).
+
+    Parameters
+    ----------
+    spill : FeatureSpill
+        Spilled features, partitioned by the property to dissolve by
+    valid_geom_types : list of str's
+        List of valid GeoJSON geometry types for the given layer
+    output_file : str
+        File path for the output file
+    n, s, e, w : float, optional
+        Lat/lon BBOX bounds by which to clip features. If not included,
+        features will not be clipped.
+    batch_size : int, optional
+        Number of geometries unioned at a time
+    output_format : str, optional
+        ``'GeoJSON'``, ``'GeoParquet'`` or ``'FlatGeobuf'``; see
+        :func:`dissolve_vector_files_by_property`
+    meta : dict, optional
+        fiona metadata (driver, crs, schema) of the inputs. By default
+        GeoJSON in EPSG 4326, with the schema inferred from the properties
+        that are written.
+    """
+    keys = spill.keys()
+    if meta is None:
+        meta = _in_memory_meta({'properties': spill.properties(key)} for key in keys)
 
-        properties, geom = zip(
-            *[(feature['properties'], make_valid(shape(feature['geometry'])))
-              for feature in group]
+    dissolved = (
+        (spill.properties(key), spill.union(key, batch_size))
+        for key in keys
+    )
+    if None not in (n, s, e, w):
+        dissolved = (
+            (properties, clip_geometries_to_bbox([g], n, s, e, w)[0])
+            for properties, g in dissolved
         )
+    _write_dissolved_features(
+        dissolved, meta, valid_geom_types, output_file, output_format
+    )
+
+
+def _in_memory_meta(features):
+    """ fiona metadata for writing GeoJSON-like features in EPSG 4326 """
+    return {
+        'driver': 'GeoJSON',
+        'crs': 'EPSG:4326',
+        'schema': {'properties': infer_property_schema(features)},
+    }
+
+
+# Columnar output formats, by file extension
+COLUMNAR_FORMATS = {
+    '.parquet': 'GeoParquet',
+    '.geoparquet': 'GeoParquet',
+    '.fgb': 'FlatGeobuf',
+}
+
 
-        # This function handles combining the coordinates into a single feature
-        g = mapping(unary_union(geom))
+def _finish_dissolved_features(dissolved, valid_geom_types):
+    """
+    Splits collections, drops empty and invalid geometry types, and promotes
+    single geometries to their Multi type.
 
-        # Perform the clip here
-        if bbox_geom:
-            g = json.loads(to_geojson(shape(g).intersection(bbox_geom)))
-        #logger.debug(g)
+    Parameters
+    ----------
+    dissolved : iterable
+        ``(properties, geometry)`` pairs, one per dissolved group
+    valid_geom_types : list of str's
+        List of valid GeoJSON geometry types for the given layer
+
+    Yields
+    ------
+    properties, geometry
+    """
+
+    # Loop through and finish the combined geometry features by group property
+    for properties, g in dissolved:
 
         # Wrap non-collections to resemble a collection so we don't need
         # multiple processing procedures for collections and non-collections
-        if g['type'] != 'GeometryCollection':
-           g = {'geometries': [g]}
-
+        parts = g.geoms if g.geom_type == 'GeometryCollection' else [g]
 
-        for g0 in g['geometries']:
+        for g0 in parts:
 
             # Skip empty features
-            if len(g0['coordinates']) == 0 or len(g0['coordinates'][0]) == 0:
+            if g0.is_empty:
                 continue
 
             # Skip lines and points
-            if g0['type'] not in valid_geom_types:#('Polygon','MultiPolygon','LineString'):
+            if g0.geom_type not in valid_geom_types:#('Polygon','MultiPolygon','LineString'):
                 continue
 
             # Convert any Polygon feature types to MultiPolygon (output file will
             # be MultiPolygon type; see below)
-            if g0['type'] == 'Polygon':
-                g0['type'] = 'MultiPolygon'
-                g0['coordinates'] = [g0['coordinates']]
-
-            if g0['type'] == 'LineString':
-                g0['type'] = 'MultiLineString'
-                g0['coordinates'] = [g0['coordinates']]
-
-            # Store newly created dissolved features
-            features_new.append({
-                'geometry': g0,
-                'properties': properties[0]
-            })
+            if g0.geom_type == 'Polygon':
+                g0 = MultiPolygon([g0])
+
+            if g0.geom_type == 'LineString':
+                g0 = MultiLineString([g0])
+
+            yield properties, g0
+
+
+def _write_dissolved_features(dissolved, meta, valid_geom_types, output_file,
+                              output_format=None):
+    """
+    Writes dissolved geometries to ``output_file``.
 
-            # Store type for writing output
-            gtype = g0['type']
+    GeoJSON is written through fiona one feature at a time, as they are
+    produced. GeoParquet and FlatGeobuf are written in bulk from arrays;
+    FlatGeobuf files include a packed spatial index.
+
+    Parameters
+    ----------
+    dissolved : iterable
+        ``(properties, geometry)`` pairs, one per dissolved group
+    meta : dict
+        fiona metadata (driver, crs, schema) of the inputs
+    valid_geom_types : list of str's
+        List of valid GeoJSON geometry types for the given layer
+    output_file : str
+        File path for the output file
+    output_format : str, optional
+        ``'GeoJSON'``, ``'GeoParquet'`` or ``'FlatGeobuf'``. By default taken
+        from the extension of ``output_file`` (``.parquet``/``.geoparquet``,
+        ``.fgb``), otherwise the driver of the inputs.
+    """
+    if output_format is None:
+        output_format = COLUMNAR_FORMATS.get(Path(output_file).suffix.lower())
+
+    finished = _finish_dissolved_features(dissolved, valid_geom_types)
 
     # Update the geometry type from Polygon to MultiPolygon so that it can
     # handle cases where adjacent tile coords don't line up precisely
     gtype = [x for x in valid_geom_types if 'Multi' in x][0]
+
+    if output_format in ('GeoParquet', 'FlatGeobuf'):
+        # Only needed for the columnar formats, so that GeoJSON output (e.g.
+        # from inside QGIS) does not pay for importing them
+        import geopandas as gpd
+        import pandas as pd
+
+        properties, geoms = [], []
+        for p, g in finished:
+            properties.append(dict(p))
+            geoms.append(g)
+        gdf = gpd.GeoDataFrame(
+            pd.DataFrame.from_records(
+                properties, columns=list(meta['schema']['properties'])
+            ),
+            geometry=np.array(geoms, dtype=object),
+            crs=meta['crs'] or 'EPSG:4326',
+        )
+        if output_format == 'GeoParquet':
+            gdf.to_parquet(output_file)
+        else:
+            gdf.to_file(
+                output_file, driver='FlatGeobuf', SPATIAL_INDEX='YES',
+                geometry_type=gtype
+            )
+        return
+
+    if output_format is not None:
+        meta = {**meta, 'driver': output_format}
     meta['schema']['geometry'] = gtype#'MultiPolygon'
     with fiona.open(output_file, 'w', **meta) as output:
-        for feature in features_new:
-            output.write(feature)
+        for properties, g0 in finished:
+            # Write newly created dissolved features
+            output.write({
+                'geometry': mapping(g0),
+                'properties': properties
+            })
 
 
 if __name__ == "__main__":
@@ -524,15 +1192,17 @@ if __name__ == "__main__":
 
     mapbox_tiles = download_tiles(tile_indices, "https://dev.macrostrat.org/tiles/", "carto")
 
+    # Decode each tile once for all of the layers
+    layer_js_paths = process_tiles(
+        mapbox_tiles, tile_indices, processing_dir,
+        [layer['layername'] for layer in layers], 4096
+    )
+
     for layer in layers:
         logger.debug(f'\n\tProcessing layer: {layer["layername"]}')
 
-        js_paths = process_tiles(
-            mapbox_tiles, tile_indices, processing_dir, layer['layername'], 4096
-        )
-
         dissolve_vector_files_by_property(
-            js_paths,
+            layer_js_paths[layer['layername']],
             layer['dissolve_by_property'],
             layer['valid_geom_types'],
             os.path.join(processing_dir,f'test_dissolve_{layer["layername"]}.json'),
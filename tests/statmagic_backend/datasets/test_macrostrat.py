@@ -0,0 +1,76 @@
+"""
+test_macrostrat - Test suite for downloading and dissolving Macrostrat units
+"""
+
+import asyncio
+
+import fiona
+import mapbox_vector_tile
+import mercantile
+from shapely.geometry import shape
+
+from statmagic_backend.datasets import macrostrat
+from statmagic_backend.geo.feature_spill import FeatureSpill
+from statmagic_backend.geo.transform import decode_protobuf_layers_to_geojson_wgs84
+
+
+TILE_INDICES = [[10, 240, 380], [10, 241, 380], [10, 242, 380]]
+
+
+def make_tile():
+    return mapbox_vector_tile.encode([{"name": "units", "features": [
+        {"geometry": "POLYGON((0 0,4096 0,4096 4096,0 4096,0 0))", "properties": {"map_id": 1}},
+        {"geometry": "POLYGON((100 100,200 100,200 200,100 100))", "properties": {"map_id": 2}},
+    ]}])
+
+
+def read_features(path):
+    with fiona.open(path) as src:
+        return sorted((f['properties']['map_id'], shape(f['geometry']).area) for f in src)
+
+
+def test_streaming_spills_each_tile_as_it_is_decoded(tmp_path, monkeypatch):
+    events = []
+    process_tiles = macrostrat.process_tiles
+    add = FeatureSpill.add
+
+    def recording_process_tiles(*args, **kwargs):
+        events.append('decode')
+        return process_tiles(*args, **kwargs)
+
+    def recording_add(self, features, transform=None):
+        events.append('spill')
+        return add(self, features, transform)
+
+    async def decoded_tiles(tile_indices, *args, **kwargs):
+        for tile_index in tile_indices:
+            events.append('decode')
+            bounds = mercantile.bounds(tile_index[1], tile_index[2], tile_index[0])
+            yield tile_index, decode_protobuf_layers_to_geojson_wgs84(make_tile(), ["units"], bounds, 4096)
+
+    monkeypatch.setattr(macrostrat, "_macrostrat_tiles", lambda *args: TILE_INDICES)
+    monkeypatch.setattr(macrostrat, "download_tiles", lambda tiles, *args, **kwargs: [make_tile() for _ in tiles])
+    monkeypatch.setattr(macrostrat, "process_tiles", recording_process_tiles)
+    monkeypatch.setattr(macrostrat, "iter_decoded_tiles", decoded_tiles)
+    monkeypatch.setattr(FeatureSpill, "add", recording_add)
+
+    tile_bounds = [mercantile.bounds(t[1], t[2], t[0]) for t in TILE_INDICES]
+    bounds = dict(n=tile_bounds[0].north, s=tile_bounds[0].south, e=tile_bounds[-1].east, w=tile_bounds[0].west)
+
+    macrostrat.macrostrat_from_bounds(bounds, tmp_path / "in_memory.json")
+    expected = read_features(tmp_path / "in_memory.json")
+    assert [map_id for map_id, _ in expected] == [1, 2]
+
+    # Each tile is spilled before the next one is decoded, so the decoded
+    # features of all the tiles are never held in memory at once
+    for name, run in [
+        ("sync.json", lambda path: macrostrat.macrostrat_from_bounds(bounds, path, streaming=True)),
+        ("async.json", lambda path: asyncio.run(macrostrat.macrostrat_from_bounds_async(bounds, path, streaming=True))),
+    ]:
+        events.clear()
+        run(tmp_path / name)
+        assert events == ['decode', 'spill'] * len(TILE_INDICES)
+        streamed = read_features(tmp_path / name)
+        assert [map_id for map_id, _ in streamed] == [1, 2]
+        for (_, area), (_, expected_area) in zip(streamed, expected):
+            assert abs(area - expected_area) < 1e-9
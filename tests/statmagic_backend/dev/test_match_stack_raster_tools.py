@@ -0,0 +1,534 @@
+"""
+test_match_stack_raster_tools - Test suite for matching rasters to a template
+"""
+
+import os
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import from_origin
+
+from statmagic_backend.dev.data_cube import (
+    PLACEHOLDER_TAG, append_band_files_to_data_cube, compact_data_cube, create_data_cube, export_data_cube,
+    is_placeholder_data_raster, new_band_file, read_cube_bands
+)
+from statmagic_backend.dev import match_stack_raster_tools
+from statmagic_backend.dev.layer_cache import LayerCache
+from statmagic_backend.dev.match_stack_raster_tools import (
+    COG_ENV, StackAssembler, StackingSession, add_matched_arrays_to_data_raster, add_selected_bands_from_source_raster_to_data_raster,
+    VirtualStack, build_overviews, drop_selected_layers_from_raster, lazy_match_cog, match_and_stack_rasters,
+    match_and_assemble_stack, match_cogList_to_template_andStack, match_raster_to_template,
+    parse_raster_processing_table_elements, reorder_array_lists_to_stack, select_overview_level, split_threads
+)
+
+
+NODATA = -999.0
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    """ UTM template with a nodata corner and a smooth two-band lat/lon input """
+    template_path = tmp_path / "template.tif"
+    template = np.ones((1, 300, 260), dtype='float32')
+    template[:, :40, :50] = NODATA
+    with rio.open(template_path, 'w', driver='GTiff', height=300, width=260, count=1,
+                  dtype='float32', crs='EPSG:32615', nodata=NODATA,
+                  transform=from_origin(400000, 4500000, 100, 100)) as dst:
+        dst.write(template)
+
+    input_path = tmp_path / "input.tif"
+    rows, cols = np.mgrid[0:400, 0:500]
+    data = np.stack([np.sin(cols / 50) + np.cos(rows / 50), rows / 400]).astype('float32')
+    with rio.open(input_path, 'w', driver='GTiff', height=400, width=500, count=2,
+                  dtype='float32', crs='EPSG:4326', nodata=NODATA,
+                  transform=from_origin(-94.3, 40.7, 0.001, 0.001)) as dst:
+        dst.write(data)
+
+    return template_path, input_path
+
+
+@pytest.mark.parametrize("resampling, atol", [(Resampling.nearest, 0.05), (Resampling.bilinear, 0.01)])
+def test_windowed_matches_full_read(rasters, tmp_path, resampling, atol):
+    template_path, input_path = rasters
+    full = match_raster_to_template(template_path, input_path, resampling, "all")
+
+    # A single block is the same warp as the full read
+    single = match_raster_to_template(template_path, input_path, resampling, "all", block_size=1000)
+    np.testing.assert_allclose(single, full, atol=1e-9)
+
+    # Smaller blocks differ only by GDAL's approximate transformer (< 1/8 px)
+    blocks = match_raster_to_template(template_path, input_path, resampling, "all", block_size=64)
+    np.testing.assert_allclose(blocks, full, atol=atol)
+
+    out = np.memmap(tmp_path / "out.dat", dtype='float64', mode='w+', shape=full.shape)
+    match_raster_to_template(template_path, input_path, resampling, "all", block_size=100, out=out)
+    np.testing.assert_allclose(out, full, atol=atol)
+
+    output_path = match_raster_to_template(template_path, input_path, resampling, 1,
+                                           block_size=128, output_path=tmp_path / "out.tif")
+    with rio.open(output_path) as src:
+        assert src.count == 1
+        np.testing.assert_allclose(src.read(), full[1:], atol=atol)
+        assert np.all(src.read(1)[:40, :50] == NODATA)
+
+
+@pytest.mark.parametrize("resampling", [Resampling.bilinear, Resampling.cubic, Resampling.lanczos])
+def test_windowed_seams_against_coarse_template(rasters, coarse_template, tmp_path, resampling):
+    _, input_path = rasters
+    noise_path = tmp_path / "noise.tif"
+    with rio.open(input_path) as src:
+        profile = src.profile
+    profile.update(count=1)
+    with rio.open(noise_path, 'w', **profile) as dst:
+        dst.write(np.random.default_rng(0).random((1, 400, 500), dtype='float32'))
+
+    # The kernels are widened by the ~12x downsampling, and so must the padding of each block
+    full = match_raster_to_template(coarse_template, noise_path, resampling, 0)
+    blocks = match_raster_to_template(coarse_template, noise_path, resampling, 0, block_size=4)
+    np.testing.assert_allclose(blocks, full, atol=0.004)
+
+
+def test_stacking_session_reads_template_once(rasters, monkeypatch):
+    template_path, input_path = rasters
+    session = StackingSession(template_path, block_size=7)
+    with rio.open(template_path) as src:
+        np.testing.assert_array_equal(session.mask(), src.read(1) == NODATA)
+    assert session._packed_mask.nbytes == 300 * 33
+
+    expected = match_raster_to_template(template_path, input_path, Resampling.bilinear, "all")
+    opened = []
+    rio_open = rio.open
+    monkeypatch.setattr(rio, "open", lambda path, *args, **kwargs: opened.append(path) or rio_open(path, *args, **kwargs))
+    stack = match_and_stack_rasters(template_path, [input_path] * 3, [Resampling.bilinear] * 3,
+                                    ["all", 0, 1], num_threads=2)
+    assert opened.count(template_path) == 1
+    np.testing.assert_array_equal(stack[0], expected)
+    np.testing.assert_array_equal(stack[1], expected[:1])
+    np.testing.assert_array_equal(stack[2], expected[1:])
+
+
+def test_split_threads():
+    assert split_threads(8, 2) == (2, 4)
+    assert split_threads(8, 20) == (8, 1)
+    assert split_threads(1, 5) == (1, 1)
+
+
+def test_process_backend_matches_threads(rasters):
+    template_path, input_path = rasters
+    args = (template_path, [input_path] * 3, [Resampling.bilinear] * 3, ["all", 0, 1])
+    threaded = match_and_stack_rasters(*args, num_threads=2)
+    processes = match_and_stack_rasters(*args, num_threads=2, backend="process")
+    assert [a.shape for a in processes] == [a.shape for a in threaded]
+    for p, t in zip(processes, threaded):
+        np.testing.assert_allclose(p, t, atol=1e-9)
+
+    # In the requested dtype, as views of the one shared stack rather than copies
+    processes = match_and_stack_rasters(*args, num_threads=2, backend="process", dtype='float32')
+    assert all(p.dtype == np.float32 for p in processes)
+    assert all(np.shares_memory(p, processes[0].base) for p in processes)
+    for p, t in zip(processes, threaded):
+        np.testing.assert_allclose(p, t, rtol=1e-6)
+
+
+def test_layer_cache_skips_matching(rasters, tmp_path, monkeypatch):
+    template_path, input_path = rasters
+    args = (template_path, [input_path] * 2, [Resampling.bilinear, Resampling.nearest], ["all", 0])
+    with LayerCache(tmp_path / "cache") as cache:
+        first = match_and_stack_rasters(*args, cache=cache)
+        assert cache.stats()["misses"] == 2 and cache.stats()["layers"] == 2
+
+        def fail(*args, **kwargs):
+            raise AssertionError("layer was matched again")
+        with monkeypatch.context() as m:
+            m.setattr(StackingSession, "match", fail)
+            second = match_and_stack_rasters(*args, cache=cache)
+        assert cache.stats()["hits"] == 2
+        for a, b in zip(first, second):
+            np.testing.assert_array_equal(a, b)
+
+        # Touching the input invalidates its layers
+        stat = os.stat(input_path)
+        os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        match_and_stack_rasters(*args, cache=cache)
+        assert cache.stats()["misses"] == 4
+
+        # Layers matched in another dtype are kept apart
+        single = match_and_stack_rasters(*args, cache=cache, dtype='float32')
+        assert cache.stats()["misses"] == 6
+        assert all(a.dtype == np.float32 for a in single)
+
+
+def test_layer_cache_lru_eviction(rasters, tmp_path):
+    template_path, input_path = rasters
+    session = StackingSession(template_path)
+    layer = np.zeros((1, session.height, session.width))
+    with LayerCache(tmp_path / "cache") as cache:
+        cache.put("a", layer + 1, session)
+        size = cache.stats()["bytes"]
+        cache.max_bytes = 2 * size + size // 2
+        cache.put("b", layer + 2, session)
+        cache.get("a")  # make "b" least recent
+        cache.put("c", layer + 3, session)
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert len(list((tmp_path / "cache").glob("*.tif"))) == 2
+
+
+def test_data_cube_appends_only_new_bands(rasters, tmp_path):
+    template_path, input_path = rasters
+    cube_path = tmp_path / "cube.vrt"
+    create_data_cube(template_path, cube_path)
+    layers = match_and_stack_rasters(template_path, [input_path], [Resampling.nearest], ["all"])[0]
+
+    # The placeholder band is replaced by the first layers added
+    add_matched_arrays_to_data_raster(cube_path, layers, ["a", "b"])
+    first_files = {f for f, _ in read_cube_bands(cube_path)}
+    first_mtimes = {f: os.stat(f).st_mtime_ns for f in first_files}
+    add_matched_arrays_to_data_raster(cube_path, layers[:1] * 2, ["c"])
+
+    bands = read_cube_bands(cube_path)
+    assert [d for _, d in bands] == ["a", "b", "c"]
+    assert {f: os.stat(f).st_mtime_ns for f in first_files} == first_mtimes
+
+    export_data_cube(cube_path, tmp_path / "cube.tif")
+    with rio.open(cube_path) as cube, rio.open(tmp_path / "cube.tif") as exported:
+        assert cube.count == exported.count == 3
+        assert exported.descriptions == ("a", "b", "c")
+        np.testing.assert_array_equal(exported.read(), cube.read())
+        np.testing.assert_array_equal(cube.read([1, 2]), layers.astype('float32'))
+
+
+def test_drop_layers_from_data_cube(rasters, tmp_path):
+    template_path, input_path = rasters
+    cube_path = tmp_path / "cube.vrt"
+    create_data_cube(template_path, cube_path)
+    layers = match_and_stack_rasters(template_path, [input_path], [Resampling.nearest], ["all"])[0]
+    add_matched_arrays_to_data_raster(cube_path, np.vstack([layers, layers]), ["a", "b", "c", "d"])
+    export_data_cube(cube_path, tmp_path / "cube.tif")
+    files = [f for f, _ in read_cube_bands(cube_path)]
+
+    drop_selected_layers_from_raster(cube_path, [0, 2])
+    drop_selected_layers_from_raster(tmp_path / "cube.tif", [0, 2])
+    with rio.open(cube_path) as cube, rio.open(tmp_path / "cube.tif") as exported:
+        assert cube.descriptions == exported.descriptions == ("b", "d")
+        np.testing.assert_array_equal(cube.read(), exported.read())
+
+    # Files are only removed on compaction
+    assert all(os.path.exists(f) for f in files)
+    assert sorted(compact_data_cube(cube_path)) == sorted([files[0], files[2]])
+    with rio.open(cube_path) as cube:
+        assert cube.read().shape[0] == 2
+
+    # A band file written but not yet listed is being added, and survives compaction
+    with rio.open(cube_path) as cube:
+        filename, band_profile = new_band_file(cube_path, cube.profile)
+    with rio.open(filename, 'w', **band_profile) as dst:
+        dst.write(layers[:1])
+    assert compact_data_cube(cube_path) == []
+    append_band_files_to_data_cube(cube_path, [(str(filename), "e")])
+    with rio.open(cube_path) as cube:
+        assert cube.descriptions == ("b", "d", "e")
+        np.testing.assert_array_equal(cube.read(3), layers[0])
+
+
+def test_placeholder_state_is_tagged(rasters, tmp_path, monkeypatch):
+    template_path, input_path = rasters
+    # Untagged rasters fall back to the pixel check
+    assert is_placeholder_data_raster(template_path)
+
+    data_path = tmp_path / "data.tif"
+    with rio.open(template_path) as src:
+        profile = src.profile
+    with rio.open(data_path, 'w', **profile) as dst:
+        dst.write(np.full((1, 300, 260), 7, dtype='float32'))
+        dst.update_tags(**{PLACEHOLDER_TAG: 'YES'})
+    create_data_cube(template_path, tmp_path / "cube.vrt")
+
+    layers = match_and_stack_rasters(template_path, [input_path], [Resampling.nearest], ["all"])[0]
+    # Tagged rasters are never scanned
+    monkeypatch.setattr(np, "all", lambda *args: pytest.fail("pixels were scanned"))
+    for path in (data_path, tmp_path / "cube.vrt"):
+        assert is_placeholder_data_raster(path)
+        add_matched_arrays_to_data_raster(path, layers, ["a", "b"])
+        assert not is_placeholder_data_raster(path)
+        add_matched_arrays_to_data_raster(path, layers[:1], ["c"])
+        with rio.open(path) as src:
+            assert src.descriptions == ("a", "b", "c")
+
+
+def test_add_selected_bands(rasters, tmp_path):
+    template_path, input_path = rasters
+    data_path = tmp_path / "data.tif"
+    with rio.open(template_path) as src:
+        profile = src.profile
+        template = src.read()
+    with rio.open(data_path, 'w', **profile) as dst:
+        dst.write(template)
+        dst.update_tags(**{PLACEHOLDER_TAG: 'YES'})
+    create_data_cube(template_path, tmp_path / "cube.vrt")
+    expected = match_raster_to_template(template_path, input_path, Resampling.bilinear, "all").astype('float32')
+
+    for path in (data_path, tmp_path / "cube.vrt"):
+        add_selected_bands_from_source_raster_to_data_raster(
+            path, input_path, ["Band 2: second"], Resampling.bilinear, block_size=1000)
+        add_selected_bands_from_source_raster_to_data_raster(
+            path, input_path, ["Band 2: again", "Band 1: first"], Resampling.bilinear, block_size=1000)
+        with rio.open(path) as src:
+            assert src.descriptions == ("second", "again", "first")
+            np.testing.assert_allclose(src.read(), expected[[1, 1, 0]], atol=1e-6)
+
+
+def test_virtual_stack_reads_windows(rasters):
+    template_path, input_path = rasters
+    args = (template_path, [input_path] * 2, [Resampling.bilinear, Resampling.nearest], [0, "all"])
+    expected = np.vstack(match_and_stack_rasters(*args)).astype('float32')
+
+    with VirtualStack(*args) as stack:
+        assert stack.shape == expected.shape
+        np.testing.assert_allclose(stack.read(), expected, atol=0.05)
+        blocks = list(stack.iter_windows(block_size=128))
+        assert len(blocks) == 9
+        for window, block in blocks:
+            assert block.shape == (3, window.height, window.width)
+            np.testing.assert_array_equal(block, stack.read(window))
+        window, block = blocks[0]
+        assert np.all(block[:, :40, :50] == NODATA)
+
+
+@pytest.fixture
+def cog_server(rasters, tmp_path):
+    """ Serves a tiled COG of the input raster, with overviews, over HTTP range requests """
+    _, input_path = rasters
+    cog_path = tmp_path / "input_cog.tif"
+    rio_copy(input_path, cog_path, driver='COG', blocksize=128, overview_resampling='average')
+    state = {"bytes": 0, "active": 0, "max_active": 0, "size": os.path.getsize(cog_path)}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.send_response(200 if self.path == "/input_cog.tif" else 404)
+            self.send_header("Content-Length", str(state["size"]))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path != "/input_cog.tif":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with lock:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            start, end = 0, state["size"] - 1
+            if "Range" in self.headers:
+                start, end = (int(x) for x in self.headers["Range"].split("=")[1].split("-"))
+                end = min(end, state["size"] - 1)
+            with open(cog_path, 'rb') as f:
+                f.seek(start)
+                body = f.read(end - start + 1)
+            time.sleep(0.01)
+            with lock:
+                state["bytes"] += len(body)
+                state["active"] -= 1
+            self.send_response(206 if "Range" in self.headers else 200)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{state['size']}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{httpd.server_address[1]}/input_cog.tif"
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_layer_cache_key_tracks_remote_version(rasters, cog_server, tmp_path):
+    template_path, _ = rasters
+    session = StackingSession(template_path)
+    url = cog_server["url"]
+    with LayerCache(tmp_path / "cache") as cache:
+        key = cache.key(url, "cog", "bilinear", session, 'float32')
+        assert cache.key(url, "cog", "bilinear", session, 'float32') == key
+        assert cache.key(url, "cog", "bilinear", session, 'float64') != key
+
+        # A file replaced at the same URL gets a new key
+        cog_server["size"] -= 1
+        assert cache.key(url, "cog", "bilinear", session, 'float32') != key
+
+
+def test_lazy_cog_matches_eager(rasters, cog_server):
+    template_path, input_path = rasters
+    session = StackingSession(template_path)
+    with rio.open(input_path) as src:
+        # The template's 100 m cells are close to the input's, so no overview is used
+        assert select_overview_level(src, session) is None
+
+    lazy = lazy_match_cog(cog_server["url"], "bilinear", session, chunk_size=64, max_concurrency=2)
+    assert lazy.shape == (2, 300, 260) and lazy.numblocks == (1, 5, 5)
+    assert cog_server["bytes"] < cog_server["size"]
+
+    matched = lazy.compute(scheduler="threads", num_workers=8)
+    full = match_raster_to_template(template_path, input_path, Resampling.bilinear, "all")
+    np.testing.assert_allclose(matched, full, atol=0.01)
+    assert cog_server["max_active"] <= 2
+    # The template covers only part of the input
+    assert cog_server["bytes"] < cog_server["size"]
+
+
+@pytest.fixture
+def coarse_template(tmp_path):
+    """ Template with 1 km cells, about 12 times coarser than the input """
+    coarse_path = tmp_path / "coarse.tif"
+    with rio.open(coarse_path, 'w', driver='GTiff', height=30, width=26, count=1, dtype='float32',
+                  crs='EPSG:32615', nodata=NODATA, transform=from_origin(400000, 4500000, 1000, 1000)) as dst:
+        dst.write(np.ones((1, 30, 26), dtype='float32'))
+    return coarse_path
+
+
+def test_lazy_cog_reads_overviews(rasters, cog_server, coarse_template):
+    _, input_path = rasters
+    coarse_path = coarse_template
+    session = StackingSession(coarse_path)
+    with rio.open(input_path) as src:
+        assert select_overview_level(src, session) is None
+    with rio.Env(**COG_ENV), rio.open(cog_server["url"]) as src:
+        assert src.overviews(1) == [2, 4]
+        assert select_overview_level(src, session) == 1
+
+    stack = match_cogList_to_template_andStack(coarse_path, [cog_server["url"]], [Resampling.average], lazy=True)
+    coarse = stack[0].compute()
+    full = match_raster_to_template(coarse_path, input_path, Resampling.average, "all")
+    np.testing.assert_allclose(coarse, full, atol=0.05)
+
+
+def test_match_reads_overviews_for_aggregating_methods(rasters, coarse_template, monkeypatch):
+    _, input_path = rasters
+    full = match_raster_to_template(coarse_template, input_path, Resampling.average, "all")
+    mtime = os.stat(input_path).st_mtime_ns
+
+    assert build_overviews(input_path, Resampling.average, min_size=64) == [2, 4]
+    assert os.path.exists(f"{input_path}.ovr") and os.stat(input_path).st_mtime_ns == mtime
+
+    session = StackingSession(coarse_template)
+    with rio.open(input_path) as src:
+        assert select_overview_level(src, session, Resampling.average) == 1
+        # The method may also be given by name or by GDAL code
+        assert select_overview_level(src, session, "average") == 1
+        assert select_overview_level(src, session, int(Resampling.average)) == 1
+        # Interpolating methods, and aggregates the overviews were not built with, read the full resolution
+        assert select_overview_level(src, session, Resampling.bilinear) is None
+        assert select_overview_level(src, session, Resampling.mode) is None
+        # The template grid is not coarser than the input
+        assert select_overview_level(src, StackingSession(rasters[0]), Resampling.average) is None
+
+    opened = []
+    rio_open = rio.open
+    monkeypatch.setattr(rio, "open", lambda *args, **kwargs: opened.append(kwargs) or rio_open(*args, **kwargs))
+    from_overview = session.match(input_path, Resampling.average, "all")
+    assert {"overview_level": 1} in opened
+    np.testing.assert_allclose(from_overview, full, atol=0.02)
+    opened.clear()
+    from_code = session.match(input_path, 5, "all", block_size=16)
+    assert {"overview_level": 1} in opened
+    np.testing.assert_allclose(from_code, full, atol=0.02)
+
+
+def test_make_overviews(rasters, coarse_template):
+    _, input_path = rasters
+    match_raster_to_template(coarse_template, input_path, Resampling.bilinear, 0, make_overviews=True)
+    assert not os.path.exists(f"{input_path}.ovr")
+
+    match_raster_to_template(coarse_template, input_path, Resampling.mode, 0, make_overviews=True)
+    with rio.open(input_path) as src:
+        assert src.overviews(1) == [2, 4, 8]
+        assert select_overview_level(src, StackingSession(coarse_template), Resampling.mode) is not None
+
+
+def test_stack_assembler_slots():
+    order = {'local': [0, 3], 'cog': [2, 1], 'full': [0, 1, 2, 3]}
+    local = [np.full((2, 4, 5), 0.0), np.full((1, 4, 5), 3.0)]
+    cog = [np.full((1, 4, 5), 2.0), np.full((1, 4, 5), 1.0)]
+    stack = reorder_array_lists_to_stack(local, cog, order)
+    assert stack.dtype == np.float32
+    np.testing.assert_array_equal(stack[:, 0, 0], [0, 0, 1, 2, 3])
+
+    assembler = StackAssembler(order, [2, 1, 1, 1], (4, 5))
+    assert np.shares_memory(assembler.slot('cog', 0), assembler.stack)
+    assert assembler.slot('local', 1).shape == (1, 4, 5)
+
+
+def test_match_and_assemble_stack(rasters, cog_server, tmp_path, monkeypatch):
+    template_path, input_path = rasters
+    # A COG between two local layers, the second of which is one band of the input
+    local_dict, cog_dict, order = parse_raster_processing_table_elements(
+        [str(input_path), cog_server["url"], f"{input_path}_1"], ['Qgs', 'CloudFront', 'file'],
+        [Resampling.bilinear, Resampling.bilinear, Resampling.nearest]
+    )
+    expected = np.concatenate([
+        match_raster_to_template(template_path, input_path, Resampling.bilinear, "all"),
+        match_raster_to_template(template_path, input_path, Resampling.bilinear, "all"),
+        match_raster_to_template(template_path, input_path, Resampling.nearest, 1),
+    ])
+
+    with LayerCache(tmp_path / "cache") as cache:
+        stack = match_and_assemble_stack(template_path, local_dict, cog_dict, order, num_threads=2,
+                                         block_size=128, cache=cache)
+        assert stack.shape == (5, 300, 260) and stack.dtype == np.float32
+        np.testing.assert_allclose(stack, expected, atol=0.05)
+        assert np.all(stack[:, :40, :50] == NODATA)
+
+        # A fully cached stack does not open the COGs
+        monkeypatch.setattr(match_stack_raster_tools, "lazy_match_cog", None)
+        cached = match_and_assemble_stack(template_path, local_dict, cog_dict, order, cache=cache)
+        np.testing.assert_array_equal(cached, stack)
+        assert cache.stats()["hits"] == 3
+
+
+def test_assembled_stack_peak_memory(rasters):
+    template_path, input_path = rasters
+    paths = [str(input_path)] * 4
+    methods = [Resampling.bilinear] * 4
+    local_dict, cog_dict, order = parse_raster_processing_table_elements(paths, ['Qgs'] * 4, methods)
+
+    tracemalloc.start()
+    try:
+        arrays = match_and_stack_rasters(template_path, paths, methods, ["all"] * 4)
+        reorder_array_lists_to_stack(arrays, [], order)
+        del arrays
+        _, list_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        match_and_assemble_stack(template_path, local_dict, cog_dict, order, block_size=64)
+        _, assembled_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert assembled_peak * 2 <= list_peak
+
+
+def test_eager_cog_cache_is_masked(rasters, tmp_path):
+    template_path, input_path = rasters
+    with LayerCache(tmp_path / "cache") as cache:
+        (eager,) = match_cogList_to_template_andStack(template_path, [str(input_path)], [Resampling.bilinear],
+                                                      cache=cache)
+        assert eager.dtype == np.float32 and np.all(eager[:, :40, :50] == NODATA)
+
+        # Layers cached by the eager path are read back as template-grid data
+        local_dict, cog_dict, order = parse_raster_processing_table_elements(
+            [str(input_path)], ['CloudFront'], [Resampling.bilinear])
+        stack = match_and_assemble_stack(template_path, local_dict, cog_dict, order, cache=cache)
+        assert cache.stats()["hits"] == 1
+        np.testing.assert_array_equal(stack, eager)
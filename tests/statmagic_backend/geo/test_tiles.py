@@ -0,0 +1,197 @@
+"""
+test_tiles - Test suite for vector tile downloading
+"""
+
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import mapbox_vector_tile
+import mercantile
+import pytest
+
+from statmagic_backend.geo import async_tiles
+from statmagic_backend.geo.async_tiles import iter_decoded_tiles
+from statmagic_backend.geo.tiles import HostRateLimiter, tile_url
+from statmagic_backend.geo.tile_cache import TileCache
+from statmagic_backend.geo.transform import download_tiles, decode_protobuf_layers_to_geojson_wgs84
+
+
+@pytest.fixture
+def tileserver():
+    """
+    Local tile server that echoes the request path back as the tile body, or
+    serves ``state["tile"]`` for every path once it is set
+    """
+    state = {"requests": 0, "fail_first": set(), "tile": None}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            state["requests"] += 1
+            if self.path in state["fail_first"]:
+                state["fail_first"].discard(self.path)
+                status, body = 503, b"busy"
+            else:
+                status, body = 200, state["tile"] or self.path.encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{httpd.server_address[1]}/tiles/"
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_tile_url():
+    assert tile_url("https://dev.macrostrat.org/tiles/", "carto", [7, 42, 43]) \
+        == "https://dev.macrostrat.org/tiles/carto/7/42/43"
+
+
+def test_download_tiles_keeps_order(tileserver):
+    tile_indices = [[10, x, y] for x in range(5) for y in range(5)]
+    tiles = download_tiles(tile_indices, tileserver["url"], "carto", max_workers=8)
+    assert tiles == [f"/tiles/carto/{z}/{x}/{y}".encode() for z, x, y in tile_indices]
+
+
+def test_download_tiles_retries(tileserver):
+    tileserver["fail_first"].add("/tiles/carto/10/1/2")
+    tiles = download_tiles([[10, 1, 2]], tileserver["url"], "carto", backoff_factor=0)
+    assert tiles == [b"/tiles/carto/10/1/2"]
+    assert tileserver["requests"] == 2
+
+
+def test_host_rate_limiter():
+    limiter = HostRateLimiter({"a.example": 50})
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.wait("http://a.example/tile")
+        limiter.wait("http://b.example/tile")  # not limited
+    # Five intervals of 1/50 s between six requests to the limited host
+    assert time.monotonic() - start >= 0.1
+
+
+def test_tile_cache_skips_network(tileserver, tmp_path):
+    tile_indices = [[10, 1, 1], [10, 1, 2]]
+    with TileCache(tmp_path / "tiles.mbtiles") as cache:
+        first = download_tiles(tile_indices, tileserver["url"], "carto", cache=cache)
+        # Overlapping extent: one cached tile, one new one
+        second = download_tiles(tile_indices[1:] + [[10, 1, 3]], tileserver["url"], "carto", cache=cache)
+        assert second[0] == first[1]
+        assert second[1] == b"/tiles/carto/10/1/3"
+        assert tileserver["requests"] == 3
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 3
+        assert cache.stats()["tiles"] == 3
+
+
+def test_tile_cache_lru_eviction(tmp_path):
+    with TileCache(tmp_path / "tiles.mbtiles", max_bytes=20) as cache:
+        cache.store("s", "carto", [[1, 0, 0]], [b"a" * 10])
+        cache.store("s", "carto", [[1, 0, 1]], [b"b" * 10])
+        cache.lookup("s", "carto", [[1, 0, 0]])  # make [1, 0, 1] least recent
+        cache.store("s", "carto", [[1, 1, 0]], [b"c" * 5])
+        entries = cache.lookup("s", "carto", [[1, 0, 0], [1, 0, 1], [1, 1, 0]])
+        assert [entry is not None for entry in entries] == [True, False, True]
+        # Replacing a tile only counts the size difference
+        cache.store("s", "carto", [[1, 1, 0]], [b"c" * 3])
+        assert cache.stats()["tiles"] == 2 and cache._bytes == 13
+
+    # The size is picked up again on reopening; eviction goes down to 90% of the cap
+    with TileCache(tmp_path / "tiles.mbtiles", max_bytes=20) as cache:
+        cache.store("s", "carto", [[1, 1, 1]], [b"d" * 5])
+        assert cache.stats()["tiles"] == 3 and cache.stats()["bytes"] == 18
+        cache.store("s", "carto", [[1, 1, 2]], [b"e" * 3])
+        assert cache.stats()["tiles"] == 3 and cache.stats()["bytes"] == 11
+
+        # A tile repeated in one batch is counted once
+        cache.store("s", "carto", [[1, 2, 0], [1, 2, 0]], [b"f" * 6, b"f" * 6])
+        assert cache.stats()["tiles"] == 4 and cache._bytes == 17
+
+    # Tiles stored by another instance sharing the database are counted
+    with TileCache(tmp_path / "tiles.mbtiles", max_bytes=20) as cache, \
+            TileCache(tmp_path / "tiles.mbtiles") as other:
+        other.store("s", "carto", [[2, 0, 0]], [b"g" * 10])
+        cache.store("s", "carto", [[2, 0, 1]], [b"h" * 4])
+        assert cache.stats()["bytes"] == 14
+
+
+def test_tile_cache_etag_revalidation(tmp_path):
+    with TileCache(tmp_path / "tiles.mbtiles", ttl=0) as cache:
+        cache.store("s", "carto", [[1, 0, 0]], [b"a"], ["etag-a"])
+        time.sleep(0.01)
+        (entry,) = cache.lookup("s", "carto", [[1, 0, 0]])
+        assert entry == (b"a", "etag-a", False)
+        cache.touch("s", "carto", [[1, 0, 0]])
+        assert cache.stats()["revalidations"] == 1
+
+
+def test_iter_decoded_tiles(tileserver, tmp_path):
+    tileserver["tile"] = mapbox_vector_tile.encode([{"name": "units", "features": [
+        {"geometry": "POLYGON((0 0,1000 0,1000 1000,0 1000,0 0))", "properties": {"map_id": 1}},
+    ]}])
+    tileserver["fail_first"].add("/tiles/carto/10/2/2")
+    tile_indices = [[10, x, y] for x in range(4) for y in range(4)]
+
+    async def collect(cache):
+        return [item async for item in iter_decoded_tiles(
+            tile_indices, tileserver["url"], "carto", ["units"], 4096,
+            max_workers=4, max_pending=2, backoff_factor=0, cache=cache
+        )]
+
+    with TileCache(tmp_path / "tiles.mbtiles") as cache:
+        # Tiles are looked up one at a time, not all up front
+        lookup = cache.lookup
+        lookup_sizes = []
+        cache.lookup = lambda *args: lookup_sizes.append(len(args[2])) or lookup(*args)
+        decoded = dict((tuple(i), layers) for i, layers in asyncio.run(collect(cache)))
+        assert lookup_sizes == [1] * len(tile_indices)
+        assert tileserver["requests"] == len(tile_indices) + 1
+        # Second run is answered from the cache
+        asyncio.run(collect(cache))
+        assert tileserver["requests"] == len(tile_indices) + 1
+
+    assert sorted(decoded) == sorted(tuple(i) for i in tile_indices)
+    for z, x, y in tile_indices:
+        bounds = mercantile.bounds(x, y, z)
+        assert decoded[(z, x, y)] == decode_protobuf_layers_to_geojson_wgs84(
+            tileserver["tile"], ["units"], bounds, 4096
+        )
+
+
+def test_iter_decoded_tiles_cancels_downloads_on_error(monkeypatch):
+    cancelled = []
+
+    async def fetch(client, url, *args):
+        if url.endswith("/10/0/0"):
+            await asyncio.sleep(0.05)
+            raise httpx.ConnectError("unreachable")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append((url, client.is_closed))
+            raise
+
+    monkeypatch.setattr(async_tiles, "fetch_tile_async", fetch)
+
+    async def collect():
+        return [item async for item in iter_decoded_tiles(
+            [[10, 0, y] for y in range(3)], "http://127.0.0.1:1/tiles/", "carto", ["units"], 4096,
+            max_workers=3
+        )]
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(collect())
+    # The other downloads were stopped before their client was closed
+    assert sorted(cancelled) == [("http://127.0.0.1:1/tiles/carto/10/0/1", False),
+                                 ("http://127.0.0.1:1/tiles/carto/10/0/2", False)]
@@ -0,0 +1,326 @@
+"""
+test_transform - Test suite for vector tile decoding and dissolving
+"""
+
+import json
+
+import fiona
+import geopandas as gpd
+import mapbox_vector_tile
+import mercantile
+import numpy as np
+import pyogrio
+import shapely
+from shapely.geometry import shape, box, LineString, Polygon
+from shapely.ops import unary_union
+from shapely.validation import make_valid
+
+from statmagic_backend.geo.transform import (
+    decode_protobuf_to_geojson_wgs84, dissolve_vector_files_by_property, get_tiles_for_ll_bounds,
+    get_adaptive_tiles_for_ll_bounds, clip_geometries_to_bbox, process_tiles, snap_to_tile_seams,
+    union_geometry_groups, zoom_level_for_precision, _round_coords
+)
+
+
+TILE_INDEX = [10, 240, 380]
+TILESIZE = 4096
+
+
+def make_tile():
+    return mapbox_vector_tile.encode([
+        {"name": "units", "features": [
+            {"geometry": "POLYGON((0 0,1000 0,1000 1000,0 1000,0 0),(10 10,20 10,20 20,10 10))",
+             "properties": {"map_id": 1}},
+            {"geometry": "MULTIPOLYGON(((0 0,10 0,10 10,0 0)),((2000 2000,3000 2000,3000 3000,2000 2000)))",
+             "properties": {"map_id": 2}},
+        ]},
+        {"name": "lines", "features": [
+            {"geometry": "LINESTRING(0 0,5 5,4095 17)", "properties": {"line_id": 3}},
+            {"geometry": "MULTILINESTRING((0 0,5 5),(1 1,2 2))", "properties": {"line_id": 4}},
+        ]},
+    ])
+
+
+def georegister_pair(pair, bounds):
+    return [
+        round(float(pair[0]) / float(TILESIZE) * (bounds.east - bounds.west) + bounds.west, 5),
+        round(float(pair[1]) / float(TILESIZE) * (bounds.north - bounds.south) + bounds.south, 5),
+    ]
+
+
+def georegister_nested(coords, bounds):
+    if not isinstance(coords[0], list):
+        return georegister_pair(coords, bounds)
+    return [georegister_nested(c, bounds) for c in coords]
+
+
+def test_decode_georegisters_every_geometry_type():
+    tile = make_tile()
+    bounds = mercantile.bounds(TILE_INDEX[1], TILE_INDEX[2], TILE_INDEX[0])
+    for layername in ("units", "lines"):
+        raw = mapbox_vector_tile.decode(tile)[layername]
+        data = decode_protobuf_to_geojson_wgs84(tile, layername, bounds, TILESIZE)
+        assert len(data['features']) == len(raw['features'])
+        for feature, raw_feature in zip(data['features'], raw['features']):
+            assert feature['properties'] == raw_feature['properties']
+            assert feature['geometry']['type'] == raw_feature['geometry']['type']
+            assert feature['geometry']['coordinates'] \
+                == georegister_nested(raw_feature['geometry']['coordinates'], bounds)
+
+
+def test_decode_missing_layer():
+    bounds = mercantile.bounds(TILE_INDEX[1], TILE_INDEX[2], TILE_INDEX[0])
+    assert decode_protobuf_to_geojson_wgs84(make_tile(), "points", bounds, TILESIZE) is None
+
+
+def test_rounding_matches_builtin_round():
+    values = np.array([0.000005, 1.234565, -95.123455, 41.000015, 2.675, -0.000015])
+    assert _round_coords(values).tolist() == [round(v, 5) for v in values.tolist()]
+
+
+def test_process_tiles_decodes_once_for_all_layers(tmp_path, monkeypatch):
+    calls = []
+    decode = mapbox_vector_tile.decode
+    monkeypatch.setattr(mapbox_vector_tile, "decode", lambda tile: calls.append(1) or decode(tile))
+
+    js_paths = process_tiles([make_tile()], [TILE_INDEX], tmp_path, ["units", "lines"], TILESIZE)
+    assert len(calls) == 1
+    assert js_paths == {
+        "units": [tmp_path / "units" / "10-240-380.json"],
+        "lines": [tmp_path / "lines" / "10-240-380.json"],
+    }
+    with open(js_paths["lines"][0]) as f:
+        assert len(json.load(f)["features"]) == 2
+
+    # A single layer name keeps the original flat layout
+    assert process_tiles([make_tile()], [TILE_INDEX], tmp_path, "units", TILESIZE) \
+        == [tmp_path / "10-240-380.json"]
+
+
+def read_features(path):
+    with fiona.open(path) as src:
+        return [(dict(f['properties']), shape(f['geometry']).wkt) for f in src]
+
+
+def test_in_memory_dissolve_matches_files(tmp_path):
+    tiles = [make_tile(), make_tile()]
+    tile_indices = [TILE_INDEX, [10, 241, 380]]
+
+    js_paths = process_tiles(tiles, tile_indices, tmp_path / "tiles", "units", TILESIZE)
+    dissolve_vector_files_by_property(
+        js_paths, 'map_id', ['Polygon', 'MultiPolygon'], tmp_path / "from_files.json")
+
+    features = process_tiles(tiles, tile_indices, None, "units", TILESIZE, return_features=True)
+    assert all(isinstance(f, dict) for f in features)
+    dissolve_vector_files_by_property(
+        features, 'map_id', ['Polygon', 'MultiPolygon'], tmp_path / "in_memory.json")
+
+    expected = read_features(tmp_path / "from_files.json")
+    assert len(expected) == 2
+    assert read_features(tmp_path / "in_memory.json") == expected
+
+
+def test_dissolve_empty_feature_collections(tmp_path):
+    # e.g. an all-ocean AOI, whose tiles have no features
+    empty = [{'type': 'FeatureCollection', 'features': []}]
+    for streaming in (False, True):
+        output_file = tmp_path / f"empty_{streaming}.json"
+        dissolve_vector_files_by_property(
+            empty, 'map_id', ['Polygon', 'MultiPolygon'], output_file, streaming=streaming)
+        assert read_features(output_file) == []
+
+
+def test_get_tiles_for_ll_bounds_is_exact():
+    bounds = dict(n=42.4046340196102, s=40.35045988370135, e=-93.39360118961542, w=-97.14894692014128)
+    for zoom_level in (4, 10, 13):
+        tiles = get_tiles_for_ll_bounds(**bounds, zoom_level=zoom_level)
+        ul = mercantile.tile(bounds['w'], bounds['n'], zoom_level)
+        lr = mercantile.tile(bounds['e'], bounds['s'], zoom_level)
+        assert len(tiles) == (lr.x - ul.x + 1) * (lr.y - ul.y + 1)
+        assert len({tuple(t) for t in tiles}) == len(tiles)
+        assert [ul.z, ul.x, ul.y] in tiles and [lr.z, lr.x, lr.y] in tiles
+
+
+def test_get_tiles_for_ll_bounds_antimeridian():
+    tiles = get_tiles_for_ll_bounds(n=60, s=50, e=-170, w=170, zoom_level=5)
+    xs = {x for _, x, _ in tiles}
+    assert 0 in xs and 31 in xs and 15 not in xs
+
+
+def test_get_tiles_for_ll_bounds_aoi():
+    # Thin diagonal AOI only touches the tiles along the diagonal of its bbox
+    aoi = LineString([(-97, 40.5), (-93.5, 42.3)]).buffer(0.01)
+    bbox_tiles = get_tiles_for_ll_bounds(n=42.31, s=40.49, e=-93.49, w=-97.01, zoom_level=9)
+    aoi_tiles = get_tiles_for_ll_bounds(n=42.31, s=40.49, e=-93.49, w=-97.01, zoom_level=9, aoi=aoi)
+    assert 0 < len(aoi_tiles) < len(bbox_tiles)
+    assert all(t in bbox_tiles for t in aoi_tiles)
+
+    # The caller's AOI is not prepared in place
+    get_adaptive_tiles_for_ll_bounds(n=42.31, s=40.49, e=-93.49, w=-97.01, precision=4000, aoi=aoi)
+    assert not shapely.is_prepared(aoi)
+
+
+def test_adaptive_tiles_cover_bbox_once():
+    bounds = dict(n=70, s=20, e=-100, w=-110)
+    tiles = get_adaptive_tiles_for_ll_bounds(**bounds, precision=4000)
+    zooms = {z for z, _, _ in tiles}
+    assert zooms == {5, 6}
+    # Fewer tiles than a single zoom level with the same worst-case precision
+    finest = get_tiles_for_ll_bounds(**bounds, zoom_level=max(zooms))
+    assert len(tiles) < len(finest)
+    # Each finest-zoom tile lies in exactly one selected tile
+    selected = {tuple(t) for t in tiles}
+    for t in mercantile.tiles(bounds['w'], bounds['s'], bounds['e'], bounds['n'], max(zooms)):
+        ancestors = [tuple(mercantile.parent(t, zoom=z)) if z < t.z else tuple(t) for z in zooms]
+        assert sum((z, x, y) in selected for x, y, z in ancestors) == 1
+    # Every tile reaches the precision at its latitude nearest the equator
+    for z, x, y in tiles:
+        assert z >= zoom_level_for_precision(4000, mercantile.bounds(x, y, z).south)
+
+
+def test_adaptive_tiles_tile_budget():
+    bounds = dict(n=70, s=20, e=-100, w=-110)
+    tiles = get_adaptive_tiles_for_ll_bounds(**bounds, precision=4000, max_tiles=20)
+    assert 0 < len(tiles) <= 20
+
+
+def test_dissolve_mixed_zoom_seams(tmp_path):
+    coarse = mercantile.bounds(120, 190, 9)
+    fine = mercantile.bounds(242, 380, 10)
+    seam = fine.west
+    # A feature cut at the seam between a z9 and an adjacent z10 tile
+    left = box(coarse.west + 0.1, fine.south + 0.01, round(seam - 1.2e-4, 5), fine.south + 0.1)
+    right = box(round(seam + 4e-6, 5), fine.south + 0.01, fine.east - 0.1, fine.south + 0.1)
+    features = [
+        {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'map_id': 1}, 'geometry': shapely.geometry.mapping(g)}
+        ]} for g in (left, right)
+    ]
+    args = ('map_id', ['Polygon', 'MultiPolygon'])
+    for streaming in (False, True):
+        output = tmp_path / f"dissolved_{streaming}.json"
+        dissolve_vector_files_by_property(
+            features, *args, output, seam_zoom_level=[9, 10], streaming=streaming)
+        ((_, wkt),) = read_features(output)
+        assert len(shapely.get_parts(shapely.from_wkt(wkt))) == 1
+
+
+def test_union_geometry_groups_matches_per_feature_union():
+    bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)])  # invalid
+    groups = [
+        [box(0, 0, 1, 1), box(1, 0, 2, 1), bowtie],
+        [box(5, 5, 6, 6)],
+        [box(0, 0, 3, 3), box(1, 1, 2, 2)],
+    ]
+    expected = [unary_union([make_valid(g) for g in geoms]) for geoms in groups]
+    for num_workers in (1, 2):
+        unions = union_geometry_groups(groups, num_workers=num_workers)
+        assert [u.wkb for u in unions] == [x.wkb for x in expected]
+
+
+def test_parallel_dissolve_matches_serial(tmp_path):
+    features = process_tiles([make_tile(), make_tile()], [TILE_INDEX, [10, 241, 380]],
+                             None, "units", TILESIZE, return_features=True)
+    for num_workers in (1, 2):
+        dissolve_vector_files_by_property(
+            features, 'map_id', ['Polygon', 'MultiPolygon'],
+            tmp_path / f"dissolved_{num_workers}.json", num_workers=num_workers)
+    assert read_features(tmp_path / "dissolved_2.json") == read_features(tmp_path / "dissolved_1.json")
+
+
+def test_clip_geometries_to_bbox():
+    geoms = [box(1, 1, 2, 2), box(-1, -1, 1, 1), box(20, 20, 21, 21), LineString([(5, -5), (5, 15)])]
+    clipped = clip_geometries_to_bbox(geoms, n=10, s=0, e=10, w=0)
+    assert clipped[0] is geoms[0]  # inside: untouched
+    assert clipped[1].equals(box(0, 0, 1, 1))
+    assert clipped[2].is_empty
+    assert clipped[3].equals(LineString([(5, 0), (5, 10)]))
+
+    # Bounds at 0 still clip
+    assert clip_geometries_to_bbox([box(-1, 1, 1, 2)], n=10, s=0, e=10, w=0)[0].equals(box(0, 1, 1, 2))
+
+
+def test_clip_geometries_to_antimeridian_bbox():
+    geoms = [box(175, 50, 179, 55), box(-179, 50, -175, 55), box(0, 50, 1, 55), box(165, 50, 175, 55)]
+    clipped = clip_geometries_to_bbox(geoms, n=60, s=40, e=-170, w=170)
+    assert clipped[0] is geoms[0]
+    assert clipped[1] is geoms[1]
+    assert clipped[2].is_empty
+    assert clipped[3].equals(box(170, 50, 175, 55))
+
+
+def test_dissolve_clips_to_bbox(tmp_path):
+    features = process_tiles([make_tile()], [TILE_INDEX], None, "units", TILESIZE, return_features=True)
+    bounds = mercantile.bounds(TILE_INDEX[1], TILE_INDEX[2], TILE_INDEX[0])
+    # Cuts through map_id 1 and leaves map_id 2 inside
+    clip = dict(n=bounds.north, s=bounds.south, e=bounds.east, w=bounds.west + 0.01)
+    dissolve_vector_files_by_property(
+        features, 'map_id', ['Polygon', 'MultiPolygon'], tmp_path / "clipped.json", **clip)
+
+    bbox_geom = box(clip['w'], clip['s'], clip['e'], clip['n'])
+    with fiona.open(tmp_path / "clipped.json") as src:
+        clipped = {f['properties']['map_id']: shape(f['geometry']) for f in src}
+    for feature in features[0]['features']:
+        expected = make_valid(shape(feature['geometry'])).intersection(bbox_geom)
+        assert clipped[feature['properties']['map_id']].equals(expected)
+
+
+def test_streaming_dissolve_matches_in_memory(tmp_path):
+    tiles = [make_tile(), make_tile()]
+    tile_indices = [TILE_INDEX, [10, 241, 380]]
+    js_paths = process_tiles(tiles, tile_indices, tmp_path / "tiles", "units", TILESIZE)
+    bounds = mercantile.bounds(TILE_INDEX[1], TILE_INDEX[2], TILE_INDEX[0])
+    clip = dict(n=bounds.north, s=bounds.south, e=bounds.east + 0.1, w=bounds.west + 0.01)
+
+    dissolve_vector_files_by_property(
+        js_paths, 'map_id', ['Polygon', 'MultiPolygon'], tmp_path / "dissolved.json", **clip)
+    dissolve_vector_files_by_property(
+        js_paths, 'map_id', ['Polygon', 'MultiPolygon'], tmp_path / "streamed.json", **clip,
+        streaming=True, batch_size=1, spill_dir=tmp_path)
+
+    expected = read_features(tmp_path / "dissolved.json")
+    streamed = read_features(tmp_path / "streamed.json")
+    assert [p for p, _ in streamed] == [p for p, _ in expected]
+    for (_, wkt), (_, expected_wkt) in zip(streamed, expected):
+        assert shapely.from_wkt(wkt).equals(shapely.from_wkt(expected_wkt))
+    # The spill file is removed afterwards
+    assert not list(tmp_path.glob("*.sqlite"))
+
+
+def test_dissolve_columnar_outputs(tmp_path):
+    tiles = [make_tile(), make_tile()]
+    tile_indices = [TILE_INDEX, [10, 241, 380]]
+    js_paths = process_tiles(tiles, tile_indices, tmp_path / "tiles", "units", TILESIZE)
+    features = process_tiles(tiles, tile_indices, None, "units", TILESIZE, return_features=True)
+    args = ('map_id', ['Polygon', 'MultiPolygon'])
+
+    dissolve_vector_files_by_property(js_paths, *args, tmp_path / "dissolved.json")
+    expected = gpd.read_file(tmp_path / "dissolved.json")
+
+    for inputs in (js_paths, features):
+        for name in ("dissolved.parquet", "dissolved.fgb"):
+            dissolve_vector_files_by_property(inputs, *args, tmp_path / name)
+            gdf = gpd.read_parquet(tmp_path / name) if name.endswith("parquet") else gpd.read_file(tmp_path / name)
+            # The FlatGeobuf spatial index reorders features
+            gdf = gdf.sort_values('map_id').reset_index(drop=True)
+            assert list(gdf['map_id']) == list(expected['map_id'])
+            assert gdf.crs.to_epsg() == 4326
+            assert all(gdf.geom_type == 'MultiPolygon')
+            assert all(gdf.geometry.geom_equals_exact(expected.geometry, 1e-9))
+
+    assert pyogrio.read_info(tmp_path / "dissolved.fgb")['capabilities']['fast_spatial_filter']
+
+
+def test_snap_to_tile_seams_closes_slivers():
+    west, east = mercantile.bounds(240, 380, 10), mercantile.bounds(241, 380, 10)
+    seam = east.west
+    # Both halves of a feature cut at the seam, each side rounded on its own
+    left = box(west.west + 0.1, 40.0, round(seam - 4e-6, 5) - 1e-5, 40.1)
+    right = box(round(seam + 4e-6, 5), 40.0, east.east - 0.1, 40.1)
+    assert unary_union([left, right]).geom_type == 'MultiPolygon'
+
+    snapped = snap_to_tile_seams([left, right], 10)
+    assert unary_union(snapped).geom_type == 'Polygon'
+    xs = [shapely.get_coordinates(g)[:, 0] for g in snapped]
+    assert set(xs[0]) == {left.bounds[0], round(seam, 5)}
+    assert set(xs[1]) == {round(seam, 5), right.bounds[2]}